@@ -1,46 +1,57 @@
-from decimal import Decimal, ROUND_HALF_UP, getcontext
+from datetime import date
+from decimal import getcontext
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
-import json
 import os
 from uuid import uuid4
 
+from settlement import METHODS, build_report, from_minor, precision, to_decimal, to_minor
+from storage import GroupCommit, open_storage, storage_path
+from storage.cache import ResultCache
+from storage.ledger import PLAN_MARGIN
+from storage.netting import EventBalances, net_report
+from storage.participants import active_names, named_expense, names_by_id
+from storage.window import DateIndex
+
 getcontext().prec = 28
 
 DATA_FILE = os.environ.get("GROUP_EXPENSE_DATA_FILE", "data.json")
+# storage engine: "json" (data.json rewritten on every save), "journal" (data.json plus an
+# append-only mutation log) or "sqlite" (row-level writes)
+STORAGE_ENGINE = os.environ.get("GROUP_EXPENSE_STORAGE", "json")
+# snapshot encoding for the json and journal engines: "json" or "binary"
+SNAPSHOT_FORMAT = os.environ.get("GROUP_EXPENSE_SNAPSHOT_FORMAT", "json")
+STORAGE_PATH = (os.environ.get("GROUP_EXPENSE_STORAGE_PATH")
+                or storage_path(STORAGE_ENGINE, DATA_FILE, SNAPSHOT_FORMAT))
+# when set, concurrent mutations arriving within this many milliseconds share one durable write
+COMMIT_WINDOW_MS = os.environ.get("GROUP_EXPENSE_COMMIT_WINDOW_MS")
+# archived event data files that /api/netting settles together
+EVENTS_DIR = os.environ.get("GROUP_EXPENSE_EVENTS_DIR", "events")
+# how long /api/report?method=optimal may search for the fewest payments before settling greedily
+SETTLE_BUDGET_MS = float(os.environ.get("GROUP_EXPENSE_SETTLE_BUDGET_MS", "200"))
+# the longest budget_ms or deadline_ms a request may ask for: the search holds a worker that long
+MAX_SETTLE_MS = float(os.environ.get("GROUP_EXPENSE_MAX_SETTLE_MS", "2000"))
 
 app = Flask(__name__, static_folder="static", static_url_path="/static")
 CORS(app)
 
+storage = open_storage(STORAGE_ENGINE, STORAGE_PATH, SNAPSHOT_FORMAT)
+if COMMIT_WINDOW_MS is not None:
+    storage = GroupCommit(storage, float(COMMIT_WINDOW_MS) / 1000.0)
+# serialized /api/report bodies, keyed by storage.version() and the query parameters
+report_cache = ResultCache()
+# the DateIndex behind /api/report?from=&to=, for the current storage.version()
+date_indexes = ResultCache(size=1)
+# per-event totals for /api/netting, kept while each file is unchanged
+event_balances = EventBalances()
+
 
 def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r") as f:
-            d = json.load(f)
-            # ensure shape
-            if 'participants' not in d:
-                d['participants'] = []
-            if 'expenses' not in d:
-                d['expenses'] = []
-            if 'event' not in d:
-                d['event'] = ''
-            if 'currency' not in d:
-                d['currency'] = 'CAD'
-            return d
-    return {"participants": [], "expenses": [], "event": '', "currency": 'CAD'}
+    return storage.load()
 
 
 def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
-
-
-def to_decimal(v):
-    return Decimal(str(v))
-
-
-def quant(v):
-    return v.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    storage.save(data)
 
 
 @app.route("/", methods=["GET"])
@@ -50,7 +61,6 @@ def index():
 
 @app.route("/api/participants", methods=["POST"])
 def set_participants():
-    data = load_data()
     payload = request.get_json() or {}
     names = payload.get("names") or []
     # normalize and remove duplicates while preserving order
@@ -63,135 +73,131 @@ def set_participants():
             seen.add(n)
             unique.append(n)
     names = unique
-    data["participants"] = names
-    # remove expenses by missing participants
-    data["expenses"] = [e for e in data.get("expenses", []) if e.get("payer") in names]
-    save_data(data)
+    # also removes expenses by missing participants
+    storage.commit({"op": "set_participants", "names": names})
     return jsonify({"ok": True, "participants": names})
 
 
+def currency_digits():
+    return precision(storage.settings()["currency"])
+
+
+def public_expense(e, digits, names=None):
+    # storage counts integer minor units and refers to people by id; the API
+    # speaks currency units and names
+    e = named_expense(e, names) if names is not None else dict(e)
+    e["amount"] = from_minor(e.pop("amount_minor", 0), digits)
+    return e
+
+
+def by_name(records, *totals):
+    """Re-key per-participant totals from ids to names, in participant order."""
+    return [{p["name"]: t.get(p["id"], 0) for p in records} for t in totals]
+
+
+def normalize_split(split, parts):
+    # if not provided or empty, default to all participants
+    if not split or split == "all":
+        return parts.copy()
+    if isinstance(split, dict) and isinstance(split.get("except"), list):
+        # {"except": [names]}: everyone but those
+        split = [p for p in parts if p not in split["except"]]
+    # filter invalid participants
+    split = [s for s in split if s in parts]
+    if not split:
+        # fallback to all
+        return parts.copy()
+    return split
+
+
 @app.route("/api/expense", methods=["POST"])
 def add_expense():
-    data = load_data()
     payload = request.get_json() or {}
     payer = payload.get("payer")
     amount = payload.get("amount")
     description = payload.get("description", "")
     date = payload.get("date", "")
     split = payload.get("split")
-    if payer not in data.get("participants", []):
+    parts = storage.participants()
+    if payer not in parts:
         return jsonify({"ok": False, "error": "payer not in participants"}), 400
+    digits = currency_digits()
     try:
-        amt = quant(to_decimal(amount))
+        amount_minor = to_minor(to_decimal(amount), digits)
     except Exception:
         return jsonify({"ok": False, "error": "invalid amount"}), 400
-    # normalize split: if not provided or empty, default to all participants
-    parts = data.get("participants", [])
-    if not split:
-        split = parts.copy()
-    else:
-        # filter invalid participants
-        split = [s for s in split if s in parts]
-        if not split:
-            # fallback to all
-            split = parts.copy()
+    split = normalize_split(split, parts)
 
-    expense = {"id": str(uuid4()), "payer": payer, "amount": float(amt), "description": description, "date": date, "split": split}
-    data.setdefault("expenses", []).append(expense)
-    save_data(data)
-    return jsonify({"ok": True, "expense": expense})
+    expense = {"id": str(uuid4()), "payer": payer, "amount_minor": amount_minor, "description": description, "date": date, "split": split}
+    storage.commit({"op": "add_expense", "expense": expense})
+    return jsonify({"ok": True, "expense": public_expense(expense, digits)})
 
 
 @app.route("/api/expense/<eid>", methods=["PUT"])
 def edit_expense(eid):
-    data = load_data()
     payload = request.get_json() or {}
-    expenses = data.get("expenses", [])
-    for e in expenses:
-        if e.get("id") == eid:
-            payer = payload.get("payer", e.get("payer"))
-            amount = payload.get("amount", e.get("amount"))
-            description = payload.get("description", e.get("description"))
-            date = payload.get("date", e.get("date"))
-            split = payload.get("split", e.get("split"))
-            if payer not in data.get("participants", []):
-                return jsonify({"ok": False, "error": "payer not in participants"}), 400
-            try:
-                amt = quant(to_decimal(amount))
-            except Exception:
-                return jsonify({"ok": False, "error": "invalid amount"}), 400
-            e["payer"] = payer
-            e["amount"] = float(amt)
-            e["description"] = description
-            e["date"] = date
-            # validate split
-            parts = data.get("participants", [])
-            if not split:
-                split = parts.copy()
-            else:
-                split = [s for s in split if s in parts]
-                if not split:
-                    split = parts.copy()
-            e["split"] = split
-            save_data(data)
-            return jsonify({"ok": True, "expense": e})
-    return jsonify({"ok": False, "error": "not found"}), 404
+    e = storage.get_expense(eid)
+    if e is None:
+        return jsonify({"ok": False, "error": "not found"}), 404
+    e = named_expense(e, storage.participant_names())
+    payer = payload.get("payer", e.get("payer"))
+    description = payload.get("description", e.get("description"))
+    date = payload.get("date", e.get("date"))
+    split = payload.get("split", e.get("split"))
+    parts = storage.participants()
+    if payer not in parts:
+        return jsonify({"ok": False, "error": "payer not in participants"}), 400
+    digits = currency_digits()
+    amount_minor = e.get("amount_minor", 0)
+    if "amount" in payload:
+        try:
+            amount_minor = to_minor(to_decimal(payload["amount"]), digits)
+        except Exception:
+            return jsonify({"ok": False, "error": "invalid amount"}), 400
+    e = dict(e, payer=payer, amount_minor=amount_minor, description=description, date=date)
+    e.pop("amount", None)
+    # validate split
+    e["split"] = normalize_split(split, parts)
+    if not storage.commit({"op": "edit_expense", "expense": e}):
+        return jsonify({"ok": False, "error": "not found"}), 404
+    return jsonify({"ok": True, "expense": public_expense(e, digits)})
 
 
 @app.route("/api/expense/<eid>", methods=["DELETE"])
 def delete_expense(eid):
-    data = load_data()
-    expenses = data.get("expenses", [])
-    new = [e for e in expenses if e.get("id") != eid]
-    if len(new) == len(expenses):
+    if not storage.commit({"op": "delete_expense", "id": eid}):
         return jsonify({"ok": False, "error": "not found"}), 404
-    data["expenses"] = new
-    save_data(data)
     return jsonify({"ok": True})
 
 
 @app.route("/api/participants/rename", methods=["POST"])
 def rename_participant():
-    data = load_data()
     payload = request.get_json() or {}
     old = payload.get("old")
     new = payload.get("new")
     if not old or not new:
         return jsonify({"ok": False, "error": "old and new required"}), 400
-    parts = data.get("participants", [])
+    parts = storage.participants()
     if old not in parts:
         return jsonify({"ok": False, "error": "old not found"}), 404
-    # replace only the first exact match to avoid renaming duplicates unintentionally
-    for idx, p in enumerate(parts):
-        if p == old:
-            parts[idx] = new
-            break
-    data["participants"] = parts
-    # update expenses
-    for e in data.get("expenses", []):
-        if e.get("payer") == old:
-            e["payer"] = new
-    save_data(data)
+    if new in parts and new != old:
+        # names identify participants at the API, so they must stay unique
+        return jsonify({"ok": False, "error": "new already exists"}), 400
+    parts = storage.commit({"op": "rename_participant", "old": old, "new": new})
     return jsonify({"ok": True, "participants": parts})
 
 
 @app.route("/api/participant/<name>", methods=["DELETE"])
 def delete_participant(name):
-    data = load_data()
-    parts = data.get("participants", [])
-    if name not in parts:
+    if name not in storage.participants():
         return jsonify({"ok": False, "error": "not found"}), 404
-    parts = [p for p in parts if p != name]
-    data["participants"] = parts
-    # remove expenses by that participant
-    data["expenses"] = [e for e in data.get("expenses", []) if e.get("payer") != name]
-    save_data(data)
+    # also removes expenses by that participant
+    parts = storage.commit({"op": "delete_participant", "name": name})
     return jsonify({"ok": True, "participants": parts})
 
 
 @app.route("/api/restore", methods=["POST"])
 def restore_item():
-    data = load_data()
     payload = request.get_json() or {}
     typ = payload.get("type")
     item = payload.get("item")
@@ -199,24 +205,16 @@ def restore_item():
         # avoid duplicate ids
         if not item or not item.get("id"):
             return jsonify({"ok": False, "error": "invalid item"}), 400
-        if any(e.get("id") == item.get("id") for e in data.get("expenses", [])):
+        # the item comes back as the API sent it, with the amount in currency units;
+        # storage converts such records to minor units
+        if not storage.commit({"op": "restore_expense", "expense": item}):
             return jsonify({"ok": False, "error": "already exists"}), 400
-        data.setdefault("expenses", []).append(item)
-        save_data(data)
         return jsonify({"ok": True, "expense": item})
     elif typ == "participant":
         if not item or not item.get("name"):
             return jsonify({"ok": False, "error": "invalid item"}), 400
-        name = item["name"]
-        parts = data.get("participants", [])
-        if name not in parts:
-            parts.append(name)
         # optionally restore expenses attached
-        for e in item.get("expenses", []):
-            if not any(x.get("id") == e.get("id") for x in data.get("expenses", [])):
-                data.setdefault("expenses", []).append(e)
-        data["participants"] = parts
-        save_data(data)
+        parts = storage.commit({"op": "restore_participant", "name": item["name"], "expenses": item.get("expenses", [])})
         return jsonify({"ok": True, "participants": parts})
     else:
         return jsonify({"ok": False, "error": "unknown type"}), 400
@@ -224,135 +222,163 @@ def restore_item():
 
 @app.route("/api/data", methods=["GET"])
 def get_data():
-    return jsonify(load_data())
+    data = dict(load_data())
+    digits = precision(data.get("currency"))
+    names = names_by_id(data)
+    data["participants"] = active_names(data)
+    data.pop("former_participants", None)
+    data.pop("ledger", None)
+    data["expenses"] = [public_expense(e, digits, names) for e in data.get("expenses", [])]
+    return jsonify(data)
 
 
 @app.route("/api/settings", methods=["GET", "POST"])
 def settings():
-    data = load_data()
     if request.method == 'GET':
-        return jsonify({
-            'event': data.get('event', ''),
-            'currency': data.get('currency', 'CAD')
-        })
+        return jsonify(storage.settings())
     # POST -> update settings
     payload = request.get_json() or {}
     event = payload.get('event')
     currency = payload.get('currency')
-    if event is not None:
-        data['event'] = str(event)
-    if currency is not None:
-        data['currency'] = str(currency)
-    save_data(data)
-    return jsonify({'ok': True, 'settings': {'event': data.get('event', ''), 'currency': data.get('currency', 'CAD')}})
+    try:
+        updated = storage.commit({"op": "settings", "event": event, "currency": currency})
+    except ValueError as exc:
+        # a currency whose minor unit can't hold every stored amount
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    return jsonify({'ok': True, 'settings': updated})
+
+
+@app.route("/api/stats", methods=["GET"])
+def stats():
+    # per-process counters; under gunicorn each worker reports its own
+    return jsonify({"ok": True, "pid": os.getpid(), "engine": STORAGE_ENGINE, "storage": storage.stats(),
+                    "report_cache": report_cache.stats(), "event_balances": event_balances.stats()})
+
+
+def flow_constraints(args):
+    """The method=flow constraints: ?blocked=A:B (neither pays the other) and ?max_incoming=A:N, repeated."""
+    blocked = set()
+    for pair in args.getlist("blocked"):
+        a, sep, b = pair.partition(":")
+        if not sep or not a or not b:
+            raise ValueError("blocked must be NAME:NAME")
+        blocked.update([(a, b), (b, a)])
+    max_incoming = {}
+    for item in args.getlist("max_incoming"):
+        name, sep, count = item.rpartition(":")
+        if not sep or not name or not count.isdigit():
+            raise ValueError("max_incoming must be NAME:COUNT")
+        max_incoming[name] = int(count)
+    return {"blocked": blocked, "max_incoming": max_incoming}
+
+
+def date_window(args):
+    """(from, to) dates of a windowed report, either None when left out; None without either."""
+    bounds = []
+    for arg in ("from", "to"):
+        value = args.get(arg)
+        try:
+            bounds.append(date.fromisoformat(value) if value else None)
+        except ValueError:
+            raise ValueError("invalid %s: expected YYYY-MM-DD" % arg)
+    if bounds == [None, None]:
+        return None
+    if None not in bounds and bounds[0] > bounds[1]:
+        raise ValueError("from is after to")
+    return tuple(bounds)
+
+
+def settlement_args(args):
+    """(method, budget in ms, flow constraints or None) from the query; ValueError with the message for a 400."""
+    method = args.get("method", "greedy")
+    if method not in METHODS:
+        raise ValueError("method must be one of: " + ", ".join(METHODS))
+    # how long optimal may search, or until when anytime keeps improving
+    budget_arg = "deadline_ms" if method == "anytime" else "budget_ms"
+    try:
+        budget_ms = float(args.get(budget_arg, SETTLE_BUDGET_MS))
+    except ValueError:
+        budget_ms = None
+    if budget_ms is None or not 0 <= budget_ms < float("inf"):
+        raise ValueError("invalid " + budget_arg)
+    if budget_ms > MAX_SETTLE_MS:
+        raise ValueError("%s may be at most %g" % (budget_arg, MAX_SETTLE_MS))
+    return method, budget_ms, flow_constraints(args) if method == "flow" else None
 
 
 @app.route("/api/report", methods=["GET"])
 def report():
-    data = load_data()
-    participants = data.get("participants", [])
-    expenses = data.get("expenses", [])
-    n = len(participants)
-    if n == 0:
+    try:
+        method, budget_ms, constraints = settlement_args(request.args)
+        window = date_window(request.args)
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    # the same dataset and parameters give the same bytes; the version changes with every save
+    version = storage.version()
+    params = (method, budget_ms if method in ("optimal", "anytime") else None)
+    if constraints:
+        params += (tuple(sorted(constraints["blocked"])), tuple(sorted(constraints["max_incoming"].items())))
+    if window:
+        params += (window,)
+    body = report_cache.get(version, params)
+    if body is not None:
+        return app.response_class(body, mimetype="application/json")
+    # the running totals kept by every mutation: no pass over the expenses
+    ledger = storage.ledger()
+    records = ledger["participants"]
+    if not records:
         return jsonify({"ok": False, "error": "no participants"}), 400
-
-    # Sum totals in Decimal, then convert to integer cents to avoid fractional-cent issues
-    totals = {p: Decimal('0.00') for p in participants}
-    total_all = Decimal('0.00')
-    for e in expenses:
-        amt = to_decimal(e.get("amount", 0))
-        totals[e["payer"]] += amt
-        total_all += amt
-
-    # Quantize total to cents and convert to integer cents
-    total_all = quant(total_all)
-    total_cents = int((total_all * Decimal('100')).to_integral_value(rounding=ROUND_HALF_UP))
-
-    # Build paid/share/balance in cents
-    paid_cents = {}
-    for p in participants:
-        p_total = quant(totals.get(p, Decimal('0.00')))
-        paid_cents[p] = int((p_total * Decimal('100')).to_integral_value(rounding=ROUND_HALF_UP))
-
-    # Compute each participant's share from each expense (integer-cent deterministic split)
-    share_cents = {p: 0 for p in participants}
-    for e in expenses:
-        amt = quant(to_decimal(e.get("amount", 0)))
-        amt_cents = int((amt * Decimal('100')).to_integral_value(rounding=ROUND_HALF_UP))
-        split = e.get("split") or participants
-        # ensure split members are valid and in deterministic order
-        split_members = [s for s in split if s in participants]
-        if not split_members:
-            split_members = participants[:]
-        k = len(split_members)
-        base = amt_cents // k
-        rem = amt_cents % k
-        ordered_split = sorted(split_members)
-        for idx, member in enumerate(ordered_split):
-            add = base + (1 if idx < rem else 0)
-            share_cents[member] += add
-
-    # compute balances in cents: positive means person is creditor (is owed money)
-    balances_cents = {p: paid_cents.get(p, 0) - share_cents.get(p, 0) for p in participants}
-
-    # Prepare creditors and debtors (amounts positive ints)
-    creditors = []
-    debtors = []
-    for p, bal in balances_cents.items():
-        if bal > 0:
-            creditors.append({"person": p, "amount": bal})
-        elif bal < 0:
-            debtors.append({"person": p, "amount": -bal})
-
-    # Prefer matching largest amounts first (reduce small cross-payments)
-    debtors.sort(key=lambda x: x["amount"], reverse=True)
-    # prioritize the person who paid the most: put them first among creditors if they're a creditor
-    # determine highest payer by paid_cents
-    top_payer = None
-    if paid_cents:
-        top_payer = max(paid_cents.items(), key=lambda kv: kv[1])[0]
-        if paid_cents.get(top_payer, 0) <= 0:
-            top_payer = None
-
-    # sort other creditors by amount desc, but place top_payer first if present
-    others = [c for c in creditors if c["person"] != top_payer]
-    others.sort(key=lambda x: x["amount"], reverse=True)
-    prioritized = []
-    if top_payer:
-        for c in creditors:
-            if c["person"] == top_payer:
-                prioritized.append(c)
-                break
-    prioritized.extend(others)
-    creditors = prioritized
-
-    payments = []
-    i = 0
-    j = 0
-    while i < len(debtors) and j < len(creditors):
-        d = debtors[i]
-        c = creditors[j]
-        take = min(d["amount"], c["amount"])  # in cents
-        payments.append({"from": d["person"], "to": c["person"], "amount": float(Decimal(take) / Decimal('100'))})
-        d["amount"] -= take
-        c["amount"] -= take
-        if d["amount"] == 0:
-            i += 1
-        if c["amount"] == 0:
-            j += 1
-
-    # Build summary (convert cents back to dollars)
-    total = float(Decimal(total_cents) / Decimal('100'))
-    per_head = float(Decimal(total_cents) / Decimal(n) / Decimal('100'))
-
-    summary = {}
-    for p in participants:
-        paid = float(Decimal(paid_cents.get(p, 0)) / Decimal('100'))
-        share = float(Decimal(share_cents.get(p, 0)) / Decimal('100'))
-        balance = float(Decimal(balances_cents.get(p, 0)) / Decimal('100'))
-        summary[p] = {"paid": paid, "share": share, "balance": balance}
-
-    return jsonify({"ok": True, "total": total, "per_head": per_head, "summary": summary, "payments": payments})
+    digits = precision(ledger["currency"])
+    total_cents = ledger["total"]
+    paid_cents, share_cents = by_name(records, ledger["paid"], ledger["share"])
+    if window:
+        # running sums by date from the ledger's sums by day, built once per dataset version
+        index = date_indexes.get(version, "dates")
+        if index is None:
+            index = DateIndex(ledger)
+            date_indexes.put(version, "dates", index)
+        paid, share, total_cents = index.totals(*window)
+        paid_cents, share_cents = by_name(records, paid, share)
+    participants = [p["name"] for p in records]
+    # the plan issued last, kept current by the mutations; it settles the whole ledger, not a window
+    names = {p["id"]: p["name"] for p in records}
+    plan = [] if window else [(names[f], names[t], cents) for f, t, cents in ledger.get("plan", [])
+                              if f in names and t in names]
+    try:
+        body = build_report(participants, paid_cents, share_cents, total_cents, digits,
+                            method=method, budget=budget_ms / 1000.0, plan=plan, constraints=constraints,
+                            margin=PLAN_MARGIN)
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    if window:
+        body["window"] = {"from": window[0] and window[0].isoformat(), "to": window[1] and window[1].isoformat()}
+    response = jsonify(body)
+    report_cache.put(version, params, response.get_data())
+    return response
+
+
+@app.route("/api/netting", methods=["GET"])
+def netting():
+    # one settlement over archived events in EVENTS_DIR: ?events=FILE (repeated), or every *.json there
+    try:
+        method, budget_ms, constraints = settlement_args(request.args)
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    names = request.args.getlist("events")
+    if not names:
+        names = sorted(n for n in os.listdir(EVENTS_DIR) if n.endswith(".json")) if os.path.isdir(EVENTS_DIR) else []
+    for name in names:
+        # file names only: nothing outside the events directory
+        if os.path.basename(name) != name or name.startswith(".") or not os.path.isfile(os.path.join(EVENTS_DIR, name)):
+            return jsonify({"ok": False, "error": "no such event: " + name}), 404
+    if not names:
+        return jsonify({"ok": False, "error": "no events"}), 400
+    try:
+        body = net_report([os.path.join(EVENTS_DIR, name) for name in names], event_balances, method,
+                          budget_ms / 1000.0, constraints=constraints)
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    return jsonify(body)
 
 
 if __name__ == "__main__":
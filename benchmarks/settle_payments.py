@@ -0,0 +1,38 @@
+"""Time the payment matchers on a very large group, and count the payments each plan needs.
+
+    python benchmarks/settle_payments.py [PARTICIPANTS]
+
+Balances are random amounts in cents that sum to zero; everyone with a
+positive balance paid that much.
+"""
+import pathlib
+import random
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from settlement import greedy_payments, heap_payments
+
+
+def make_balances(n, seed=1):
+    rng = random.Random(seed)
+    balances = {"Participant %d" % i: rng.randint(-100000, 100000) for i in range(n)}
+    balances["Participant 0"] -= sum(balances.values())
+    return balances, {p: max(b, 0) for p, b in balances.items()}
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 200000
+    balances, paid = make_balances(n)
+    print("%d participants" % n)
+    print("%-7s %9s %9s" % ("matcher", "time (s)", "payments"))
+    for name, fn in (("greedy", greedy_payments), ("heap", heap_payments)):
+        start = time.perf_counter()
+        payments = fn(balances, paid)
+        print("%-7s %9.3f %9d" % (name, time.perf_counter() - start, len(payments)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
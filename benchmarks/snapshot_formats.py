@@ -0,0 +1,72 @@
+"""Compare snapshot formats on a synthetic ledger.
+
+    python benchmarks/snapshot_formats.py [EXPENSES]
+
+Reports save time, load time and file size for every format in
+storage.snapshot.FORMATS.
+"""
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from storage import JsonStorage
+from storage.snapshot import FORMATS
+
+DESCRIPTIONS = ["Groceries", "Dinner", "Fuel", "Lodging", "Tickets", "Coffee", "Taxi", "Snacks"]
+
+
+def make_dataset(n_expenses, n_participants=12, seed=1):
+    rng = random.Random(seed)
+    names = ["Participant %d" % i for i in range(n_participants)]
+    expenses = []
+    for i in range(n_expenses):
+        split = names if rng.random() < 0.6 else sorted(rng.sample(names, rng.randint(1, n_participants)))
+        expenses.append({
+            "id": str(uuid4()),
+            "payer": rng.choice(names),
+            "amount": round(rng.uniform(1, 500), 2),
+            "description": rng.choice(DESCRIPTIONS) if rng.random() < 0.8 else "Receipt #%d" % i,
+            "date": "2025-%02d-%02d" % (rng.randint(1, 12), rng.randint(1, 28)),
+            "split": list(split),
+        })
+    return {"participants": names, "expenses": expenses, "event": "Benchmark", "currency": "CAD"}
+
+
+def best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 100000
+    data = make_dataset(n)
+    print("%d expenses, %d participants" % (n, len(data["participants"])))
+    print("%-8s %10s %10s %12s" % ("format", "save (s)", "load (s)", "size (bytes)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in FORMATS:
+            store = JsonStorage(os.path.join(tmp, "data." + name), snapshot_format=name)
+            save = best_of(lambda: store.save(data), 3)
+
+            def load():
+                store.cache.invalidate()
+                return store.load()
+
+            elapsed = best_of(load, 3)
+            assert load() == data
+            print("%-8s %10.3f %10.3f %12d" % (name, save, elapsed, os.path.getsize(store.path)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,10 @@
+from .anytime import anytime_payments
+from .flow import flow_payments
+from .incremental import adjust_payments
+from .matching import greedy_payments, heap_payments, top_payer
+from .money import from_cents, from_minor, precision, quant, to_cents, to_decimal, to_minor
+from .optimize import optimal_payments
+from .parallel import parallel_add_expenses
+from .report import METHODS, balances, build_report, settle
+from .totals import (SplitOrders, add_expenses, expense_totals, fold_expenses, split_key, split_members,
+                     split_shares)
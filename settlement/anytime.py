@@ -0,0 +1,82 @@
+# Fewer payments by local search, for as long as the caller can wait.
+#
+# The greedy payments form a forest: debtors pay creditors, and a group of
+# ``k`` people linked by payments uses ``k - 1`` of them. The search takes a
+# debtor and a creditor who don't pay each other but are linked by a chain of
+# payments, adds the direct payment, and moves money around the cycle that
+# closes (more on the new payment and every other link of the chain, less on
+# the rest) until a payment on it drops to zero. The payment count never
+# grows; when two payments drop to zero at once the chain is merged into one
+# fewer payment and the group splits in two. Every person pays and receives
+# what they did before.
+#
+# Pairs are picked at random from a generator seeded the same way every call,
+# so a run given as long as another makes the same moves.
+from random import Random
+from time import perf_counter
+
+from .matching import greedy_payments
+
+
+def _chain(links, start, end):
+    # the people on a chain of payments from ``start`` to ``end``, or None
+    previous = {start: None}
+    queue = [start]
+    for u in queue:
+        if u == end:
+            path = [end]
+            while path[-1] != start:
+                path.append(previous[path[-1]])
+            return path
+        for v in links[u]:
+            if v not in previous:
+                previous[v] = u
+                queue.append(v)
+    return None
+
+
+def anytime_payments(balances_cents, paid_cents, deadline, seed=0):
+    """(payments settling ``balances_cents``, search iterations), improving the greedy ones until ``deadline``.
+
+    ``deadline`` is a ``perf_counter()`` time. The search stops early at one
+    payment per debtor or per creditor, whichever are more: no plan has fewer.
+    """
+    plan = {}
+    links = {p: set() for p in balances_cents}
+    for f, t, cents in greedy_payments(balances_cents, paid_cents):
+        plan[f, t] = cents
+        links[f].add(t)
+        links[t].add(f)
+    debtors = [p for p, bal in balances_cents.items() if bal < 0]
+    creditors = [p for p, bal in balances_cents.items() if bal > 0]
+    # every debtor pays and every creditor receives at least once
+    floor = max(len(debtors), len(creditors))
+    rng = Random(seed)
+    iterations = 0
+    while len(plan) > floor and perf_counter() < deadline:
+        iterations += 1
+        d = rng.choice(debtors)
+        c = rng.choice(creditors)
+        if (d, c) in plan:
+            continue
+        path = _chain(links, d, c)
+        if path is None:
+            continue
+        # from c back to d: payments into a creditor lose, payments out of a debtor on to the next one gain
+        chain = [(path[i + 1], path[i]) if (path[i + 1], path[i]) in plan else (path[i], path[i + 1])
+                 for i in range(len(path) - 1)]
+        less = chain[0::2]
+        more = chain[1::2]
+        moved = min(plan[pair] for pair in less)
+        for pair in more:
+            plan[pair] += moved
+        plan[d, c] = moved
+        links[d].add(c)
+        links[c].add(d)
+        for f, t in less:
+            plan[f, t] -= moved
+            if not plan[f, t]:
+                del plan[f, t]
+                links[f].discard(t)
+                links[t].discard(f)
+    return [(f, t, cents) for (f, t), cents in plan.items()], iterations
@@ -0,0 +1,239 @@
+# Settling under constraints, as a min-cost flow.
+#
+# Balances become a network: a source supplies each debtor with what they
+# owe, each creditor drains what they are owed into a sink, and anyone may pay
+# anyone they are allowed to, any amount, at a cost of one per unit moved. The
+# cheapest flow that moves as much as it can settles every debt directly where
+# that is allowed and routes it through other people (who pass on what they
+# receive) where it isn't.
+#
+# The flow is found by successive shortest paths. Each round runs Dijkstra's
+# algorithm over reduced costs (cost plus the potential of the tail minus that
+# of the head, which stays non-negative) and moves the potentials by the
+# distances found; then as much as fits is pushed along the shortest paths,
+# the edges whose reduced cost is now zero, as a blocking flow. There is one
+# round per distinct path length, so usually one or two. Debtors and creditors
+# are tried largest first, as in ``greedy_payments``.
+#
+# A cap on how many payments someone receives is not a flow constraint. It is
+# met by repair, without solving again: while someone receives more payments
+# than their cap, their smallest payment that can move is sent instead to
+# another person whose payments already reach them, the nearest one with room
+# for another payment, and everyone on the way passes it on. The number of
+# payments never grows. When nobody can take a payment over, the repair gives up with
+# ``CapsNotMet``, which does not mean that no plan exists.
+from heapq import heappop, heappush
+
+
+class CapsNotMet(ValueError):
+    """The repair found no plan within the caps on payments received; one may still exist."""
+
+
+class _Network:
+    def __init__(self, size):
+        self.adj = [[] for _ in range(size)]
+        self.to = []
+        self.cap = []
+        self.cost = []
+
+    def add(self, u, v, cap, cost):
+        # edge e runs u -> v, e ^ 1 is its residual v -> u
+        self.adj[u].append(len(self.to))
+        self.adj[v].append(len(self.to) + 1)
+        self.to += (v, u)
+        self.cap += (cap, 0)
+        self.cost += (cost, -cost)
+
+    def add_from(self, u, heads, cap, cost):
+        """``add(u, v, cap, cost)`` for every ``v`` in ``heads``, in bulk."""
+        first = len(self.to)
+        for n, v in enumerate(heads):
+            self.adj[v].append(first + 2 * n + 1)
+        self.adj[u].extend(range(first, first + 2 * len(heads), 2))
+        pairs = [u] * (2 * len(heads))
+        pairs[::2] = heads
+        self.to += pairs
+        self.cap += (cap, 0) * len(heads)
+        self.cost += (cost, -cost) * len(heads)
+
+    def distances(self, s, pot):
+        adj, to, cap, cost = self.adj, self.to, self.cap, self.cost
+        dist = [None] * len(adj)
+        dist[s] = 0
+        heap = [(0, s)]
+        while heap:
+            d, u = heappop(heap)
+            if d > dist[u]:
+                continue
+            base = d + pot[u]
+            for e in adj[u]:
+                if cap[e]:
+                    v = to[e]
+                    nd = base + cost[e] - pot[v]
+                    if dist[v] is None or nd < dist[v]:
+                        dist[v] = nd
+                        heappush(heap, (nd, v))
+        return dist
+
+    def blocking_flow(self, s, t, pot):
+        """Push what fits along the edges of zero reduced cost; the amount pushed."""
+        adj, to, cap, cost = self.adj, self.to, self.cap, self.cost
+        # levels keep the search off cycles of zero reduced cost
+        level = [None] * len(adj)
+        level[s] = 0
+        queue = [s]
+        for u in queue:
+            for e in adj[u]:
+                v = to[e]
+                if cap[e] and level[v] is None and cost[e] + pot[u] - pot[v] == 0:
+                    level[v] = level[u] + 1
+                    queue.append(v)
+        if level[t] is None:
+            return 0
+        cursor = [0] * len(adj)
+        pushed = 0
+        while True:
+            path = []
+            u = s
+            while u != t:
+                edges = adj[u]
+                while cursor[u] < len(edges):
+                    e = edges[cursor[u]]
+                    v = to[e]
+                    if cap[e] and level[v] == level[u] + 1 and cost[e] + pot[u] - pot[v] == 0:
+                        break
+                    cursor[u] += 1
+                else:
+                    # a dead end: back up and skip the edge that led here
+                    if u == s:
+                        return pushed
+                    level[u] = None
+                    e = path.pop()
+                    u = to[e ^ 1]
+                    cursor[u] += 1
+                    continue
+                path.append(e)
+                u = v
+            amount = min(cap[e] for e in path)
+            for e in path:
+                cap[e] -= amount
+                cap[e ^ 1] += amount
+            pushed += amount
+
+    def min_cost_flow(self, s, t):
+        """Send as much as fits from ``s`` to ``t`` at the least cost; the amount sent."""
+        pot = [0] * len(self.adj)
+        sent = 0
+        while True:
+            dist = self.distances(s, pot)
+            if dist[t] is None:
+                return sent
+            for v, d in enumerate(dist):
+                pot[v] += dist[t] if d is None or d > dist[t] else d
+            sent += self.blocking_flow(s, t, pot)
+
+
+def _network(people, balances_cents, blocked):
+    # (network, source, sink, the edges between people)
+    n = len(people)
+    s, t = n, n + 1
+    net = _Network(n + 2)
+    debtors = sorted((i for i, p in enumerate(people) if balances_cents[p] < 0),
+                     key=lambda i: balances_cents[people[i]])
+    creditors = sorted((i for i, p in enumerate(people) if balances_cents[p] > 0),
+                       key=lambda i: -balances_cents[people[i]])
+    for i in debtors:
+        net.add(s, i, -balances_cents[people[i]], 0)
+    # creditors first in everyone's list, so direct payments are found before routes through others
+    heads = creditors + [i for i in range(n) if balances_cents[people[i]] <= 0]
+    unlimited = sum(-balances_cents[people[i]] for i in debtors)
+    pairs = []
+    for i in debtors + [i for i in range(n) if balances_cents[people[i]] >= 0]:
+        allowed = [j for j in heads if j != i and (people[i], people[j]) not in blocked]
+        pairs.extend(range(len(net.to), len(net.to) + 2 * len(allowed), 2))
+        net.add_from(i, allowed, unlimited, 1)
+    for j in creditors:
+        net.add(j, t, balances_cents[people[j]], 0)
+    return net, s, t, pairs
+
+
+def _repair(plan, max_incoming, blocked):
+    # brings everyone within their cap; ``plan`` maps (from, to) to an amount, in the order paid
+    into = {}
+    for f, t in plan:
+        into.setdefault(t, {})[f] = None
+
+    def room(p):
+        cap = max_incoming.get(p)
+        return cap is None or len(into.get(p, ())) < cap
+
+    def pay(f, t, cents):
+        # a payment the other way nets against this one
+        back = plan.get((t, f), 0)
+        if back > cents:
+            plan[t, f] = back - cents
+            return
+        if back:
+            del plan[t, f]
+            del into[f][t]
+        if back < cents:
+            if (f, t) not in plan:
+                into.setdefault(t, {})[f] = None
+            plan[f, t] = plan.get((f, t), 0) + cents - back
+
+    def route(b, j, cents):
+        # the nearest person whose payments reach j without passing b and who can take b's payment
+        nxt = {j: None}
+        queue = [j]
+        for u in queue:
+            for f in into.get(u, ()):
+                if f == b or f in nxt:
+                    continue
+                nxt[f] = u
+                queue.append(f)
+                if (b, f) not in blocked and ((b, f) in plan or plan.get((f, b), 0) >= cents or room(f)):
+                    path = [f]
+                    while path[-1] != j:
+                        path.append(nxt[path[-1]])
+                    return path
+        return None
+
+    for j, cap in max_incoming.items():
+        while len(into.get(j, ())) > cap:
+            for b in sorted(into[j], key=lambda f: plan[f, j]):
+                cents = plan[b, j]
+                path = route(b, j, cents)
+                if path is not None:
+                    break
+            else:
+                return False
+            del plan[b, j]
+            del into[j][b]
+            for u, v in zip(path, path[1:]):
+                plan[u, v] += cents
+            pay(b, path[0], cents)
+    return True
+
+
+def flow_payments(balances_cents, blocked=(), max_incoming=None):
+    """Payments settling ``balances_cents`` within the constraints, or None if there are none.
+
+    ``blocked`` holds (from, to) pairs that cannot pay; ``max_incoming`` maps
+    a person to the most payments they will receive. Someone who has left
+    (balances that don't sum to zero) leaves as much unsettled as greedy does.
+    ``CapsNotMet`` if the caps could not be met.
+    """
+    people = list(balances_cents)
+    max_incoming = max_incoming or {}
+    if any(balances_cents.get(p, 0) > 0 and not cap for p, cap in max_incoming.items()):
+        # owed money and can't be paid
+        return None
+    blocked = set(blocked)
+    settle = min(sum(b for b in balances_cents.values() if b > 0), -sum(b for b in balances_cents.values() if b < 0))
+    net, s, t, pairs = _network(people, balances_cents, blocked)
+    if net.min_cost_flow(s, t) < settle:
+        return None
+    plan = {(people[net.to[e ^ 1]], people[net.to[e]]): net.cap[e ^ 1] for e in pairs if net.cap[e ^ 1]}
+    if not _repair(plan, max_incoming, blocked):
+        raise CapsNotMet("no payments within the caps on payments received were found")
+    return [(f, to, cents) for (f, to), cents in plan.items()]
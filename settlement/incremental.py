@@ -0,0 +1,75 @@
+# Keeping an issued payment plan when the balances move.
+#
+# Once people have been told who pays whom, one more expense should not
+# reshuffle the whole list. ``adjust_payments`` takes the last plan and the
+# new balances and settles only the difference: transfers between people
+# whose balances moved the opposite ways are resized first, then what is left
+# is matched with ``greedy_payments`` and folded into the transfers already
+# there. Everyone else's transfers stay as they were.
+#
+# The adjustments can leave more transfers than a fresh plan would need. A
+# fresh plan never needs more than one payment fewer than the number of
+# people with a balance (see ``settlement.optimize``); past that by more than
+# ``margin`` the plan is replaced with fresh greedy payments.
+from .matching import greedy_payments
+
+MARGIN = 2
+
+
+def residuals(plan, balances_cents):
+    """What each balance still needs once ``plan`` is paid; positive means still owed."""
+    left = dict(balances_cents)
+    for f, t, cents in plan:
+        if f in left and t in left:
+            left[f] += cents
+            left[t] -= cents
+    return left
+
+
+def adjust_payments(plan, balances_cents, paid_cents, margin=MARGIN):
+    """Payments settling ``balances_cents`` that change as little of ``plan`` as they can.
+
+    Returns (payments, False if they are a fresh plan instead). ``plan`` is a
+    list of (from, to, cents). Transfers involving anyone not in
+    ``balances_cents`` are dropped; new ones go at the end, in the order
+    ``greedy_payments`` gives them.
+    """
+    kept = [[f, t, cents] for f, t, cents in plan
+            if f in balances_cents and t in balances_cents and f != t and cents > 0]
+    left = residuals(kept, balances_cents)
+    if any(left.values()):
+        for transfer in kept:
+            f, t, cents = transfer
+            # f pays more than it now owes and t receives more than it is owed: pay less
+            if left[f] > 0 and left[t] < 0:
+                take = min(cents, left[f], -left[t])
+                transfer[2] -= take
+                left[f] -= take
+                left[t] += take
+        for transfer in kept:
+            f, t, cents = transfer
+            # f still owes and t is still owed: pay more
+            if left[f] < 0 and left[t] > 0:
+                take = min(-left[f], left[t])
+                transfer[2] += take
+                left[f] += take
+                left[t] -= take
+        position = {(f, t): n for n, (f, t, _) in enumerate(kept)}
+        for f, t, cents in greedy_payments({p: bal for p, bal in left.items() if bal}, paid_cents):
+            if (f, t) in position:
+                kept[position[(f, t)]][2] += cents
+            elif (t, f) in position:
+                # nets against a transfer the other way, which may turn around
+                transfer = kept[position[(t, f)]]
+                transfer[2] -= cents
+                if transfer[2] < 0:
+                    transfer[:] = [f, t, -transfer[2]]
+                    position[(f, t)] = position.pop((t, f))
+            else:
+                position[(f, t)] = len(kept)
+                kept.append([f, t, cents])
+        kept = [transfer for transfer in kept if transfer[2]]
+    owing = sum(1 for bal in balances_cents.values() if bal)
+    if len(kept) > max(owing - 1, 0) + margin:
+        return greedy_payments(balances_cents, paid_cents), False
+    return [tuple(transfer) for transfer in kept], True
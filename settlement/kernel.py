@@ -0,0 +1,62 @@
+# Batched share arithmetic for whole-ledger scans.
+#
+# Sharing out expenses grouped by split (see ``totals._distribute``) needs,
+# per group, the sum of ``a // k`` over its amounts and how often each
+# remainder ``a % k`` came up. The scans collect every amount with its group
+# number first and hand the arrays here, so the arithmetic runs once over the
+# whole batch: with NumPy when it is installed, with plain loops otherwise.
+# Both paths give the same integers; NumPy is only used when every partial sum
+# fits in 64 bits.
+try:
+    import numpy
+except ImportError:  # optional: the loops below give the same results
+    numpy = None
+
+# below this many expenses converting to arrays costs more than it saves
+MIN_BATCH = 64
+_INT64 = 1 << 63
+
+
+def _fits(a):
+    # no int64 sum over ``a`` can overflow
+    return len(a) == 0 or max(-int(a.min()), int(a.max())) * len(a) < _INT64
+
+
+def _as_int64(values):
+    try:
+        a = numpy.asarray(values, dtype=numpy.int64)
+    except OverflowError:
+        return None
+    return a if _fits(a) else None
+
+
+def _use_numpy(values):
+    return numpy is not None and len(values) >= MIN_BATCH
+
+
+def group_sums(amounts, group_of, sizes):
+    """Per group ``g``: (sum of ``a // sizes[g]``, count of each remainder) over its amounts.
+
+    ``amounts[i]`` belongs to group ``group_of[i]``; every size is at least one.
+    """
+    if _use_numpy(amounts):
+        a = _as_int64(amounts)
+        if a is not None:
+            g = numpy.asarray(group_of, dtype=numpy.intp)
+            k = numpy.asarray(sizes, dtype=numpy.int64)
+            base, rem = numpy.divmod(a, k[g])
+            base_sums = numpy.zeros(len(sizes), dtype=numpy.int64)
+            numpy.add.at(base_sums, g, base)
+            # one histogram per group, laid end to end
+            offsets = numpy.zeros(len(sizes), dtype=numpy.int64)
+            numpy.cumsum(k[:-1], out=offsets[1:])
+            counts = numpy.bincount(offsets[g] + rem, minlength=int(k.sum())).tolist()
+            starts = offsets.tolist()
+            return [(int(base_sums[n]), counts[starts[n]:starts[n] + size]) for n, size in enumerate(sizes)]
+    base_sums = [0] * len(sizes)
+    remainders = [[0] * size for size in sizes]
+    for amount, n in zip(amounts, group_of):
+        base, rem = divmod(amount, sizes[n])
+        base_sums[n] += base
+        remainders[n][rem] += 1
+    return list(zip(base_sums, remainders))
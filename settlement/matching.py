@@ -0,0 +1,102 @@
+# Turning balances into a list of payments.
+#
+# Both matchers take ``balances_cents`` mapping person -> paid minus share
+# (positive means the person is owed money) and return a list of
+# (from, to, cents). Ties between equal amounts go to whoever comes first in
+# ``balances_cents``, and the person who paid the most, if owed money, is paid
+# first. Both run in O(n log n) and emit at most one payment fewer than the
+# number of people with a non-zero balance.
+#
+# ``greedy_payments`` is the default plan and the one to use for large groups.
+# ``heap_payments`` gives a different plan, usually with a few payments fewer,
+# at about three times the cost; it is not a faster way to the greedy plan.
+from heapq import heapify, heappop, heappush
+
+
+def top_payer(paid_cents):
+    """Whoever paid the most (the first of them on a tie), or None if nobody paid anything."""
+    top = None
+    most = 0
+    for p, units in paid_cents.items():
+        if units > most:
+            top = p
+            most = units
+    return top
+
+
+def greedy_payments(balances_cents, paid_cents):
+    """Match debtors to creditors, largest first, with the top payer paid first.
+
+    Debtors are taken in order of debt and each pays the creditors in order of
+    credit until their debt is cleared.
+    """
+    people = list(balances_cents)
+    left = [abs(bal) for bal in balances_cents.values()]
+    top = top_payer(paid_cents)
+    debtors = []
+    creditors = []
+    first = None
+    for i, bal in enumerate(balances_cents.values()):
+        if bal < 0:
+            debtors.append(i)
+        elif bal > 0:
+            if people[i] == top:
+                first = i
+            else:
+                creditors.append(i)
+    # sorts are stable, so equal amounts keep the order of balances_cents
+    debtors.sort(key=left.__getitem__, reverse=True)
+    creditors.sort(key=left.__getitem__, reverse=True)
+    if first is not None:
+        creditors.insert(0, first)
+
+    payments = []
+    i = 0
+    j = 0
+    while i < len(debtors) and j < len(creditors):
+        d = debtors[i]
+        c = creditors[j]
+        take = min(left[d], left[c])
+        payments.append((people[d], people[c], take))
+        left[d] -= take
+        left[c] -= take
+        if left[d] == 0:
+            i += 1
+        if left[c] == 0:
+            j += 1
+    return payments
+
+
+def heap_payments(balances_cents, paid_cents=None, top_payer_first=True):
+    """Repeatedly match the largest remaining debt with the largest remaining credit.
+
+    Unlike ``greedy_payments`` a partly settled debtor goes back in line, so
+    large balances are matched with each other before small ones and the
+    payments differ from the greedy ones even with ``top_payer_first``, which
+    keeps the top payer (see ``top_payer``) first among the creditors until
+    paid in full.
+    """
+    people = list(balances_cents)
+    top = top_payer(paid_cents) if top_payer_first and paid_cents else None
+    # (rank, -amount, position): the top payer ranks 0, everyone else 1; ties keep the input order
+    debtors = []
+    creditors = []
+    for i, bal in enumerate(balances_cents.values()):
+        if bal < 0:
+            debtors.append((bal, i))
+        elif bal > 0:
+            creditors.append((0 if people[i] == top else 1, -bal, i))
+    heapify(debtors)
+    heapify(creditors)
+
+    payments = []
+    while debtors and creditors:
+        debt, d = heappop(debtors)
+        rank, credit, c = heappop(creditors)
+        take = min(-debt, -credit)
+        payments.append((people[d], people[c], take))
+        if debt + take:
+            heappush(debtors, (debt + take, d))
+        if credit + take:
+            heappush(creditors, (rank, credit + take, c))
+    return payments
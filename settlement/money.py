@@ -0,0 +1,46 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+# digits after the decimal point in each currency's minor unit (ISO 4217);
+# anything not listed uses DEFAULT_PRECISION
+PRECISION = {
+    "BHD": 3, "IQD": 3, "JOD": 3, "KWD": 3, "LYD": 3, "OMR": 3, "TND": 3,
+    "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "ISK": 0, "JPY": 0, "KMF": 0, "KRW": 0,
+    "PYG": 0, "RWF": 0, "UGX": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+}
+DEFAULT_PRECISION = 2
+
+
+def precision(currency):
+    return PRECISION.get(str(currency or "").upper(), DEFAULT_PRECISION)
+
+
+def to_decimal(v):
+    return Decimal(str(v))
+
+
+def quant(v, digits=2):
+    return v.quantize(Decimal(1).scaleb(-digits), rounding=ROUND_HALF_UP)
+
+
+def to_minor(v, digits):
+    # quantize to the minor unit first, then convert to an integer count of minor units
+    return int(quant(v, digits).scaleb(digits).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def from_minor(minor, digits):
+    return float(Decimal(minor).scaleb(-digits))
+
+
+def rescale_minor(minor, old_digits, new_digits):
+    """Re-express an amount of minor units at another precision, rounding half up."""
+    if new_digits >= old_digits:
+        return minor * 10 ** (new_digits - old_digits)
+    return to_minor(Decimal(minor).scaleb(-old_digits), new_digits)
+
+
+def to_cents(v):
+    return to_minor(v, 2)
+
+
+def from_cents(cents):
+    return from_minor(cents, 2)
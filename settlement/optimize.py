@@ -0,0 +1,102 @@
+# Fewest-payment settlement for small groups.
+#
+# Settling a group of ``k`` people whose balances sum to zero never needs more
+# than ``k - 1`` payments, and the greedy matcher achieves that. So the fewest
+# payments overall come from splitting the balances into as many zero-sum
+# groups as possible and settling each group on its own. Finding that split
+# is exponential, so it is only attempted for up to ``MAX_EXACT`` balances,
+# within a time budget; past either limit the greedy payments are used.
+from time import perf_counter
+
+from .matching import greedy_payments
+
+MAX_EXACT = 20
+# how many subsets to visit between clock checks
+CHECK_EVERY = 1024
+
+
+def _opposite_pairs(people, balances_cents):
+    # a debt and a credit of the same size always make a group of their own in some best split
+    pairs = []
+    waiting = {}
+    for p in people:
+        match = waiting.get(-balances_cents[p])
+        if match:
+            pairs.append([match.pop(0), p])
+        else:
+            waiting.setdefault(balances_cents[p], []).append(p)
+    paired = {p for pair in pairs for p in pair}
+    return pairs, [p for p in people if p not in paired]
+
+
+def zero_sum_groups(amounts, deadline=None):
+    """Split ``amounts`` into the most zero-sum groups: lists of indexes.
+
+    Returns None when ``perf_counter()`` passes ``deadline`` first.
+    """
+    n = len(amounts)
+    full = (1 << n) - 1
+    sums = [0] * (full + 1)
+    # best[mask]: the most zero-sum groups the balances in ``mask`` split into, the last one possibly open
+    best = bytearray(full + 1)
+    for mask in range(1, full + 1):
+        if deadline is not None and mask % CHECK_EVERY == 1 and perf_counter() >= deadline:
+            return None
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + amounts[low.bit_length() - 1]
+        most = 0
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if best[mask ^ bit] > most:
+                most = best[mask ^ bit]
+            rest ^= bit
+        best[mask] = most + (sums[mask] == 0)
+    # walk back from the full set; the masks visited are prefixes of one order of the balances
+    order = []
+    mask = full
+    while mask:
+        want = best[mask] - (sums[mask] == 0)
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if best[mask ^ bit] == want:
+                break
+            rest ^= bit
+        order.append(bit.bit_length() - 1)
+        mask ^= bit
+    groups = []
+    group = []
+    running = 0
+    for i in reversed(order):
+        group.append(i)
+        running += amounts[i]
+        if running == 0:
+            groups.append(group)
+            group = []
+    if group:
+        # balances that don't sum to zero (someone who left had paid) leave one open group
+        groups.append(group)
+    return groups
+
+
+def optimal_payments(balances_cents, paid_cents, budget=None):
+    """The fewest payments that settle ``balances_cents``, or None past the limits.
+
+    ``budget`` is in seconds. Each zero-sum group is settled with
+    ``greedy_payments``, so ties break as they do there.
+    """
+    deadline = None if budget is None else perf_counter() + budget
+    people = [p for p, bal in balances_cents.items() if bal]
+    groups, rest = _opposite_pairs(people, balances_cents)
+    if len(rest) > MAX_EXACT:
+        return None
+    found = zero_sum_groups([balances_cents[p] for p in rest], deadline)
+    if found is None:
+        return None
+    groups.extend([rest[i] for i in g] for g in found)
+    payments = []
+    for group in groups:
+        payments.extend(greedy_payments({p: balances_cents[p] for p in group},
+                                        {p: paid_cents[p] for p in group if p in paid_cents}))
+    return payments
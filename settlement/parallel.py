@@ -0,0 +1,75 @@
+# Whole-ledger totals split across worker processes.
+#
+# Every expense's paid and share units depend on that expense alone, so a
+# long expense list can be cut into contiguous shards, each shard totalled in
+# its own process, and the partial totals added up. The shards are merged in
+# order, so the result, down to the key order of the dicts, is what a serial
+# ``add_expenses`` gives.
+#
+# Pickling a list of expense dicts over to the workers costs more than
+# totalling it, so the workers are forked after the list is put in a module
+# global and inherit it; only shard bounds go out and small per-participant
+# dicts come back. Where fork is not available, with one worker, or below
+# ``min_expenses`` (pool startup is not free) the scan stays serial. A fork
+# copies only the calling thread, so callers with other threads holding locks
+# should leave it serial; storage.ledger does unless told otherwise.
+import multiprocessing
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from .totals import add_expenses
+
+MIN_EXPENSES = 200000
+
+# what the forked workers read: (participants, expenses, rank)
+_job = None
+_job_lock = threading.Lock()
+
+
+def _shard(start, end):
+    participants, expenses, rank = _job
+    paid_cents = defaultdict(int)
+    share_cents = defaultdict(int)
+    total_cents = add_expenses(paid_cents, share_cents, participants, expenses[start:end], rank)
+    return dict(paid_cents), dict(share_cents), total_cents
+
+
+def _fork_context():
+    try:
+        return multiprocessing.get_context("fork")
+    except ValueError:
+        return None
+
+
+def parallel_add_expenses(paid_cents, share_cents, participants, expenses, rank=None, workers=None,
+                          min_expenses=MIN_EXPENSES):
+    """``add_expenses`` over shards of ``expenses`` in up to ``workers`` processes.
+
+    ``workers`` defaults to the number of CPUs. An unknown payer raises
+    KeyError from ``paid_cents`` as it does in ``add_expenses``, though only
+    once every shard is done.
+    """
+    global _job
+    workers = workers or os.cpu_count() or 1
+    context = _fork_context()
+    if context is None or workers < 2 or len(expenses) < max(min_expenses, 2):
+        return add_expenses(paid_cents, share_cents, participants, expenses, rank)
+    size = -(-len(expenses) // workers)
+    bounds = [(i, min(i + size, len(expenses))) for i in range(0, len(expenses), size)]
+    with _job_lock:
+        _job = (list(participants), expenses, rank)
+        try:
+            with ProcessPoolExecutor(max_workers=len(bounds), mp_context=context) as pool:
+                partials = list(pool.map(_shard, *zip(*bounds)))
+        finally:
+            _job = None
+    total_cents = 0
+    for paid, share, total in partials:
+        for p, units in paid.items():
+            paid_cents[p] += units
+        for p, units in share.items():
+            share_cents[p] += units
+        total_cents += total
+    return total_cents
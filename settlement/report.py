@@ -0,0 +1,98 @@
+from decimal import Decimal
+from time import perf_counter
+
+from .anytime import anytime_payments
+from .flow import flow_payments
+from .incremental import MARGIN, adjust_payments
+from .matching import greedy_payments, heap_payments
+from .money import from_minor
+from .optimize import optimal_payments
+
+# how payments are chosen: "greedy" lets the largest debtors pay the largest
+# creditors in turn; "heap" always matches the largest remaining debt and
+# credit, a different plan that is slower on large groups (see settlement.matching);
+# "optimal" finds the fewest payments, falling back to greedy past its
+# limits; "incremental" adjusts the plan issued last (see settlement.incremental);
+# "flow" keeps to blocked pairs and caps on payments received (see settlement.flow);
+# "anytime" improves the greedy payments until its budget runs out (see settlement.anytime)
+METHODS = ("greedy", "heap", "optimal", "incremental", "flow", "anytime")
+
+
+def balances(participants, paid_cents, share_cents):
+    # positive means person is creditor (is owed money)
+    return {p: paid_cents.get(p, 0) - share_cents.get(p, 0) for p in participants}
+
+
+def settle(balances_cents, paid_cents, method="greedy", budget=None, plan=(), constraints=None, margin=MARGIN):
+    """(payments, {"method": the method that produced them, "ms": milliseconds taken}).
+
+    ``budget`` is in seconds, for "optimal" and "anytime" (which also reports
+    its "iterations"); ``plan`` is the issued plan "incremental" adjusts,
+    with the ``margin`` it is kept under (see ``adjust_payments``);
+    ``constraints`` are the ``flow_payments`` keyword arguments for "flow".
+    ValueError if the constraints name someone else or no payments meet them.
+    """
+    if method not in METHODS:
+        raise ValueError("unknown settlement method %r" % (method,))
+    start = perf_counter()
+    payments = None
+    extra = {}
+    if method == "optimal":
+        payments = optimal_payments(balances_cents, paid_cents, budget)
+    elif method == "heap":
+        payments = heap_payments(balances_cents, paid_cents)
+    elif method == "incremental":
+        payments, kept = adjust_payments(plan, balances_cents, paid_cents, margin)
+        if not kept:
+            method = "greedy"
+    elif method == "flow":
+        constraints = constraints or {}
+        named = {p for pair in constraints.get("blocked", ()) for p in pair} | set(constraints.get("max_incoming", ()))
+        unknown = sorted(named - set(balances_cents))
+        if unknown:
+            raise ValueError("not in participants: " + ", ".join(unknown))
+        payments = flow_payments(balances_cents, **constraints)
+        if payments is None:
+            raise ValueError("no payments settle the balances within the constraints")
+    elif method == "anytime":
+        payments, extra["iterations"] = anytime_payments(balances_cents, paid_cents, start + (budget or 0))
+    if payments is None:
+        method = "greedy"
+        payments = greedy_payments(balances_cents, paid_cents)
+    return payments, dict({"method": method, "ms": round((perf_counter() - start) * 1000, 3)}, **extra)
+
+
+def build_report(participants, paid_cents, share_cents, total_cents, digits=2, payments=None,
+                 method="greedy", budget=None, plan=(), constraints=None, margin=MARGIN):
+    """The /api/report body: totals, per-person summary and payments, in currency units.
+
+    Amounts come in as integer minor units with ``digits`` decimal places.
+    Payments are chosen by ``method`` (see ``settle``) unless given; ``plan``
+    is the issued plan and ``constraints`` the ones for "flow", by participant,
+    and ``margin`` the one the plan is maintained with.
+    """
+    balances_cents = balances(participants, paid_cents, share_cents)
+    settlement = None
+    if payments is None:
+        payments, settlement = settle(balances_cents, paid_cents, method, budget, plan, constraints, margin)
+    n = len(participants)
+
+    # Build summary (convert minor units back to currency units)
+    total = from_minor(total_cents, digits)
+    per_head = float((Decimal(total_cents) / Decimal(n)).scaleb(-digits))
+
+    summary = {}
+    for p in participants:
+        paid = from_minor(paid_cents.get(p, 0), digits)
+        share = from_minor(share_cents.get(p, 0), digits)
+        balance = from_minor(balances_cents.get(p, 0), digits)
+        summary[p] = {"paid": paid, "share": share, "balance": balance}
+
+    return {
+        "ok": True,
+        "total": total,
+        "per_head": per_head,
+        "summary": summary,
+        "payments": [{"from": f, "to": t, "amount": from_minor(c, digits)} for f, t, c in payments],
+        "settlement": settlement,
+    }
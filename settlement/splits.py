@@ -0,0 +1,53 @@
+# Compact split encoding.
+#
+# A split lists the participant ids an expense is shared among. In a large
+# group most expenses are shared by everyone, and spelling out every id on
+# every expense dominates the stored file, so a split may instead be stored as
+# a bitset over participant ids: ``{"bits": "<hex>"}``, bit ``i`` set when id
+# ``i`` shares the expense. ``compact`` picks whichever form is shorter; it
+# only encodes lists of distinct ids in ascending order, which the bitset
+# gives back exactly.
+
+BITS = "bits"
+# '{"bits": ""}' around the digits, against at least ", " between list items
+BITS_OVERHEAD = 12
+
+
+def is_id(v):
+    return isinstance(v, int) and not isinstance(v, bool) and v > 0
+
+
+def mask_ids(mask):
+    """The bit positions set in ``mask``, ascending."""
+    ids = []
+    while mask:
+        low = mask & -mask
+        ids.append(low.bit_length() - 1)
+        mask ^= low
+    return ids
+
+
+def members(split):
+    """The ids in ``split``, whichever form it is stored in; other values pass through."""
+    if isinstance(split, dict):
+        return mask_ids(int(split.get(BITS) or "0", 16))
+    return split
+
+
+def compact(split):
+    """``split`` in its stored form: a bitset when that is shorter, else unchanged."""
+    if not isinstance(split, list):
+        return split
+    mask = 0
+    prev = 0
+    width = 0
+    for s in split:
+        if not is_id(s) or s <= prev:
+            return split
+        prev = s
+        mask |= 1 << s
+        width += len(str(s)) + 2
+    digits = format(mask, "x")
+    if len(digits) + BITS_OVERHEAD >= width:
+        return split
+    return {BITS: digits}
@@ -0,0 +1,157 @@
+# Per-participant paid and share totals, in integer minor units of the currency.
+#
+# Participants are whatever keys the expenses use for payer and split (the
+# storage layer uses participant ids). Remainder units of an uneven split go
+# to members in ``rank`` order; callers pass each key's position in the
+# name-sorted participant list so the extra units land where they always did.
+from .kernel import group_sums
+from .splits import BITS, members
+
+
+def _ranked(keys, rank):
+    return sorted(keys) if rank is None else sorted(keys, key=rank.__getitem__)
+
+
+def _distribute(share_cents, ordered, base, remainders):
+    """Hand out the shares of every expense with one split, given their tallies.
+
+    An expense of ``a`` units over ``k`` members gives each ``a // k`` and one
+    more unit to the first ``a % k`` members, so it is enough to sum the
+    quotients (``base``) and count how often each remainder came up. A report
+    over thousands of "everyone" expenses then touches each member once instead
+    of once per expense, with exactly the per-expense result.
+    """
+    # the member at position idx gets an extra unit from every expense whose remainder exceeds idx
+    extra = 0
+    for idx in range(len(ordered) - 1, -1, -1):
+        share_cents[ordered[idx]] += base + extra
+        extra += remainders[idx]
+
+
+def _share_groups(share_cents, groups, amounts, group_of):
+    # groups: the ordered members of each split; the tallies are computed in one batch
+    for ordered, (base, remainders) in zip(groups, group_sums(amounts, group_of, [len(g) for g in groups])):
+        _distribute(share_cents, ordered, base, remainders)
+
+
+def split_members(split, current, everyone, rank=None):
+    """The members an expense with ``split`` is shared among, in remainder order.
+
+    Splits may be id lists or compact bitsets (see ``settlement.splits``);
+    members not in ``current`` are dropped, and nobody left means ``everyone``.
+    """
+    split_members = [s for s in members(split) or () if s in current]
+    return _ranked(split_members, rank) if split_members else everyone
+
+
+def split_shares(amount, ordered):
+    """(member, units) for each member of ``ordered`` sharing ``amount``."""
+    base, rem = divmod(amount, len(ordered))
+    return [(member, base + (1 if idx < rem else 0)) for idx, member in enumerate(ordered)]
+
+
+def split_key(split):
+    """A hashable key equal for equal splits in the same stored form."""
+    return split.get(BITS) if isinstance(split, dict) else tuple(split or ())
+
+
+class SplitOrders:
+    """The splits used among one set of participants, each resolved once.
+
+    ``order(split)`` is what ``split_members`` gives, as a tuple shared by
+    every expense with the same split, so a repeated split costs a dict lookup
+    instead of a filter and a sort. ``shares(amount, split)`` keeps the
+    (member, units) vector of each amount and split the same way. Both memos
+    are dropped when they reach ``MEMO_SIZE`` entries.
+    """
+
+    MEMO_SIZE = 4096
+
+    def __init__(self, participants, rank=None):
+        self.current = frozenset(participants)
+        self.rank = rank
+        self.everyone = tuple(_ranked(participants, rank))
+        self._orders = {}
+        self._shares = {}
+
+    def order(self, split, key=None):
+        if key is None:
+            key = split_key(split)
+        ordered = self._orders.get(key)
+        if ordered is None:
+            if len(self._orders) >= self.MEMO_SIZE:
+                self._orders.clear()
+            ordered = self._orders[key] = tuple(split_members(split, self.current, self.everyone, self.rank))
+        return ordered
+
+    def shares(self, amount, split):
+        key = split_key(split)
+        vector = self._shares.get((amount, key))
+        if vector is None:
+            if len(self._shares) >= self.MEMO_SIZE:
+                self._shares.clear()
+            vector = self._shares[amount, key] = tuple(split_shares(amount, self.order(split, key)))
+        return vector
+
+
+def add_expenses(paid_cents, share_cents, participants, expenses, rank=None):
+    """Add the expenses' paid and share units into the two dicts; returns their total.
+
+    Expenses with the same split are shared out together. ``paid_cents`` must
+    accept every payer (a plain dict raises KeyError for an unknown one).
+    """
+    orders = SplitOrders(participants, rank)
+    index = {}
+    groups = []
+    amounts = []
+    group_of = []
+    total_cents = 0
+    for e in expenses:
+        amt_cents = e.get("amount_minor", 0)
+        paid_cents[e["payer"]] += amt_cents
+        total_cents += amt_cents
+        split = e.get("split")
+        key = split_key(split)
+        n = index.get(key)
+        if n is None:
+            n = index[key] = len(groups)
+            groups.append(orders.order(split, key))
+        amounts.append(amt_cents)
+        group_of.append(n)
+    _share_groups(share_cents, groups, amounts, group_of)
+    return total_cents
+
+
+def fold_expenses(paid_cents, share_cents, participants, expenses, rank=None):
+    """``add_expenses`` for an iterator of expenses, in memory that grows only with the distinct splits.
+
+    Each expense is tallied into its split's quotient sum and remainder counts
+    as it comes, instead of being collected for one batch.
+    """
+    orders = SplitOrders(participants, rank)
+    tallies = {}
+    total_cents = 0
+    for e in expenses:
+        amt_cents = e.get("amount_minor", 0)
+        paid_cents[e["payer"]] += amt_cents
+        total_cents += amt_cents
+        split = e.get("split")
+        key = split_key(split)
+        tally = tallies.get(key)
+        if tally is None:
+            ordered = orders.order(split, key)
+            tally = tallies[key] = [ordered, 0, [0] * len(ordered)]
+        base, rem = divmod(amt_cents, len(tally[0]))
+        tally[1] += base
+        tally[2][rem] += 1
+    for ordered, base, remainders in tallies.values():
+        _distribute(share_cents, ordered, base, remainders)
+    return total_cents
+
+
+def expense_totals(participants, expenses, rank=None):
+    """Scan a list of expense dicts; returns (paid, share, total) in minor units."""
+    paid_cents = {p: 0 for p in participants}
+    share_cents = {p: 0 for p in participants}
+    total_cents = add_expenses(paid_cents, share_cents, participants, expenses, rank)
+    return paid_cents, share_cents, total_cents
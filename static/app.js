@@ -214,7 +214,12 @@ el ('saveParticipants').addEventListener ('click', async () => {
 if (el ('currencySelect')) {
   el ('currencySelect').addEventListener ('change', async () => {
     const c = el ('currencySelect').value || 'USD';
-    await saveSettings ({currency: c});
+    const res = await saveSettings ({currency: c});
+    if (!res || res.ok === false) {
+      showToast ((res && res.error) || 'Save failed', 'error');
+      // put the dropdown back on the currency the server kept
+      await refreshData ();
+    }
   });
 }
 
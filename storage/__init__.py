@@ -0,0 +1,50 @@
+import os
+
+from .base import Storage, empty_data, normalize
+from .group_commit import GroupCommit
+from .journal import JournalStorage
+from .json_store import JsonStorage
+from .sectioned import SectionedStorage
+from .sqlite_store import SqliteStorage, import_json
+
+ENGINES = {
+    "json": JsonStorage,
+    "journal": JournalStorage,
+    "sectioned": SectionedStorage,
+    "sqlite": SqliteStorage,
+}
+
+# engines that keep a whole-dataset snapshot file and accept a snapshot format
+SNAPSHOT_ENGINES = ("json", "journal")
+
+# default file suffix when the path is derived from the JSON data file
+SUFFIXES = {
+    "sectioned": ".sections",
+    "sqlite": ".db",
+}
+FORMAT_SUFFIXES = {
+    "binary": ".bin",
+}
+
+
+def storage_path(engine, data_file, snapshot_format="json"):
+    if engine in SNAPSHOT_ENGINES:
+        suffix = FORMAT_SUFFIXES.get(snapshot_format)
+    else:
+        suffix = SUFFIXES.get(engine)
+    if suffix is None:
+        return data_file
+    root, ext = os.path.splitext(data_file)
+    if ext == ".json":
+        return root + suffix
+    return data_file
+
+
+def open_storage(engine, path, snapshot_format="json"):
+    try:
+        cls = ENGINES[engine]
+    except KeyError:
+        raise ValueError("unknown storage engine %r (expected one of: %s)" % (engine, ", ".join(sorted(ENGINES))))
+    if engine in SNAPSHOT_ENGINES:
+        return cls(path, snapshot_format=snapshot_format)
+    return cls(path)
@@ -0,0 +1,55 @@
+# Expense amounts are stored as an integer count of the currency's minor unit
+# (``amount_minor``: cents for CAD, yen for JPY, fils for KWD), see
+# ``settlement.money.PRECISION``. Datasets written before that carried a float
+# ``amount`` in major units; they are upgraded when loaded.
+from settlement.money import precision, rescale_minor, to_decimal, to_minor
+
+
+def upgrade_expense(e, digits):
+    """``e`` with its legacy float ``amount`` replaced by ``amount_minor``; ``e`` itself if current."""
+    if "amount_minor" in e:
+        return e
+    e = dict(e)
+    try:
+        e["amount_minor"] = to_minor(to_decimal(e.get("amount", 0)), digits)
+    except Exception:
+        # not a number: keep what was there for inspection, count it as zero
+        e["amount_minor"] = 0
+    else:
+        e.pop("amount", None)
+    return e
+
+
+def upgrade_expenses(expenses, currency):
+    """``expenses`` with every legacy record upgraded; the same list when there are none."""
+    digits = precision(currency)
+    upgraded = None
+    for n, e in enumerate(expenses):
+        if "amount_minor" not in e:
+            if upgraded is None:
+                upgraded = list(expenses)
+            upgraded[n] = upgrade_expense(e, digits)
+    return expenses if upgraded is None else upgraded
+
+
+def rounding_error(count, currency):
+    """The ValueError refusing a change to ``currency`` that would round ``count`` stored amounts."""
+    return ValueError("%s has %d decimal places: %d expense amount(s) would be rounded"
+                      % (currency, precision(currency), count))
+
+
+def rescale_expenses(expenses, old_currency, new_currency):
+    """Expenses re-expressed in the minor unit of ``new_currency``; the same list if it matches.
+
+    Amounts are never rounded: ValueError (``rounding_error``) if one has
+    more digits than ``new_currency`` keeps.
+    """
+    old, new = precision(old_currency), precision(new_currency)
+    if old == new:
+        return expenses
+    if new < old:
+        step = 10 ** (old - new)
+        rounded = sum(1 for e in expenses if type(e.get("amount_minor")) is int and e["amount_minor"] % step)
+        if rounded:
+            raise rounding_error(rounded, new_currency)
+    return [dict(e, amount_minor=rescale_minor(e.get("amount_minor", 0), old, new)) for e in expenses]
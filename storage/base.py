@@ -0,0 +1,121 @@
+import threading
+
+from . import ledger, mutations
+from .amounts import upgrade_expenses
+from .participants import active_names, names_by_id, upgrade_participants
+from .index import ExpenseIndex
+
+
+def empty_data():
+    return {"participants": [], "former_participants": [], "expenses": [], "event": '', "currency": 'CAD',
+            "ledger": {"total": 0, "expenses": 0, "rows": [], "plan": []}}
+
+
+def normalize(d):
+    # ensure shape
+    if 'participants' not in d:
+        d['participants'] = []
+    if 'expenses' not in d:
+        d['expenses'] = []
+    if 'event' not in d:
+        d['event'] = ''
+    if 'currency' not in d:
+        d['currency'] = 'CAD'
+    # float amounts written before minor units
+    d['expenses'] = upgrade_expenses(d['expenses'], d['currency'])
+    # participants referred to by name before ids
+    upgrade_participants(d)
+    # running totals: missing in older files, or miscounted after a hand edit
+    d['ledger'] = ledger.current(d)
+    return d
+
+
+class Storage:
+    """Common interface of the storage engines.
+
+    Subclasses must implement ``load`` and ``save``. The remaining methods have
+    whole-dataset fallbacks that engines override when they can touch less.
+    Datasets returned by ``load`` may be shared and must be treated as read-only.
+
+    ``index`` maps expense ids to positions in the latest loaded dataset and is
+    carried from one mutation to the next; ``index_lock`` serialises its use.
+    ``revision`` counts the saves made through this object.
+    """
+
+    def __init__(self):
+        self.index = ExpenseIndex()
+        self.index_lock = threading.Lock()
+        self.revision = 0
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, data):
+        raise NotImplementedError
+
+    def commit(self, op):
+        result = self.commit_batch([op])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def commit_batch(self, ops):
+        """Apply several mutation records with a single save.
+
+        Returns one result per record; a record that raised gets its exception
+        in place of a result and leaves the dataset as it was before it.
+        """
+        # shallow copy: apply() replaces what it changes, leaving the loaded dataset intact
+        data = dict(self.load())
+        results = []
+        with self.index_lock:
+            for op in ops:
+                before = dict(data)
+                try:
+                    results.append(mutations.apply(data, op, self.index))
+                except Exception as exc:
+                    data = before
+                    results.append(exc)
+        self.save(data)
+        return results
+
+    def participants(self):
+        """Names of the current participants, in order."""
+        return active_names(self.load())
+
+    def participant_names(self):
+        """id -> name for every participant id an expense may refer to."""
+        return names_by_id(self.load())
+
+    def ledger(self):
+        """Running totals for the report, see ``storage.ledger.view``."""
+        return ledger.view(self.load())
+
+    def settings(self):
+        data = self.load()
+        return {"event": data.get("event", ""), "currency": data.get("currency", "CAD")}
+
+    def get_expense(self, eid):
+        expenses = self.load().get("expenses", [])
+        with self.index_lock:
+            if self.index.sync(expenses):
+                idx = self.index.find(expenses, eid)
+                return None if idx is None else expenses[idx]
+        for e in expenses:
+            if e.get("id") == eid:
+                return e
+        return None
+
+    def version(self):
+        """A cheap value that changes whenever the dataset does, for keying caches; None if there is none.
+
+        Engines combine ``revision``, bumped once a save is in place, with
+        something other processes' saves change, such as a file's identity.
+        """
+        return None
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
@@ -0,0 +1,283 @@
+# Compact binary snapshot format (stdlib only).
+#
+# Layout, all integers little-endian:
+#
+#   magic "GXTB" | HEADER
+#   string table   nstrings u32 lengths (in characters) + one UTF-8 blob
+#   participants   nparts (u32 id, u32 name string index) pairs
+#   split patterns per pattern: u32 member count + u32 participant ids
+#   expenses       nexpenses RECORD structs
+#   extras         JSON blob for anything the fixed layout can't hold
+#
+# Every name, description and date is stored once in the string table and
+# referenced by index (index 0 stands for None). Payers are participant ids (0
+# stands for None). Identical split lists are stored once as a pattern and
+# decoded into one shared list; a split stored as a bitset (see
+# ``settlement.splits``) is stored as the pattern of its ids and flagged. UUID
+# expense ids are packed into 16 raw bytes.
+import json
+import struct
+import sys
+from array import array
+
+from settlement.splits import BITS, compact, members
+
+from .base import normalize
+
+MAGIC = b"GXTB"
+VERSION = 1
+
+# version, nstrings, blob bytes, nparts, npatterns, pattern words, nexpenses, extras bytes, event, currency
+HEADER = struct.Struct("<HIIIIIIIII")
+# id, flags, payer, amount in minor units, description, date, split pattern
+RECORD = struct.Struct("<16sBIqIII")
+
+UUID_ID = 1
+NO_SPLIT = 2
+BITS_SPLIT = 4
+
+KNOWN_KEYS = ("participants", "expenses", "event", "currency")
+U32 = 1 << 32
+EXPENSE_KEYS = ("id", "payer", "amount_minor", "description", "date", "split")
+
+
+def _u32(values):
+    a = array("I", values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+
+def _read_u32(buf, pos, count):
+    a = array("I")
+    a.frombytes(buf[pos:pos + 4 * count])
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a, pos + 4 * count
+
+
+def _is_str(v):
+    return v is None or isinstance(v, str)
+
+
+def _is_id(v):
+    return isinstance(v, int) and not isinstance(v, bool) and 0 < v < U32
+
+
+def _payer(v):
+    return v or None
+
+
+def _pack_id(eid, intern):
+    # canonical lowercase UUIDs (what uuid4() produces) pack into 16 bytes
+    if (isinstance(eid, str) and len(eid) == 36
+            and eid[8] == eid[13] == eid[18] == eid[23] == "-"):
+        h = eid.replace("-", "")
+        if len(h) == 32 and (h.islower() or h.isdigit()):
+            try:
+                return bytes.fromhex(h), UUID_ID
+            except ValueError:
+                pass
+    return struct.pack("<I12x", intern(eid)), 0
+
+
+def _unpack_id(raw, flags, strings):
+    if flags & UUID_ID:
+        h = raw.hex()
+        return "%s-%s-%s-%s-%s" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+    return strings[struct.unpack_from("<I", raw)[0]]
+
+
+def encode(data):
+    table = {}
+    strings = []
+
+    def intern(s):
+        if s is None:
+            return 0
+        idx = table.get(s)
+        if idx is None:
+            idx = table[s] = len(strings) + 1
+            strings.append(s)
+        return idx
+
+    # participant ids and minor units, whatever shape the caller's dataset is in
+    data = normalize(dict(data))
+    extras = {k: v for k, v in data.items() if k not in KNOWN_KEYS}
+    participants = data["participants"]
+    if not all(_is_id(p.get("id")) and isinstance(p.get("name"), str) and len(p) == 2 for p in participants):
+        extras["participants"] = participants
+        participants = []
+    event = data.get("event", "")
+    currency = data.get("currency", "CAD")
+    event_idx = intern(event if isinstance(event, str) else str(event))
+    currency_idx = intern(currency if isinstance(currency, str) else str(currency))
+    part_words = []
+    for p in participants:
+        part_words.append(p["id"])
+        part_words.append(intern(p["name"]))
+
+    patterns = {}
+    pattern_words = []
+    bit_patterns = {}
+
+    def pattern_of(key):
+        pattern = patterns.get(key)
+        if pattern is None:
+            pattern = patterns[key] = len(patterns)
+            pattern_words.append(len(key))
+            pattern_words.extend(key)
+        return pattern
+
+    records = []
+    expense_extras = {}
+    for n, e in enumerate(data["expenses"]):
+        # fields that don't fit the fixed layout travel in the extras blob
+        extra = {k: v for k, v in e.items() if k not in EXPENSE_KEYS}
+        flags = 0
+        eid = e.get("id")
+        if not _is_str(eid):
+            extra["id"] = eid
+            eid = None
+        rid, id_flag = _pack_id(eid, intern)
+        flags |= id_flag
+        payer = e.get("payer")
+        if payer is None:
+            payer = 0
+        elif not _is_id(payer):
+            extra["payer"] = payer
+            payer = 0
+        amount = e.get("amount_minor")
+        if isinstance(amount, bool) or not isinstance(amount, int) or not -1 << 63 <= amount < 1 << 63:
+            extra["amount_minor"] = amount
+            amount = 0
+        description = e.get("description")
+        if not _is_str(description):
+            extra["description"] = description
+            description = None
+        date = e.get("date")
+        if not _is_str(date):
+            extra["date"] = date
+            date = None
+        split = e.get("split")
+        pattern = 0
+        if split is None:
+            flags |= NO_SPLIT
+        elif isinstance(split, dict):
+            digits = split.get(BITS)
+            pattern = bit_patterns.get(digits) if isinstance(digits, str) and len(split) == 1 else None
+            if pattern is None:
+                try:
+                    key = tuple(members(split))
+                except (TypeError, ValueError):
+                    key = None
+                # only a bitset that decodes back to the same value
+                if key is not None and all(_is_id(s) for s in key) and compact(list(key)) == split:
+                    pattern = bit_patterns[digits] = pattern_of(key)
+            if pattern is None:
+                extra["split"] = split
+                flags |= NO_SPLIT
+                pattern = 0
+            else:
+                flags |= BITS_SPLIT
+        else:
+            try:
+                key = tuple(split) if isinstance(split, list) else None
+                pattern = patterns.get(key)
+            except TypeError:
+                key = None
+            if key is not None and pattern is None:
+                if all(_is_id(s) for s in key):
+                    pattern = pattern_of(key)
+                else:
+                    key = None
+            if key is None:
+                extra["split"] = split
+                flags |= NO_SPLIT
+                pattern = 0
+        if extra:
+            expense_extras[str(n)] = extra
+        records.append(RECORD.pack(
+            rid, flags, payer, amount, intern(description), intern(date), pattern))
+
+    if expense_extras:
+        extras["__expenses__"] = expense_extras
+    extras_raw = json.dumps(extras, separators=(",", ":")).encode() if extras else b""
+    blob = "".join(strings).encode("utf-8")
+    header = HEADER.pack(
+        VERSION, len(strings), len(blob), len(participants), len(patterns), len(pattern_words),
+        len(records), len(extras_raw), event_idx, currency_idx)
+    return b"".join([
+        MAGIC, header,
+        _u32(len(s) for s in strings), blob,
+        _u32(part_words),
+        _u32(pattern_words),
+        b"".join(records),
+        extras_raw,
+    ])
+
+
+def decode(raw):
+    if raw[:4] != MAGIC:
+        raise ValueError("not a binary snapshot")
+    buf = memoryview(raw)
+    (version, nstrings, blob_len, nparts, npatterns, nwords,
+     nexpenses, extras_len, event_idx, currency_idx) = HEADER.unpack_from(buf, 4)
+    if version != VERSION:
+        raise ValueError("unsupported binary snapshot version %d" % version)
+    pos = 4 + HEADER.size
+
+    lengths, pos = _read_u32(buf, pos, nstrings)
+    text = str(buf[pos:pos + blob_len], "utf-8")
+    pos += blob_len
+    strings = [None]
+    o = 0
+    for n in lengths:
+        strings.append(text[o:o + n])
+        o += n
+
+    part_words, pos = _read_u32(buf, pos, 2 * nparts)
+    participants = [{"id": part_words[i], "name": strings[part_words[i + 1]]} for i in range(0, len(part_words), 2)]
+
+    words, pos = _read_u32(buf, pos, nwords)
+    splits = []
+    w = 0
+    for _ in range(npatterns):
+        n = words[w]
+        splits.append(list(words[w + 1:w + 1 + n]))
+        w += 1 + n
+    bit_splits = {}
+
+    def bits_split(pattern):
+        split = bit_splits.get(pattern)
+        if split is None:
+            split = bit_splits[pattern] = compact(splits[pattern])
+        return split
+
+    end = pos + RECORD.size * nexpenses
+    expenses = [
+        {
+            "id": _unpack_id(rid, flags, strings),
+            "payer": _payer(payer),
+            "amount_minor": amount,
+            "description": strings[desc],
+            "date": strings[date],
+            "split": (None if flags & NO_SPLIT
+                      else bits_split(pattern) if flags & BITS_SPLIT else splits[pattern]),
+        }
+        for rid, flags, payer, amount, desc, date, pattern in RECORD.iter_unpack(buf[pos:end])
+    ]
+    pos = end
+
+    data = {
+        "participants": participants,
+        "expenses": expenses,
+        "event": strings[event_idx],
+        "currency": strings[currency_idx],
+    }
+    if extras_len:
+        extras = json.loads(bytes(buf[pos:pos + extras_len]))
+        for n, extra in extras.pop("__expenses__", {}).items():
+            expenses[int(n)].update(extra)
+        data.update(extras)
+    return data
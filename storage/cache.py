@@ -0,0 +1,96 @@
+import threading
+
+
+def file_id(st):
+    # cheap identity of a file's current contents: a rewrite or rename changes at least one
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class Lookups:
+    """Hit and miss counts of a cache, for /api/stats; the cache's own lock guards them."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class ResultCache:
+    """Results computed from one version of the dataset, by request parameters.
+
+    ``version`` comes from ``Storage.version``; a lookup with any other
+    version misses, and storing a result for a new version drops the rest.
+    """
+
+    def __init__(self, size=16):
+        self._lock = threading.Lock()
+        self.size = size
+        self.version = None
+        self.entries = {}
+        self.lookups = Lookups()
+
+    def get(self, version, params):
+        with self._lock:
+            value = self.entries.get(params) if version is not None and version == self.version else None
+            self.lookups.count(value is not None)
+            return value
+
+    def put(self, version, params, value):
+        if version is None:
+            return
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self.entries = {}
+            elif len(self.entries) >= self.size and params not in self.entries:
+                # the oldest parameters go first
+                del self.entries[next(iter(self.entries))]
+            self.entries[params] = value
+
+    def invalidate(self):
+        with self._lock:
+            self.version = None
+            self.entries = {}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.lookups.stats(), entries=len(self.entries))
+
+
+class DatasetCache:
+    """The last parsed dataset, keyed by the identity of the file it came from."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.key = None
+        self.data = None
+        self.lookups = Lookups()
+
+    def get(self, key):
+        with self._lock:
+            hit = key is not None and key == self.key
+            self.lookups.count(hit)
+            return self.data if hit else None
+
+    def put(self, key, data):
+        with self._lock:
+            self.key = key
+            self.data = data
+
+    def invalidate(self):
+        with self._lock:
+            self.key = None
+            self.data = None
+
+    def stats(self):
+        with self._lock:
+            return self.lookups.stats()
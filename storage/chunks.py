@@ -0,0 +1,123 @@
+# Expense lists that change without being copied.
+#
+# Mutation records are copy-on-write (see ``storage.mutations``): readers may
+# still hold the list a change started from, so it can't be edited in place.
+# Copying a plain list costs the whole list for every add, edit or delete.
+# ``ExpenseList`` keeps the expenses in chunks of up to ``CHUNK`` and derives
+# each new version by copying only the chunk that changes plus the list of
+# chunks, so a change costs about ``CHUNK + len / CHUNK`` instead of ``len``.
+# Every version shares the chunks it didn't change with the one before.
+#
+# A plain list is wrapped as a single chunk without copying; it is cut into
+# chunks the first time something inside it changes. Appends never touch it.
+from bisect import bisect_right
+from collections.abc import Sequence
+from itertools import chain
+
+CHUNK = 1024
+
+
+class ExpenseList(Sequence):
+    """A read-only sequence of expenses; ``appended``, ``replaced`` and ``deleted`` return new versions.
+
+    Compares equal to a list with the same expenses, and ``+`` with a list
+    gives a plain list. json needs ``to_json`` to write one. Chunks are never
+    edited once a version holds them.
+    """
+
+    __slots__ = ("_chunks", "_starts")
+
+    def __init__(self, chunks=()):
+        self._chunks = tuple(c for c in chunks if c)
+        starts = [0]
+        for c in self._chunks:
+            starts.append(starts[-1] + len(c))
+        # _starts[k]: position of the first expense of chunk k; the last entry is the length
+        self._starts = starts
+
+    def __len__(self):
+        return self._starts[-1]
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("expense index out of range")
+        k = bisect_right(self._starts, i) - 1
+        return self._chunks[k][i - self._starts[k]]
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, ExpenseList)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return "ExpenseList(%r)" % (list(self),)
+
+    def _locate(self, i):
+        # (chunks with the one holding position i at most CHUNK long, its number, the offset in it)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("expense index out of range")
+        k = bisect_right(self._starts, i) - 1
+        chunks = self._chunks
+        chunk = chunks[k]
+        offset = i - self._starts[k]
+        if len(chunk) > CHUNK:
+            # a wrapped plain list: cut it up once
+            pieces = [chunk[n:n + CHUNK] for n in range(0, len(chunk), CHUNK)]
+            chunks = chunks[:k] + tuple(pieces) + chunks[k + 1:]
+            k += offset // CHUNK
+            offset %= CHUNK
+        return list(chunks), k, offset
+
+    def appended(self, expenses):
+        """This list followed by ``expenses``."""
+        chunks = list(self._chunks)
+        items = list(expenses)
+        if chunks and len(chunks[-1]) < CHUNK:
+            room = CHUNK - len(chunks[-1])
+            chunks[-1] = chunks[-1] + items[:room]
+            items = items[room:]
+        chunks.extend(items[n:n + CHUNK] for n in range(0, len(items), CHUNK))
+        return ExpenseList(chunks)
+
+    def replaced(self, i, expense):
+        """This list with ``expense`` at position ``i``."""
+        chunks, k, offset = self._locate(i)
+        chunk = list(chunks[k])
+        chunk[offset] = expense
+        chunks[k] = chunk
+        return ExpenseList(chunks)
+
+    def deleted(self, i):
+        """This list without the expense at position ``i``."""
+        chunks, k, offset = self._locate(i)
+        chunks[k] = chunks[k][:offset] + chunks[k][offset + 1:]
+        return ExpenseList(chunks)
+
+
+def chunked(expenses):
+    """``expenses`` as an ``ExpenseList``, without copying a plain list."""
+    return expenses if isinstance(expenses, ExpenseList) else ExpenseList([expenses])
+
+
+def to_json(value):
+    # json.dumps ``default``: an ExpenseList is written as the list it stands for
+    if isinstance(value, ExpenseList):
+        return list(value)
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from .base import Storage
+
+
+class _Pending:
+    __slots__ = ("op", "done", "result")
+
+    def __init__(self, op):
+        self.op = op
+        self.done = False
+        self.result = None
+
+
+class GroupCommit(Storage):
+    """Coalesce concurrent mutations into batches with one durable write each.
+
+    The first request to arrive becomes the batch leader: it waits ``window``
+    seconds for others to queue behind it, then hands the whole queue to the
+    wrapped engine's ``commit_batch`` (one file write and fsync). Every request
+    returns only once the batch holding it is on disk. Requests arriving while
+    a batch is being written queue up for the next one. Reads go straight to
+    the wrapped engine.
+    """
+
+    def __init__(self, inner, window):
+        super().__init__()
+        self.inner = inner
+        self.window = window
+        self._cond = threading.Condition()
+        self._queue = []
+        self._flushing = False
+        self.batches = 0
+        self.batched_ops = 0
+
+    def commit(self, op):
+        pending = _Pending(op)
+        with self._cond:
+            self._queue.append(pending)
+            while self._flushing:
+                self._cond.wait()
+                if pending.done:
+                    return self._result(pending)
+            self._flushing = True
+        # leader: let concurrent requests join the batch, then write it
+        if self.window > 0:
+            time.sleep(self.window)
+        with self._cond:
+            batch, self._queue = self._queue, []
+        try:
+            results = self.inner.commit_batch([p.op for p in batch])
+        except BaseException as exc:
+            results = [exc] * len(batch)
+        with self._cond:
+            for p, result in zip(batch, results):
+                p.result = result
+                p.done = True
+            self.batches += 1
+            self.batched_ops += len(batch)
+            self._flushing = False
+            self._cond.notify_all()
+        return self._result(pending)
+
+    def _result(self, pending):
+        if isinstance(pending.result, BaseException):
+            raise pending.result
+        return pending.result
+
+    def commit_batch(self, ops):
+        return self.inner.commit_batch(ops)
+
+    def load(self):
+        return self.inner.load()
+
+    def version(self):
+        return self.inner.version()
+
+    def save(self, data):
+        self.inner.save(data)
+
+    def participants(self):
+        return self.inner.participants()
+
+    def participant_names(self):
+        return self.inner.participant_names()
+
+    def ledger(self):
+        return self.inner.ledger()
+
+    def settings(self):
+        return self.inner.settings()
+
+    def get_expense(self, eid):
+        return self.inner.get_expense(eid)
+
+    def stats(self):
+        with self._cond:
+            group = {
+                "batches": self.batches,
+                "batched_ops": self.batched_ops,
+                "mean_batch": self.batched_ops / self.batches if self.batches else 0.0,
+            }
+        return dict(self.inner.stats(), group_commit=group)
+
+    def close(self):
+        self.inner.close()
@@ -0,0 +1,101 @@
+# Expense id index used by the mutation records.
+#
+# Expense lists are copy-on-write (see ``storage.mutations``), so every change
+# produces a new list object. ``ExpenseIndex`` follows the newest list of one
+# dataset: it is told how each mutation derived the new list from the old one
+# and updates its id -> position map in O(1) (deletes in O(log n)) instead of
+# rescanning. Handed any other list, to look up in or to derive from, it
+# rebuilds itself, so a stale index can only cost time, never return a wrong
+# position.
+from bisect import bisect_left, insort
+
+# rebuild the position map once this many deletes have piled up, and they are
+# more than an eighth of the list
+COMPACT_MIN = 64
+
+
+class ExpenseIndex:
+    """Expense id -> position in the most recent version of an expenses list.
+
+    Positions are kept in a virtual list that only ever grows: a delete records
+    the removed slot in ``_deleted`` instead of renumbering everything after
+    it, and lookups subtract the removed slots before them. The map is rebuilt
+    (compacted) lazily once deletes pile up.
+    """
+
+    def __init__(self):
+        self.expenses = None
+        self._pos = {}
+        self._deleted = []
+        self._next = 0
+        self.unique = True
+        self.rebuilds = 0
+
+    def _build(self, expenses):
+        pos = {}
+        unique = True
+        for n, e in enumerate(expenses):
+            try:
+                if pos.setdefault(e.get("id"), n) != n:
+                    unique = False
+            except TypeError:
+                # unhashable id in a hand-edited file
+                unique = False
+        self.expenses = expenses
+        self._pos = pos
+        self._deleted = []
+        self._next = len(expenses)
+        self.unique = unique
+        self.rebuilds += 1
+
+    def sync(self, expenses):
+        """Point the index at ``expenses``; returns whether ids are unique (lookups are valid)."""
+        if expenses is not self.expenses:
+            self._build(expenses)
+        return self.unique
+
+    def find(self, expenses, eid):
+        """Position of the expense with id ``eid`` in ``expenses``, or None."""
+        self.sync(expenses)
+        try:
+            slot = self._pos.get(eid)
+        except TypeError:
+            return None
+        if slot is None:
+            return None
+        return slot - bisect_left(self._deleted, slot)
+
+    def _follows(self, previous, expenses):
+        # whether the map is of ``previous``, so that a change from it can be applied; rebuilt for ``expenses`` if not
+        if previous is self.expenses:
+            return True
+        self._build(expenses)
+        return False
+
+    def replaced(self, previous, expenses):
+        """``expenses`` has the ids of ``previous`` at the same positions (an edit or a rescale)."""
+        if self._follows(previous, expenses):
+            self.expenses = expenses
+
+    def appended(self, previous, expenses, eids):
+        """``expenses`` is ``previous`` plus expenses with ids ``eids``."""
+        if not self._follows(previous, expenses):
+            return
+        for eid in eids:
+            try:
+                if self._pos.setdefault(eid, self._next) != self._next:
+                    self.unique = False
+            except TypeError:
+                self.unique = False
+            self._next += 1
+        self.expenses = expenses
+
+    def removed(self, previous, expenses, eid):
+        """``expenses`` is ``previous`` without the expense ``eid``."""
+        if not self._follows(previous, expenses):
+            return
+        slot = self._pos.pop(eid)
+        insort(self._deleted, slot)
+        self.expenses = expenses
+        if len(self._deleted) > max(COMPACT_MIN, len(expenses) // 8):
+            self._build(expenses)
@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+
+from . import mutations
+from .base import Storage, empty_data, normalize
+from .cache import Lookups, file_id
+from .index import ExpenseIndex
+from .locks import StorageLocks, discard, install, write_temp
+from .snapshot import codec
+
+# compact once the journal grows past this many bytes
+COMPACT_BYTES = int(os.environ.get("GROUP_EXPENSE_JOURNAL_COMPACT_BYTES", 1 << 20))
+
+
+class JournalStorage(Storage):
+    """Snapshot plus an append-only log of mutation records.
+
+    ``commit`` appends one compact ``[seq, op]`` line to ``<path>.journal``
+    instead of rewriting the snapshot, so a write costs the size of the change.
+    The dataset is rebuilt from snapshot + journal, and the process keeps the
+    result in memory, replaying only the journal tail that other processes
+    appended since. Once the journal passes ``compact_bytes`` a background
+    thread folds it into a new snapshot. The snapshot records the last folded
+    ``seq`` (``journal_seq``) so records surviving a crash mid-compaction are
+    skipped on replay, and a torn final record is dropped and truncated away.
+
+    Appends and compaction hold the cross-process writer lock; readers take
+    the shared file lock so they never pair a snapshot with the wrong journal.
+    ``snapshot_format`` picks the snapshot encoding (see ``storage.snapshot``).
+    Datasets returned by ``load`` are shared and must be treated as read-only.
+    """
+
+    def __init__(self, path, journal_path=None, compact_bytes=None, snapshot_format="json"):
+        super().__init__()
+        self.path = path
+        self.encode, self.decode = codec(snapshot_format)
+        self.journal_path = journal_path or path + ".journal"
+        self.compact_bytes = COMPACT_BYTES if compact_bytes is None else compact_bytes
+        self.locks = StorageLocks(path)
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._compactor = None
+        self._state = None
+        self._seq = 0
+        self._snapshot_id = None
+        self._journal_ino = None
+        self._offset = 0
+        self.lookups = Lookups()
+
+    def _read_snapshot(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return empty_data(), 0, None
+        with f:
+            snapshot_id = file_id(os.fstat(f.fileno()))
+            data = self.decode(f.read())
+        seq = data.pop("journal_seq", 0)
+        return normalize(data), seq, snapshot_id
+
+    def _replay(self, data, seq, offset):
+        # apply journal records after ``offset``; returns (seq, end of the last good record, torn)
+        try:
+            with open(self.journal_path, "rb") as f:
+                f.seek(offset)
+                buf = f.read()
+        except FileNotFoundError:
+            return seq, offset, False
+        pos = 0
+        index = ExpenseIndex()
+        while pos < len(buf):
+            end = buf.find(b"\n", pos)
+            if end < 0:
+                # partial final record: an interrupted append, or one still in progress
+                return seq, offset + pos, True
+            try:
+                rec_seq, op = json.loads(buf[pos:end])
+            except ValueError:
+                return seq, offset + pos, True
+            if rec_seq > seq:
+                mutations.apply(data, op, index)
+                seq = rec_seq
+            pos = end + 1
+        return seq, offset + pos, False
+
+    def _refresh(self, repair=False):
+        # only a caller holding the writer lock may repair: otherwise a torn
+        # record may just be another worker's append in progress
+        with self._lock, self.locks.read():
+            try:
+                snapshot_id = file_id(os.stat(self.path))
+            except FileNotFoundError:
+                snapshot_id = None
+            try:
+                jst = os.stat(self.journal_path)
+                journal_ino, journal_size = jst.st_ino, jst.st_size
+            except FileNotFoundError:
+                journal_ino, journal_size = None, 0
+            if (self._state is None or snapshot_id != self._snapshot_id
+                    or journal_ino != self._journal_ino or journal_size < self._offset):
+                self._state, self._seq, self._snapshot_id = self._read_snapshot()
+                self._journal_ino = journal_ino
+                self._offset = 0
+            elif journal_size == self._offset:
+                self.lookups.count(True)
+                return
+            self.lookups.count(False)
+            if journal_size > self._offset:
+                # replay into a copy so datasets already handed to readers stay intact
+                self._state = dict(self._state)
+                self._seq, self._offset, torn = self._replay(self._state, self._seq, self._offset)
+                if torn and repair:
+                    os.truncate(self.journal_path, self._offset)
+
+    def load(self):
+        with self._lock:
+            self._refresh()
+            return self._state
+
+    def version(self):
+        # appends grow the journal; compaction and saves replace the files
+        try:
+            snapshot_id = file_id(os.stat(self.path))
+        except FileNotFoundError:
+            snapshot_id = None
+        try:
+            jst = os.stat(self.journal_path)
+            journal = jst.st_ino, jst.st_size
+        except FileNotFoundError:
+            journal = None
+        return self.revision, snapshot_id, journal
+
+    def save(self, data):
+        with self.locks.write(), self._lock:
+            self._refresh(repair=True)
+            data = normalize(dict(data))
+            tmp, st = write_temp(self.path, self.encode(dict(data, journal_seq=self._seq)))
+            with self.locks.swap():
+                install(tmp, self.path)
+                self._write_journal(b"")
+            self._state = data
+            self._snapshot_id = file_id(st)
+            self._offset = 0
+            self.revision += 1
+
+    def commit_batch(self, ops):
+        # every record of the batch goes out in one append and one fsync
+        with self.locks.write():
+            with self._lock:
+                self._refresh(repair=True)
+                # apply to a copy so datasets already handed to readers stay intact
+                state = dict(self._state)
+                seq = self._seq
+            lines = []
+            results = []
+            with self.index_lock:
+                for op in ops:
+                    before = dict(state)
+                    try:
+                        line = json.dumps([seq + 1, op], separators=(",", ":")) + "\n"
+                        results.append(mutations.apply(state, op, self.index))
+                    except Exception as exc:
+                        state = before
+                        results.append(exc)
+                        continue
+                    lines.append(line.encode())
+                    seq += 1
+            try:
+                with open(self.journal_path, "ab") as f:
+                    f.write(b"".join(lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    offset = f.tell()
+                    journal_ino = os.fstat(f.fileno()).st_ino
+            except BaseException:
+                with self._lock:
+                    # the journal may hold part of the batch, rebuild from disk next time
+                    self._state = None
+                raise
+            with self._lock:
+                self._state = state
+                self._seq = seq
+                self._offset = offset
+                self._journal_ino = journal_ino
+                self.revision += 1
+            if offset > self.compact_bytes:
+                self._start_compaction()
+            return results
+
+    def _write_journal(self, tail):
+        tmp, st = write_temp(self.journal_path, tail)
+        install(tmp, self.journal_path)
+        self._journal_ino = st.st_ino
+
+    def _journal_inode(self):
+        try:
+            return os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _start_compaction(self):
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(target=self.compact, name="journal-compactor", daemon=True)
+            self._compactor.start()
+
+    def compact(self):
+        """Fold the journal into a new snapshot, keeping records appended meanwhile."""
+        with self._compact_lock:
+            # build the new snapshot without blocking readers or writers
+            with self.locks.read():
+                data, seq, snapshot_id = self._read_snapshot()
+                journal_ino = self._journal_inode()
+                seq, offset, _ = self._replay(data, seq, 0)
+            tmp, st = write_temp(self.path, self.encode(dict(data, journal_seq=seq)))
+            with self.locks.write(), self._lock:
+                try:
+                    current_id = file_id(os.stat(self.path))
+                except FileNotFoundError:
+                    current_id = None
+                if current_id != snapshot_id or self._journal_inode() != journal_ino:
+                    # another worker compacted or saved meanwhile: the tail past ``offset`` is not ours
+                    discard(tmp)
+                    return
+                try:
+                    with open(self.journal_path, "rb") as f:
+                        f.seek(offset)
+                        tail = f.read()
+                except FileNotFoundError:
+                    tail = b""
+                # swap snapshot and journal together so readers see a matching pair
+                with self.locks.swap():
+                    install(tmp, self.path)
+                    self._write_journal(tail)
+                self._snapshot_id = file_id(st)
+                if self._state is not None and self._offset >= offset:
+                    # the in-memory state is unchanged, only the files behind it moved
+                    self._offset -= offset
+                else:
+                    self._state = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self.lookups.stats(), journal_bytes=self._offset)
+
+    def wait_for_compaction(self):
+        if self._compactor is not None:
+            self._compactor.join()
@@ -0,0 +1,65 @@
+import os
+
+from .base import Storage, empty_data, normalize
+from .cache import DatasetCache, file_id
+from .locks import StorageLocks, install, write_temp
+from .snapshot import codec
+
+
+class JsonStorage(Storage):
+    """The original single-file store: the whole dataset in one JSON document.
+
+    The parsed document is cached in-process and revalidated with a single
+    ``stat`` of the file, so warm reads neither read nor parse it. ``revision``
+    counts the saves made through this process. Saves go through a temporary
+    file and a rename under the cross-process locks of ``StorageLocks``.
+    ``snapshot_format`` picks the on-disk encoding (see ``storage.snapshot``).
+    """
+
+    def __init__(self, path, snapshot_format="json"):
+        super().__init__()
+        self.path = path
+        self.encode, self.decode = codec(snapshot_format)
+        self.cache = DatasetCache()
+        self.locks = StorageLocks(path)
+
+    def load(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.cache.invalidate()
+            return empty_data()
+        data = self.cache.get(file_id(st))
+        if data is not None:
+            return data
+        with self.locks.read():
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:
+                return empty_data()
+            with f:
+                key = file_id(os.fstat(f.fileno()))
+                data = normalize(self.decode(f.read()))
+        self.cache.put(key, data)
+        return data
+
+    def save(self, data):
+        with self.locks.write():
+            tmp, st = write_temp(self.path, self.encode(data))
+            with self.locks.swap():
+                install(tmp, self.path)
+            self.cache.put(file_id(st), data)
+            self.revision += 1
+
+    def version(self):
+        try:
+            return self.revision, file_id(os.stat(self.path))
+        except FileNotFoundError:
+            return None
+
+    def commit_batch(self, ops):
+        with self.locks.write():
+            return super().commit_batch(ops)
+
+    def stats(self):
+        return dict(self.cache.stats(), revision=self.revision)
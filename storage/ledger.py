@@ -0,0 +1,233 @@
+# Running per-participant totals, kept with the dataset.
+#
+# ``data["ledger"]`` holds what /api/report needs, in minor units: what each
+# participant paid, their share of the expenses, and the group total.
+#
+#   {"total": 12345, "expenses": 17, "rows": [[id, paid, share], ...],
+#    "plan": [[from id, to id, amount], ...]}
+#
+# Mutation records keep it current as they go. Adding, editing or removing an
+# expense applies the difference that one expense makes. Changing who the
+# participants are changes the share of every expense split among them (an
+# expense split among everyone is then split among the new set), and renaming
+# someone can change who receives remainder units, so those records rebuild it.
+#
+# ``rows`` are sorted by participant id. ``expenses`` is the number of
+# expenses the ledger covers, a cheap check against files edited by hand: a
+# dataset whose ledger is missing, incomplete or miscounted gets a fresh one on
+# load.
+#
+# ``plan`` is the last payment plan issued for the current participants.
+# Applying an expense adjusts it (see ``settlement.incremental``) rather than
+# recomputing it, so the payments people were told about change only where
+# the expense moved their balances; a rebuild starts a fresh one.
+#
+# ``days`` holds the same sums by the date of the expenses, for reports over a
+# range of dates (``storage.window``):
+#
+#   [[day ordinal, total, [[id, paid, share], ...]], ...]
+#
+# sorted by day, each day's rows sorted by id, with no all-zero rows and no
+# empty days. An expense without an ISO date (YYYY-MM-DD) is in no day. The
+# records keep it current the way they keep ``rows``: a change touches only
+# the days of the expenses it adds and removes.
+import os
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import date as _date
+from functools import lru_cache
+
+from settlement.incremental import MARGIN, adjust_payments
+from settlement.matching import greedy_payments
+from settlement.parallel import MIN_EXPENSES, parallel_add_expenses
+from settlement.totals import SplitOrders
+
+from .participants import name_rank
+
+# rebuilds over at least this many expenses are split across processes (see settlement.parallel)
+PARALLEL_MIN_EXPENSES = int(os.environ.get("GROUP_EXPENSE_PARALLEL_MIN_EXPENSES", MIN_EXPENSES))
+# worker processes for those rebuilds; 0 means one per CPU. Off (1) unless set:
+# forking while the server's threads hold the data file and index locks can
+# leave a worker waiting on a lock nobody will release
+PARALLEL_WORKERS = int(os.environ.get("GROUP_EXPENSE_PARALLEL_WORKERS", 1))
+# how many transfers an adjusted plan may have beyond a fresh one's bound before it is replaced
+PLAN_MARGIN = int(os.environ.get("GROUP_EXPENSE_PLAN_MARGIN", MARGIN))
+# what every ledger holds; one missing a key (a hand edit) is rebuilt
+KEYS = ("total", "expenses", "rows", "plan", "days")
+
+
+def _counted(expenses):
+    # an amount that isn't an integer (a hand-edited file) counts as zero, as a failed upgrade does
+    return [e if type(e.get("amount_minor", 0)) is int else dict(e, amount_minor=0) for e in expenses]
+
+
+def date_ordinal(value):
+    """The ordinal of an ISO date string, 0 when it isn't one."""
+    try:
+        return _date.fromisoformat(value).toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+
+def _id_order(pid):
+    return (not isinstance(pid, int), pid if isinstance(pid, int) else str(pid))
+
+
+def plan(records, paid, share, issued=None):
+    """The payment plan for totals by id: ``issued`` adjusted, or fresh greedy payments when it is None."""
+    balances = {p["id"]: paid.get(p["id"], 0) - share.get(p["id"], 0) for p in records}
+    paid = {p["id"]: paid.get(p["id"], 0) for p in records}
+    if issued is None:
+        payments = greedy_payments(balances, paid)
+    else:
+        payments = adjust_payments(issued, balances, paid, PLAN_MARGIN)[0]
+    return [list(payment) for payment in payments]
+
+
+def make(records, total, count, paid, share, issued=None, days=()):
+    """A ledger from totals by id; ``records`` are the current participants, ``issued`` the plan to adjust."""
+    # amounts without a payer only count towards the total; people who left keep a row while it is not zero
+    paid.pop(None, None)
+    active = {p["id"] for p in records}
+    ids = sorted((pid for pid in set(paid) | set(share) if pid in active or paid.get(pid) or share.get(pid)),
+                 key=_id_order)
+    return {"total": total, "expenses": count, "rows": [[pid, paid.get(pid, 0), share.get(pid, 0)] for pid in ids],
+            "plan": plan(records, paid, share, issued), "days": list(days)}
+
+
+def build(data):
+    """The ledger of ``data``, computed from all of its expenses."""
+    records = data.get("participants", [])
+    ids = [p["id"] for p in records]
+    count = len(data.get("expenses", []))
+    expenses = _counted(data.get("expenses", []))
+    # a payer who has left still paid
+    paid = defaultdict(int, ((pid, 0) for pid in ids))
+    share = {pid: 0 for pid in ids}
+    if ids:
+        total = parallel_add_expenses(paid, share, ids, expenses, name_rank(records),
+                                      PARALLEL_WORKERS or None, PARALLEL_MIN_EXPENSES)
+    else:
+        # nobody to share among
+        total = 0
+        for e in expenses:
+            paid[e.get("payer")] += e.get("amount_minor", 0)
+            total += e.get("amount_minor", 0)
+    return make(records, total, count, dict(paid), share, days=_days([], day_deltas(records, expenses)))
+
+
+def _complete(ledger):
+    return isinstance(ledger, dict) and all(key in ledger for key in KEYS)
+
+
+def current(data):
+    """The ledger stored with ``data``, or a fresh one when it is missing or out of date."""
+    ledger = data.get("ledger")
+    if not _complete(ledger) or ledger["expenses"] != len(data.get("expenses", [])):
+        return build(data)
+    return ledger
+
+
+@lru_cache(maxsize=8)
+def _orders(people):
+    records = [{"id": pid, "name": name} for pid, name in people]
+    return SplitOrders([pid for pid, _ in people], name_rank(records))
+
+
+def split_orders(records):
+    """The ``SplitOrders`` of participants ``records``, shared by every call with the same participants."""
+    return _orders(tuple((p["id"], p["name"]) for p in records))
+
+
+def deltas(records, added=(), removed=()):
+    """(paid, share, total) changes from adding and removing expenses, participants ``records``."""
+    orders = split_orders(records) if records else None
+    paid = defaultdict(int)
+    share = defaultdict(int)
+    total = 0
+    for sign, expenses in ((1, added), (-1, removed)):
+        for e in _counted(expenses):
+            amt = e.get("amount_minor", 0)
+            total += sign * amt
+            paid[e.get("payer")] += sign * amt
+            if orders is not None:
+                for member, units in orders.shares(amt, e.get("split")):
+                    share[member] += sign * units
+    return paid, share, total
+
+
+def day_deltas(records, added=(), removed=()):
+    """{day ordinal: (paid, share, total) changes} from adding and removing expenses, participants ``records``."""
+    by_day = {}
+    for n, expenses in enumerate((added, removed)):
+        for e in expenses:
+            day = date_ordinal(e.get("date"))
+            if day:
+                by_day.setdefault(day, ([], []))[n].append(e)
+    return {day: deltas(records, a, r) for day, (a, r) in by_day.items()}
+
+
+def _days(days, changes):
+    # ``days`` (see the top of this file) with ``day_deltas`` applied; the days not changed are shared
+    days = list(days)
+    ordinals = [day for day, _, _ in days]
+    for day, (d_paid, d_share, d_total) in sorted(changes.items()):
+        k = bisect_left(ordinals, day)
+        found = k < len(days) and ordinals[k] == day
+        total = d_total + (days[k][1] if found else 0)
+        rows = {pid: [p, s] for pid, p, s in days[k][2]} if found else {}
+        # amounts without a payer only count towards the day's total
+        d_paid.pop(None, None)
+        for pid, units in d_paid.items():
+            rows.setdefault(pid, [0, 0])[0] += units
+        for pid, units in d_share.items():
+            rows.setdefault(pid, [0, 0])[1] += units
+        rows = [[pid, p, s] for pid, (p, s) in sorted(rows.items(), key=lambda r: _id_order(r[0])) if p or s]
+        if total or rows:
+            if found:
+                days[k] = [day, total, rows]
+            else:
+                days.insert(k, [day, total, rows])
+                ordinals.insert(k, day)
+        elif found:
+            del days[k]
+            del ordinals[k]
+    return days
+
+
+def update(data, added=(), removed=()):
+    """Replace ``data["ledger"]`` after the expenses ``added`` and ``removed`` changed ``data["expenses"]``."""
+    ledger = data.get("ledger")
+    count = len(data.get("expenses", []))
+    if not _complete(ledger) or ledger["expenses"] + len(added) - len(removed) != count:
+        data["ledger"] = build(data)
+        return
+    records = data.get("participants", [])
+    d_paid, d_share, d_total = deltas(records, added, removed)
+    paid = {pid: p for pid, p, _ in ledger["rows"]}
+    share = {pid: s for pid, _, s in ledger["rows"]}
+    for pid, units in d_paid.items():
+        paid[pid] = paid.get(pid, 0) + units
+    for pid, units in d_share.items():
+        share[pid] = share.get(pid, 0) + units
+    data["ledger"] = make(records, ledger["total"] + d_total, count, paid, share, ledger["plan"],
+                          _days(ledger["days"], day_deltas(records, added, removed)))
+
+
+def rebuild(data):
+    data["ledger"] = build(data)
+
+
+def view(data, ledger=None):
+    """What /api/report needs: participant records, currency, paid and share by id, the total, the plan and the days."""
+    if ledger is None:
+        ledger = current(data)
+    return {
+        "participants": data.get("participants", []),
+        "currency": data.get("currency", "CAD"),
+        "paid": {pid: p for pid, p, _ in ledger["rows"]},
+        "share": {pid: s for pid, _, s in ledger["rows"]},
+        "total": ledger["total"],
+        "plan": ledger["plan"],
+        "days": ledger["days"],
+    }
@@ -0,0 +1,130 @@
+# Cross-process locking for the file-backed engines.
+#
+# Two advisory flock(2) locks guard a dataset stored at ``path``:
+#
+# * ``<path>.write.lock`` is held exclusively for a whole read-modify-write
+#   cycle, so writers in different gunicorn workers never lose each other's
+#   updates.
+# * ``<path>.lock`` is held shared by readers while they open and read the
+#   data files, and exclusively by a writer only for the instant it renames
+#   freshly written files into place.
+#
+# Writers serialize new contents to a temporary file first, so readers never
+# wait on serialization and never observe a half-written file.
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class FileLock:
+    """Shared/exclusive flock on a sidecar file, reentrant within a thread.
+
+    Every acquisition opens its own descriptor, so threads of one process
+    contend with each other exactly like separate processes do. Where fcntl is
+    unavailable the lock degrades to an in-process lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._fallback = threading.RLock()
+
+    @contextmanager
+    def _hold(self, exclusive):
+        held = getattr(self._local, "mode", None)
+        if held is not None:
+            if exclusive and held != "ex":
+                raise RuntimeError("cannot upgrade a shared lock on %s" % self.path)
+            yield
+            return
+        if fcntl is None:
+            with self._fallback:
+                self._local.mode = "ex" if exclusive else "sh"
+                try:
+                    yield
+                finally:
+                    self._local.mode = None
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._local.mode = "ex" if exclusive else "sh"
+            try:
+                yield
+            finally:
+                self._local.mode = None
+        finally:
+            # closing the descriptor releases the lock
+            os.close(fd)
+
+    def shared(self):
+        return self._hold(False)
+
+    def exclusive(self):
+        return self._hold(True)
+
+
+class StorageLocks:
+    def __init__(self, path):
+        self.writer = FileLock(path + ".write.lock")
+        self.files = FileLock(path + ".lock")
+
+    def write(self):
+        # held across a commit's load, apply and save so concurrent workers can't lose each other's updates
+        return self.writer.exclusive()
+
+    def read(self):
+        return self.files.shared()
+
+    def swap(self):
+        return self.files.exclusive()
+
+
+def write_temp(path, payload):
+    """Write ``payload`` to a synced temporary file beside ``path``; returns (tmp, stat)."""
+    tmp = "%s.tmp-%d-%d" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+    except BaseException:
+        discard(tmp)
+        raise
+    return tmp, st
+
+
+def install(tmp, path):
+    # rename keeps the inode, size and mtime, so the temp file's stat identifies the result
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        discard(tmp)
+        raise
+    fsync_dir(path)
+
+
+def discard(tmp):
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+
+
+def fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
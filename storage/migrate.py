@@ -0,0 +1,66 @@
+# One-shot conversion of a dataset between storage engines and snapshot formats.
+#
+#   python -m storage.migrate data.json data.db     # JSON -> SQLite
+#   python -m storage.migrate data.json data.bin    # JSON -> binary snapshot
+#   python -m storage.migrate data.bin data.json    # and back
+#   python -m storage.migrate data.json data.sections  # JSON -> sectioned directory
+#
+# The engine of each side is picked from its file extension.
+import os
+import sys
+
+from .json_store import JsonStorage
+from .sectioned import SectionedStorage
+from .sqlite_store import SqliteStorage
+
+EXTENSIONS = {
+    ".json": lambda path: JsonStorage(path),
+    ".bin": lambda path: JsonStorage(path, snapshot_format="binary"),
+    ".db": SqliteStorage,
+    ".sections": SectionedStorage,
+    ".sqlite": SqliteStorage,
+    ".sqlite3": SqliteStorage,
+}
+
+
+def open_path(path):
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        return EXTENSIONS[ext](path)
+    except KeyError:
+        raise ValueError("don't know how to store %s (expected one of: %s)" % (path, ", ".join(sorted(EXTENSIONS))))
+
+
+def convert(src_path, dst_path):
+    src = open_path(src_path)
+    dst = open_path(dst_path)
+    try:
+        data = src.load()
+        dst.save(data)
+    finally:
+        src.close()
+        dst.close()
+    return data
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("usage: python -m storage.migrate SOURCE DESTINATION", file=sys.stderr)
+        return 2
+    src_path, dst_path = argv
+    if not os.path.exists(src_path):
+        print("no such file: %s" % src_path, file=sys.stderr)
+        return 1
+    try:
+        data = convert(src_path, dst_path)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+    print("copied %d participants and %d expenses into %s"
+          % (len(data["participants"]), len(data["expenses"]), dst_path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
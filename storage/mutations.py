@@ -0,0 +1,219 @@
+# Mutation records shared by every storage engine.
+#
+# Endpoints never edit a loaded dataset in place; they describe the change as a
+# small dict (``{"op": "add_expense", "expense": {...}}``) and hand it to
+# ``Storage.commit``. Engines that only know how to read and write a whole
+# dataset fall back to ``apply`` below, while engines with finer-grained
+# persistence (SQLite rows, journals) translate the record directly.
+#
+# ``apply`` is copy-on-write: it replaces the lists and expense records it
+# changes instead of editing them, so a shallow copy of a cached dataset can be
+# mutated while readers keep using the original. Adding, editing, deleting and
+# restoring an expense derive the new list as an ``ExpenseList``
+# (``storage.chunks``), which copies only the chunk that changed.
+#
+# Records that address an expense by id look it up through an ``ExpenseIndex``
+# (``storage.index``). Engines keep one per dataset and pass it to every
+# ``apply`` so the index survives across requests; without one, a fresh index
+# is built for the call.
+#
+# Records name participants the way the API does; expenses are stored with
+# participant ids (see ``storage.participants``) and converted on the way in,
+# long splits as a compact bitset (``settlement.splits``).
+#
+# Every record also keeps the dataset's running totals (``storage.ledger``)
+# current, so a report never has to scan the expenses.
+from settlement.money import precision
+from settlement.splits import compact
+
+from . import ledger, participants
+from .amounts import rescale_expenses, upgrade_expense
+from .chunks import chunked
+from .index import ExpenseIndex
+
+
+def _expense(data, expense):
+    # restored items come back as the API sent them, with a float amount
+    expense = upgrade_expense(expense, precision(data.get("currency")))
+    expense = participants.expense_ids(data, expense)
+    split = compact(expense.get("split"))
+    if split is not expense.get("split"):
+        expense = dict(expense, split=split)
+    return expense
+
+
+def _participants_result(data):
+    return participants.active_names(data)
+
+
+def _set_participants(data, op, index):
+    participants.set_active(data, op["names"])
+    # remove expenses by missing participants
+    ids = {p["id"] for p in data["participants"]}
+    data["expenses"] = [e for e in data.get("expenses", []) if e.get("payer") in ids]
+    ledger.rebuild(data)
+    return _participants_result(data)
+
+
+def _add_expense(data, op, index):
+    expense = _expense(data, op["expense"])
+    expenses = data.get("expenses", [])
+    index.sync(expenses)
+    data["expenses"] = chunked(expenses).appended([expense])
+    index.appended(expenses, data["expenses"], [expense.get("id")])
+    ledger.update(data, added=[expense])
+    return True
+
+
+def _edit_expense(data, op, index):
+    expense = _expense(data, op["expense"])
+    expenses = data.get("expenses", [])
+    if not index.sync(expenses):
+        # duplicate ids: edit the first match, as a scan would
+        for idx, e in enumerate(expenses):
+            if e.get("id") == expense.get("id"):
+                data["expenses"] = expenses[:idx] + [expense] + expenses[idx + 1:]
+                ledger.update(data, added=[expense], removed=[e])
+                return True
+        return False
+    idx = index.find(expenses, expense.get("id"))
+    if idx is None:
+        return False
+    new = chunked(expenses).replaced(idx, expense)
+    data["expenses"] = new
+    index.replaced(expenses, new)
+    ledger.update(data, added=[expense], removed=[expenses[idx]])
+    return True
+
+
+def _delete_expense(data, op, index):
+    expenses = data.get("expenses", [])
+    if not index.sync(expenses):
+        # duplicate ids: remove every match
+        new = [e for e in expenses if e.get("id") != op["id"]]
+        if len(new) == len(expenses):
+            return False
+        data["expenses"] = new
+        ledger.update(data, removed=[e for e in expenses if e.get("id") == op["id"]])
+        return True
+    idx = index.find(expenses, op["id"])
+    if idx is None:
+        return False
+    new = chunked(expenses).deleted(idx)
+    data["expenses"] = new
+    index.removed(expenses, new, op["id"])
+    ledger.update(data, removed=[expenses[idx]])
+    return True
+
+
+def _rename_participant(data, op, index):
+    old = op["old"]
+    new = op["new"]
+    parts = list(data.get("participants", []))
+    # replace only the first exact match to avoid renaming duplicates unintentionally;
+    # expenses refer to the id, so nothing else changes
+    for idx, p in enumerate(parts):
+        if p["name"] == old:
+            parts[idx] = dict(p, name=new)
+            break
+    reordered = participants.name_rank(parts) != participants.name_rank(data.get("participants", []))
+    data["participants"] = parts
+    if reordered:
+        # remainder units go out in name order
+        ledger.rebuild(data)
+    return _participants_result(data)
+
+
+def _delete_participant(data, op, index):
+    name = op["name"]
+    gone = [p for p in data.get("participants", []) if p["name"] == name]
+    ids = {p["id"] for p in gone}
+    data["participants"] = [p for p in data.get("participants", []) if p["name"] != name]
+    # their id stays reserved: older splits may still list them
+    data["former_participants"] = data.get("former_participants", []) + gone
+    # remove expenses by that participant
+    data["expenses"] = [e for e in data.get("expenses", []) if e.get("payer") not in ids]
+    ledger.rebuild(data)
+    return _participants_result(data)
+
+
+def _restore_expense(data, op, index):
+    expense = _expense(data, op["expense"])
+    expenses = data.get("expenses", [])
+    if index.find(expenses, expense.get("id")) is not None:
+        return False
+    data["expenses"] = chunked(expenses).appended([expense])
+    index.appended(expenses, data["expenses"], [expense.get("id")])
+    ledger.update(data, added=[expense])
+    return True
+
+
+def _restore_participant(data, op, index):
+    name = op["name"]
+    names = participants.active_names(data)
+    joined = name not in names
+    if joined:
+        participants.set_active(data, names + [name])
+    expenses = data.get("expenses", [])
+    # with no expenses to look up, nothing else would point the index at this list
+    index.sync(expenses)
+    added = []
+    seen = set()
+    for e in op.get("expenses", []):
+        eid = e.get("id")
+        # skip ids already stored, and repeats within the restored list
+        if eid in seen or index.find(expenses, eid) is not None:
+            continue
+        seen.add(eid)
+        added.append(_expense(data, e))
+    data["expenses"] = chunked(expenses).appended(added)
+    index.appended(expenses, data["expenses"], [e.get("id") for e in added])
+    if joined:
+        ledger.rebuild(data)
+    else:
+        ledger.update(data, added=added)
+    return _participants_result(data)
+
+
+def _settings(data, op, index):
+    if op.get("event") is not None:
+        data["event"] = str(op["event"])
+    if op.get("currency") is not None:
+        currency = str(op["currency"])
+        # amounts are counted in the currency's minor unit, re-express them in the new one (exactly, or not at all)
+        expenses = data.get("expenses", [])
+        index.sync(expenses)
+        data["expenses"] = rescale_expenses(expenses, data.get("currency"), currency)
+        index.replaced(expenses, data["expenses"])
+        data["currency"] = currency
+        if data["expenses"] is not expenses:
+            ledger.rebuild(data)
+    return {"event": data.get("event", ""), "currency": data.get("currency", "CAD")}
+
+
+HANDLERS = {
+    "set_participants": _set_participants,
+    "add_expense": _add_expense,
+    "edit_expense": _edit_expense,
+    "delete_expense": _delete_expense,
+    "rename_participant": _rename_participant,
+    "delete_participant": _delete_participant,
+    "restore_expense": _restore_expense,
+    "restore_participant": _restore_participant,
+    "settings": _settings,
+}
+
+
+def apply(data, op, index=None):
+    """Apply one mutation record to ``data`` and return its result.
+
+    ``index`` is the dataset's ``ExpenseIndex``; pass the same one to every
+    call on a dataset to keep id lookups constant time.
+    """
+    try:
+        handler = HANDLERS[op["op"]]
+    except KeyError:
+        raise ValueError("unknown mutation: %r" % (op.get("op"),))
+    if index is None:
+        index = ExpenseIndex()
+    return handler(data, op, index)
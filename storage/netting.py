@@ -0,0 +1,149 @@
+# One settlement across several events.
+#
+#   python -m storage.netting [--method=METHOD] [--cache=FILE] EVENT_JSON...
+#
+# A group that runs events back to back and settles each data file on its
+# own sends money back and forth: what someone is owed for one event pays
+# what they owe for the next. ``net_report`` adds up what each person paid
+# and owes over a set of archived data files, matched by participant name,
+# and settles the sum once, with the same minor-unit totals and the same
+# settlement methods as /api/report.
+#
+# Each file's totals are read with ``storage.stream`` and kept in an
+# ``EventBalances`` cache under the file's identity (inode, size, mtime), so
+# adding an event to the set reads that event alone. The command keeps the
+# cache in ``--cache`` between runs.
+import json
+import os
+import sys
+import threading
+
+from settlement import METHODS, build_report, from_minor, precision
+
+from .cache import Lookups, file_id
+from .locks import install, write_temp
+from .stream import stream_ledger
+
+
+def event_totals(path):
+    """What one event file contributes: currency, total, and paid and share by participant name."""
+    view = stream_ledger(path)
+    records = view["participants"]
+    return {
+        "currency": view["currency"],
+        "total": view["total"],
+        "paid": {p["name"]: view["paid"][p["id"]] for p in records},
+        "share": {p["name"]: view["share"][p["id"]] for p in records},
+    }
+
+
+class EventBalances:
+    """``event_totals`` of event files, computed once per version of each file.
+
+    With ``path`` the entries are also read from and saved to that JSON file.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self.path = path
+        self.entries = {}
+        self.lookups = Lookups()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.entries = {key: (tuple(token), totals) for key, (token, totals) in json.load(f).items()}
+
+    def get(self, event_path):
+        key = os.path.abspath(event_path)
+        token = file_id(os.stat(event_path))
+        with self._lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] == token
+            self.lookups.count(hit)
+            if hit:
+                return entry[1]
+        totals = event_totals(event_path)
+        with self._lock:
+            self.entries[key] = (token, totals)
+        return totals
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            payload = json.dumps({key: [list(token), totals] for key, (token, totals) in self.entries.items()})
+        install(write_temp(self.path, payload.encode())[0], self.path)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.lookups.stats(), entries=len(self.entries))
+
+
+def net_report(paths, balances=None, method="greedy", budget=None, **options):
+    """The /api/report body for the events in ``paths`` taken together, plus per-event totals under "events".
+
+    ``balances`` is the ``EventBalances`` to read through; ``options`` go to
+    ``build_report``. ValueError if the events use different currencies or
+    have nobody in them.
+    """
+    if balances is None:
+        balances = EventBalances()
+    paid = {}
+    share = {}
+    total = 0
+    currency = None
+    events = []
+    for path in paths:
+        event = balances.get(path)
+        if currency is not None and event["currency"] != currency:
+            raise ValueError("events use different currencies: %s and %s" % (currency, event["currency"]))
+        currency = event["currency"]
+        for name, units in event["paid"].items():
+            paid[name] = paid.get(name, 0) + units
+        for name, units in event["share"].items():
+            share[name] = share.get(name, 0) + units
+            paid.setdefault(name, 0)
+        total += event["total"]
+        events.append((os.path.basename(path), event["total"]))
+    if not paid:
+        raise ValueError("no participants in these events")
+    digits = precision(currency)
+    report = build_report(list(paid), paid, share, total, digits, method=method, budget=budget, **options)
+    report["currency"] = currency
+    report["events"] = [{"file": name, "total": from_minor(units, digits)} for name, units in events]
+    return report
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    method = "greedy"
+    cache = None
+    paths = []
+    for arg in argv:
+        if arg.startswith("--method="):
+            method = arg[len("--method="):]
+        elif arg.startswith("--cache="):
+            cache = arg[len("--cache="):]
+        else:
+            paths.append(arg)
+    if not paths or method not in METHODS:
+        print("usage: python -m storage.netting [--method=%s] [--cache=FILE] EVENT_JSON..." % "|".join(METHODS),
+              file=sys.stderr)
+        return 2
+    for path in paths:
+        if not os.path.exists(path):
+            print("no such file: %s" % path, file=sys.stderr)
+            return 1
+    balances = EventBalances(cache)
+    try:
+        report = net_report(paths, balances, method)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    balances.save()
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# Participant records and the ids expenses refer to them by.
+#
+# ``data["participants"]`` lists the current participants, in display order, as
+# ``{"id": int, "name": str}`` records. Expenses store the payer's id and the
+# ids of the people they are split among, so renaming someone touches one
+# record. People who left keep their record in ``data["former_participants"]``:
+# older expenses may still list them in a split, and if the same name is added
+# back it gets its old id, which brings those splits back to life exactly as
+# the name-based format did.
+#
+# Mutation records and the API still speak names; ``expense_ids`` and
+# ``named_expense`` convert at that edge. Datasets written with names are
+# upgraded by ``upgrade_participants`` when loaded.
+from settlement.splits import members
+
+
+def names_by_id(data):
+    """id -> name for current and former participants."""
+    names = {p["id"]: p["name"] for p in data.get("former_participants", [])}
+    names.update((p["id"], p["name"]) for p in data.get("participants", []))
+    return names
+
+
+def active_names(data):
+    return [p["name"] for p in data.get("participants", [])]
+
+
+def name_rank(records):
+    """id -> position in name order; uneven splits hand remainder units out in this order."""
+    ordered = sorted(records, key=lambda p: (p["name"], p["id"]))
+    return {p["id"]: n for n, p in enumerate(ordered)}
+
+
+def find(data, name):
+    """Id of the participant called ``name``: a current one first, else the latest former one."""
+    for p in data.get("participants", []):
+        if p["name"] == name:
+            return p["id"]
+    for p in reversed(data.get("former_participants", [])):
+        if p["name"] == name:
+            return p["id"]
+    return None
+
+
+def _next_id(data):
+    ids = [p["id"] for p in data.get("participants", [])]
+    ids.extend(p["id"] for p in data.get("former_participants", []))
+    return max(ids, default=0) + 1
+
+
+class _Claims:
+    """Name -> id lookups that give names never seen before a former-participant record."""
+
+    def __init__(self, data):
+        self.data = data
+        self.ids = {p["name"]: p["id"] for p in data.get("former_participants", [])}
+        self.ids.update((p["name"], p["id"]) for p in data.get("participants", []))
+        self.next = _next_id(data)
+        self.new = []
+
+    def __call__(self, name):
+        pid = self.ids.get(name)
+        if pid is None:
+            pid = self.ids[name] = self.next
+            self.next += 1
+            self.new.append({"id": pid, "name": name})
+        return pid
+
+    def expense(self, e):
+        payer = e.get("payer")
+        split = e.get("split")
+        named_payer = isinstance(payer, str)
+        named_split = isinstance(split, list) and any(isinstance(s, str) for s in split)
+        if not named_payer and not named_split:
+            return e
+        e = dict(e)
+        if named_payer:
+            e["payer"] = self(payer)
+        if named_split:
+            e["split"] = [self(s) if isinstance(s, str) else s for s in split]
+        return e
+
+    def finish(self):
+        if self.new:
+            self.data["former_participants"] = self.data.get("former_participants", []) + self.new
+
+
+def set_active(data, names):
+    """Make ``names`` the current participants, reusing the ids those names had."""
+    current = {p["name"]: p for p in data.get("participants", [])}
+    former = list(data.get("former_participants", []))
+    next_id = _next_id(data)
+    active = []
+    for name in names:
+        record = current.pop(name, None)
+        if record is None:
+            for n in range(len(former) - 1, -1, -1):
+                if former[n]["name"] == name:
+                    record = former.pop(n)
+                    break
+            else:
+                record = {"id": next_id, "name": name}
+                next_id += 1
+        active.append(record)
+    # whoever is left over becomes a former participant
+    data["former_participants"] = former + list(current.values())
+    data["participants"] = active
+
+
+def expense_ids(data, e):
+    """``e`` with payer and split given as ids; names (from the API or old files) are resolved."""
+    claims = _Claims(data)
+    e = claims.expense(e)
+    claims.finish()
+    return e
+
+
+def named_expense(e, names):
+    """``e`` with payer and split given as names, for the API."""
+    e = dict(e)
+    if e.get("payer") in names:
+        e["payer"] = names[e["payer"]]
+    split = members(e.get("split"))
+    if isinstance(split, list):
+        e["split"] = [names.get(s, s) for s in split]
+    return e
+
+
+def upgrade_participants(data):
+    """Convert a dataset that refers to participants by name; returns whether it did."""
+    if "former_participants" in data:
+        return False
+    parts = data.get("participants", [])
+    seen = set()
+    records = []
+    for p in parts:
+        # the name-based format allowed duplicate names; they were one person there too
+        if isinstance(p, str) and p not in seen:
+            seen.add(p)
+            records.append({"id": len(records) + 1, "name": p})
+    data["participants"] = records
+    data["former_participants"] = []
+    claims = _Claims(data)
+    data["expenses"] = [claims.expense(e) for e in data.get("expenses", [])]
+    claims.finish()
+    return True
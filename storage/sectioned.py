@@ -0,0 +1,179 @@
+# Sectioned dataset: settings, participants, expenses and the running totals
+# (``storage.ledger``) in separate files.
+#
+# A dataset lives in a directory. ``manifest.json`` names the file holding
+# each section:
+#
+#   {"version": 1, "serial": 7, "sections": {"settings": "settings-7.json",
+#                                            "participants": "participants-3.json",
+#                                            "expenses": "expenses-6.json",
+#                                            "ledger": "ledger-6.json"}}
+#
+# Section files are written once and never modified; a save writes new files
+# only for the sections that changed and then swaps the manifest with a rename.
+# Readers decode just the sections they ask for, and keep decoded sections
+# keyed by file name, so a section stays cached until a save replaces it.
+import json
+import os
+import threading
+
+from . import ledger
+from .base import Storage, empty_data, normalize
+from .cache import Lookups, file_id
+from .chunks import to_json
+from .locks import StorageLocks, install, write_temp
+from .participants import active_names, names_by_id
+
+SECTIONS = ("settings", "participants", "expenses", "ledger")
+PARTICIPANT_KEYS = ("participants", "former_participants")
+KNOWN_KEYS = PARTICIPANT_KEYS + ("expenses", "ledger")
+VERSION = 1
+
+
+def split_sections(data):
+    """Split a dataset into its sections; top-level keys other than the lists travel with settings."""
+    return {
+        "settings": {k: v for k, v in data.items() if k not in KNOWN_KEYS},
+        "participants": {k: data.get(k, []) for k in PARTICIPANT_KEYS},
+        "expenses": data.get("expenses", []),
+        "ledger": data.get("ledger"),
+    }
+
+
+def join_sections(sections):
+    data = dict(sections["settings"])
+    data.setdefault("event", "")
+    data.setdefault("currency", "CAD")
+    data.update(sections["participants"])
+    data["expenses"] = sections["expenses"]
+    data["ledger"] = sections["ledger"]
+    return data
+
+
+class SectionedStorage(Storage):
+    """Dataset split into independently loadable and writable sections.
+
+    ``settings`` decodes only the settings section, ``participants`` only
+    the participant list and ``ledger`` skips the expenses as well; expenses
+    are parsed only by endpoints that need them. A commit rewrites only the sections whose contents changed:
+    mutation records are copy-on-write, so an untouched section is still the
+    very object that was loaded and is recognised by identity.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.locks = StorageLocks(path)
+        self._lock = threading.Lock()
+        self._manifest = None  # (manifest identity, manifest)
+        self._sections = {}  # file name -> decoded section
+        self.lookups = Lookups()
+        os.makedirs(path, exist_ok=True)
+
+    def _read(self, names):
+        """Decode the named sections of the current dataset; returns (manifest, {section: value})."""
+        with self._lock, self.locks.read():
+            try:
+                with open(self.manifest_path, "rb") as f:
+                    key = file_id(os.fstat(f.fileno()))
+                    if self._manifest is None or self._manifest[0] != key:
+                        manifest = json.loads(f.read())
+                        if manifest.get("version") != VERSION:
+                            raise ValueError("unsupported sectioned dataset version %r" % (manifest.get("version"),))
+                        self._manifest = (key, manifest)
+            except FileNotFoundError:
+                self._manifest = None
+                self._sections = {}
+                return None, split_sections(empty_data())
+            manifest = self._manifest[1]
+            files = manifest["sections"]
+            # drop sections a newer manifest no longer references
+            for fname in set(self._sections) - set(files.values()):
+                del self._sections[fname]
+            result = {}
+            hit = True
+            for name in names:
+                value = self._sections.get(files[name])
+                if value is None:
+                    hit = False
+                    value = self._decode(files, name)
+                result[name] = value
+            self.lookups.count(hit)
+            return manifest, result
+
+    def _decode(self, files, name):
+        with open(os.path.join(self.path, files[name]), "rb") as f:
+            value = self._sections[files[name]] = json.loads(f.read())
+        return value
+
+    def load(self):
+        _, sections = self._read(SECTIONS)
+        return join_sections(sections)
+
+    def participants(self):
+        return active_names(self._read(("participants",))[1]["participants"])
+
+    def participant_names(self):
+        return names_by_id(self._read(("participants",))[1]["participants"])
+
+    def ledger(self):
+        s = self._read(("settings", "participants", "ledger"))[1]
+        data = {"participants": s["participants"]["participants"], "currency": s["settings"].get("currency", "CAD")}
+        return ledger.view(data, s["ledger"])
+
+    def settings(self):
+        s = self._read(("settings",))[1]["settings"]
+        return {"event": s.get("event", ""), "currency": s.get("currency", "CAD")}
+
+    def version(self):
+        try:
+            return self.revision, file_id(os.stat(self.manifest_path))
+        except FileNotFoundError:
+            return None
+
+    def save(self, data):
+        with self.locks.write():
+            manifest, current = self._read(SECTIONS)
+            self._write(manifest, current, split_sections(normalize(dict(data))))
+
+    def commit_batch(self, ops):
+        with self.locks.write():
+            return super().commit_batch(ops)
+
+    def _write(self, manifest, current, sections):
+        serial = manifest["serial"] + 1 if manifest else 1
+        files = dict(manifest["sections"]) if manifest else {}
+        written = {}
+        for name in SECTIONS:
+            value = sections[name]
+            if manifest is not None and (value is current[name] or value == current[name]):
+                continue
+            fname = "%s-%d.json" % (name, serial)
+            tmp, _ = write_temp(os.path.join(self.path, fname), json.dumps(value, separators=(",", ":"), default=to_json).encode())
+            install(tmp, os.path.join(self.path, fname))
+            files[name] = fname
+            written[fname] = value
+        if not written:
+            return
+        manifest = {"version": VERSION, "serial": serial, "sections": files}
+        tmp, st = write_temp(self.manifest_path, json.dumps(manifest).encode())
+        with self.locks.swap():
+            install(tmp, self.manifest_path)
+            # no reader is inside _read now, and the next one sees the new manifest
+            live = set(files.values()) | {"manifest.json"}
+            for entry in os.listdir(self.path):
+                if entry not in live:
+                    try:
+                        os.remove(os.path.join(self.path, entry))
+                    except FileNotFoundError:
+                        pass
+        with self._lock:
+            self._manifest = (file_id(st), manifest)
+            self._sections = {f: v for f, v in self._sections.items() if f in live}
+            self._sections.update(written)
+            self.revision += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.lookups.stats(), revision=self.revision)
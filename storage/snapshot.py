@@ -0,0 +1,26 @@
+# Snapshot codecs used by the file-backed engines: bytes <-> dataset dict.
+import json
+
+from . import binary
+from .chunks import to_json
+
+
+def encode_json(data):
+    return json.dumps(data, indent=2, default=to_json).encode()
+
+
+def decode_json(raw):
+    return json.loads(raw)
+
+
+FORMATS = {
+    "json": (encode_json, decode_json),
+    "binary": (binary.encode, binary.decode),
+}
+
+
+def codec(name):
+    try:
+        return FORMATS[name]
+    except KeyError:
+        raise ValueError("unknown snapshot format %r (expected one of: %s)" % (name, ", ".join(sorted(FORMATS))))
@@ -0,0 +1,533 @@
+import sqlite3
+import threading
+
+from settlement.money import precision, rescale_minor
+from settlement.splits import compact, members
+
+from . import ledger
+from . import participants as parts
+from .amounts import rounding_error, upgrade_expense
+from .base import Storage, empty_data, normalize
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (
+    id INTEGER PRIMARY KEY,
+    active INTEGER NOT NULL DEFAULT 1,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS participants_name ON participants(name);
+CREATE INDEX IF NOT EXISTS participants_position ON participants(active, position);
+
+CREATE TABLE IF NOT EXISTS expenses (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    payer_id INTEGER,
+    amount_minor INTEGER NOT NULL DEFAULT 0,
+    description TEXT,
+    date TEXT
+);
+CREATE INDEX IF NOT EXISTS expenses_payer ON expenses(payer_id);
+
+CREATE TABLE IF NOT EXISTS expense_splits (
+    expense_seq INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    participant_id INTEGER NOT NULL,
+    PRIMARY KEY (expense_seq, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS expense_splits_participant ON expense_splits(participant_id);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS ledger (
+    participant_id INTEGER PRIMARY KEY,
+    paid INTEGER NOT NULL DEFAULT 0,
+    share INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS ledger_days (
+    day INTEGER NOT NULL,
+    participant_id INTEGER NOT NULL,
+    paid INTEGER NOT NULL DEFAULT 0,
+    share INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, participant_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS ledger_plan (
+    position INTEGER PRIMARY KEY,
+    payer_id INTEGER NOT NULL,
+    payee_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS writes (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    count INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO writes (id, count) VALUES (0, 0)
+"""
+# ledger row for expenses without a payer, so that the group total (and a day's) is SUM(paid)
+NO_PAYER = 0
+
+EXPENSE_COLUMNS = "seq, id, payer_id, amount_minor, description, date"
+
+
+class SqliteStorage(Storage):
+    """Row-level store: each mutation touches only the rows it changes.
+
+    The database runs in WAL mode so readers never wait for a writer, and
+    commits are synced so an acknowledged write survives power loss. One
+    connection is kept per thread since sqlite3 connections are not shareable.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.create_function("rescale_minor", 3, rescale_minor, deterministic=True)
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # executescript would commit first; run the statements inside this transaction
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+            conn.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # -- reads ---------------------------------------------------------------
+
+    def participants(self):
+        rows = self._connect().execute("SELECT name FROM participants WHERE active ORDER BY position, id")
+        return [r[0] for r in rows]
+
+    def participant_names(self):
+        return dict(self._connect().execute("SELECT id, name FROM participants"))
+
+    def _participant_data(self, conn):
+        data = {"participants": [], "former_participants": []}
+        for pid, active, name in conn.execute(
+                "SELECT id, active, name FROM participants ORDER BY position, id"):
+            data["participants" if active else "former_participants"].append({"id": pid, "name": name})
+        return data
+
+    def settings(self):
+        d = {"event": '', "currency": 'CAD'}
+        for key, value in self._connect().execute("SELECT key, value FROM settings"):
+            d[key] = value
+        return d
+
+    def ledger(self):
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            records = self._participant_data(conn)["participants"]
+            currency = self.settings()["currency"]
+            rows = conn.execute("SELECT participant_id, paid, share FROM ledger").fetchall()
+            plan = self._plan(conn)
+            days = self._days(conn)
+        finally:
+            conn.execute("COMMIT")
+        return {
+            "participants": records,
+            "currency": currency,
+            "paid": {pid: paid for pid, paid, _ in rows if pid != NO_PAYER},
+            "share": {pid: share for pid, _, share in rows if pid != NO_PAYER},
+            "total": sum(paid for _, paid, _ in rows),
+            "plan": plan,
+            "days": days,
+        }
+
+    def _plan(self, conn):
+        return [list(r) for r in conn.execute("SELECT payer_id, payee_id, amount FROM ledger_plan ORDER BY position")]
+
+    def _ledger_dict(self, conn, records, count):
+        rows = conn.execute("SELECT participant_id, paid, share FROM ledger").fetchall()
+        return ledger.make(
+            records, sum(paid for _, paid, _ in rows), count,
+            {pid: paid for pid, paid, _ in rows if pid != NO_PAYER},
+            {pid: share for pid, _, share in rows if pid != NO_PAYER},
+            self._plan(conn), self._days(conn))
+
+    def _days(self, conn):
+        # the ledger's ``days``: a day's total is the sum of its rows, the no-payer row included
+        days = []
+        for day, pid, paid, share in conn.execute(
+                "SELECT day, participant_id, paid, share FROM ledger_days ORDER BY day, participant_id"):
+            if not days or days[-1][0] != day:
+                days.append([day, 0, []])
+            days[-1][1] += paid
+            if pid != NO_PAYER:
+                days[-1][2].append([pid, paid, share])
+        return days
+
+    def _split(self, conn, seq):
+        rows = conn.execute(
+            "SELECT participant_id FROM expense_splits WHERE expense_seq = ? ORDER BY position", (seq,))
+        return [r[0] for r in rows]
+
+    def get_expense(self, eid):
+        conn = self._connect()
+        row = conn.execute("SELECT %s FROM expenses WHERE id = ?" % EXPENSE_COLUMNS, (eid,)).fetchone()
+        if row is None:
+            return None
+        return _expense_from_row(row, self._split(conn, row[0]))
+
+    def load(self):
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            data = empty_data()
+            data.update(self.settings())
+            data.update(self._participant_data(conn))
+            splits = {}
+            for seq, pid in conn.execute(
+                    "SELECT expense_seq, participant_id FROM expense_splits ORDER BY expense_seq, position"):
+                splits.setdefault(seq, []).append(pid)
+            data["expenses"] = [
+                _expense_from_row(row, splits.get(row[0], []))
+                for row in conn.execute("SELECT %s FROM expenses ORDER BY seq" % EXPENSE_COLUMNS)
+            ]
+            data["ledger"] = self._ledger_dict(conn, data["participants"], len(data["expenses"]))
+        finally:
+            conn.execute("COMMIT")
+        return data
+
+    # -- writes --------------------------------------------------------------
+
+    def save(self, data):
+        data = normalize(dict(data))
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM expense_splits")
+            conn.execute("DELETE FROM expenses")
+            conn.execute("DELETE FROM settings")
+            self._write_all(conn, data)
+            self._count_write(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self.revision += 1
+
+    def _write_all(self, conn, data):
+        # into emptied expense tables
+        self._put_participants(conn, data)
+        self._put_settings(conn, data.get("event"), data.get("currency"))
+        for e in data["expenses"]:
+            self._insert_expense(conn, e)
+        self._put_ledger(conn, data["ledger"])
+
+    # -- ledger (see storage.ledger) -------------------------------------------
+
+    def _put_ledger(self, conn, value):
+        conn.execute("DELETE FROM ledger")
+        conn.executemany("INSERT INTO ledger (participant_id, paid, share) VALUES (?, ?, ?)", value["rows"])
+        unpaid = value["total"] - sum(paid for _, paid, _ in value["rows"])
+        if unpaid:
+            conn.execute("INSERT INTO ledger (participant_id, paid) VALUES (?, ?)", (NO_PAYER, unpaid))
+        self._put_plan(conn, value["plan"])
+        self._put_days(conn, value["days"])
+
+    def _put_days(self, conn, days):
+        conn.execute("DELETE FROM ledger_days")
+        for day, total, rows in days:
+            conn.executemany("INSERT INTO ledger_days (day, participant_id, paid, share) VALUES (?, ?, ?, ?)",
+                             ((day, pid, paid, share) for pid, paid, share in rows))
+            unpaid = total - sum(paid for _, paid, _ in rows)
+            if unpaid:
+                conn.execute("INSERT INTO ledger_days (day, participant_id, paid) VALUES (?, ?, ?)",
+                             (day, NO_PAYER, unpaid))
+
+    def _put_plan(self, conn, plan):
+        conn.execute("DELETE FROM ledger_plan")
+        conn.executemany("INSERT INTO ledger_plan (position, payer_id, payee_id, amount) VALUES (?, ?, ?, ?)",
+                         ((n, f, t, amount) for n, (f, t, amount) in enumerate(plan)))
+
+    def _ledger_data(self, conn):
+        # the participants and what the ledger needs of every expense
+        data = self._participant_data(conn)
+        splits = {}
+        for seq, pid in conn.execute(
+                "SELECT expense_seq, participant_id FROM expense_splits ORDER BY expense_seq, position"):
+            splits.setdefault(seq, []).append(pid)
+        data["expenses"] = [
+            {"payer": payer, "amount_minor": amount, "split": splits.get(seq, []), "date": date}
+            for seq, payer, amount, date in conn.execute("SELECT seq, payer_id, amount_minor, date FROM expenses")]
+        return data
+
+    def _rebuild_ledger(self, conn):
+        # participants changed: every split among them may share out differently
+        self._put_ledger(conn, ledger.build(self._ledger_data(conn)))
+
+    def _update_ledger(self, conn, added=(), removed=()):
+        records = self._participant_data(conn)["participants"]
+        changes = _ledger_changes(*ledger.deltas(records, added, removed)[:2])
+        conn.executemany(
+            "INSERT INTO ledger (participant_id, paid, share) VALUES (?, ?, ?) ON CONFLICT(participant_id) "
+            "DO UPDATE SET paid = paid + excluded.paid, share = share + excluded.share",
+            ((pid, paid, share) for pid, (paid, share) in changes.items() if paid or share))
+        for day, (d_paid, d_share, _) in ledger.day_deltas(records, added, removed).items():
+            changes = _ledger_changes(d_paid, d_share)
+            conn.executemany(
+                "INSERT INTO ledger_days (day, participant_id, paid, share) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(day, participant_id) DO UPDATE SET paid = paid + excluded.paid, "
+                "share = share + excluded.share",
+                ((day, pid, paid, share) for pid, (paid, share) in changes.items() if paid or share))
+            conn.execute("DELETE FROM ledger_days WHERE day = ? AND paid = 0 AND share = 0", (day,))
+        # the issued plan follows the new balances
+        rows = conn.execute("SELECT participant_id, paid, share FROM ledger").fetchall()
+        self._put_plan(conn, ledger.plan(
+            records, {pid: paid for pid, paid, _ in rows}, {pid: share for pid, _, share in rows}, self._plan(conn)))
+
+    def _expenses_where(self, conn, where, params=()):
+        rows = conn.execute("SELECT %s FROM expenses WHERE %s" % (EXPENSE_COLUMNS, where), params).fetchall()
+        return [_expense_from_row(row, self._split(conn, row[0])) for row in rows]
+
+    def commit_batch(self, ops):
+        # one transaction for the whole batch; a savepoint per record isolates failures
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        results = []
+        try:
+            for op in ops:
+                conn.execute("SAVEPOINT op")
+                try:
+                    handler = getattr(self, "_op_" + op["op"], None)
+                    if handler is None:
+                        raise ValueError("unknown mutation: %r" % (op.get("op"),))
+                    results.append(handler(conn, op))
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO op")
+                    results.append(exc)
+                conn.execute("RELEASE op")
+            self._count_write(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self.revision += 1
+        return results
+
+    def _count_write(self, conn):
+        conn.execute("UPDATE writes SET count = count + 1")
+
+    def version(self):
+        # every save and batch bumps the counter in its own transaction, so any connection reads the same value
+        return self.revision, self._connect().execute("SELECT count FROM writes").fetchone()[0]
+
+    def _digits(self, conn):
+        row = conn.execute("SELECT value FROM settings WHERE key = 'currency'").fetchone()
+        return precision(row[0] if row else "CAD")
+
+    def _put_participants(self, conn, data):
+        # the participant list is short; rewriting it keeps positions dense
+        conn.execute("DELETE FROM participants")
+        for active, key in ((1, "participants"), (0, "former_participants")):
+            conn.executemany(
+                "INSERT INTO participants (id, active, position, name) VALUES (?, ?, ?, ?)",
+                ((p["id"], active, n, p["name"]) for n, p in enumerate(data.get(key, []))))
+
+    def _expense_ids(self, conn, e):
+        """``e`` with names resolved to participant ids; names never seen get a former-participant row."""
+        data = self._participant_data(conn)
+        known = len(data["former_participants"])
+        e = parts.expense_ids(data, e)
+        conn.executemany(
+            "INSERT INTO participants (id, active, position, name) VALUES (?, 0, ?, ?)",
+            ((p["id"], n, p["name"]) for n, p in enumerate(data["former_participants"][known:], known)))
+        return e
+
+    def _insert_expense(self, conn, e):
+        """Insert ``e``; returns it as stored, with minor units and participant ids."""
+        if "amount_minor" not in e:
+            # a restored item, as the API sent it, with a float amount
+            e = upgrade_expense(e, self._digits(conn))
+        e = self._expense_ids(conn, e)
+        cur = conn.execute(
+            "INSERT INTO expenses (id, payer_id, amount_minor, description, date) VALUES (?, ?, ?, ?, ?)",
+            (e.get("id"), e.get("payer"), e.get("amount_minor", 0), e.get("description"), e.get("date")))
+        self._insert_split(conn, cur.lastrowid, e.get("split"))
+        return e
+
+    def _insert_split(self, conn, seq, split):
+        conn.executemany(
+            "INSERT INTO expense_splits (expense_seq, position, participant_id) VALUES (?, ?, ?)",
+            ((seq, idx, pid) for idx, pid in enumerate(members(split) or [])))
+
+    def _delete_expenses_where(self, conn, where, params=()):
+        conn.execute(
+            "DELETE FROM expense_splits WHERE expense_seq IN (SELECT seq FROM expenses WHERE %s)" % where, params)
+        conn.execute("DELETE FROM expenses WHERE %s" % where, params)
+
+    def _put_settings(self, conn, event, currency):
+        for key, value in (("event", event), ("currency", currency)):
+            if value is not None:
+                conn.execute(
+                    "INSERT INTO settings (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, str(value)))
+
+    def _op_set_participants(self, conn, op):
+        data = self._participant_data(conn)
+        parts.set_active(data, op["names"])
+        self._put_participants(conn, data)
+        # as in mutations: expenses paid by someone no longer listed go too
+        self._delete_expenses_where(
+            conn, "payer_id IS NULL OR payer_id NOT IN (SELECT id FROM participants WHERE active)")
+        self._rebuild_ledger(conn)
+        return list(op["names"])
+
+    def _op_add_expense(self, conn, op):
+        self._update_ledger(conn, added=[self._insert_expense(conn, op["expense"])])
+        return True
+
+    def _op_edit_expense(self, conn, op):
+        e = op["expense"]
+        if "amount_minor" not in e:
+            e = upgrade_expense(e, self._digits(conn))
+        row = conn.execute("SELECT %s FROM expenses WHERE id = ?" % EXPENSE_COLUMNS, (e.get("id"),)).fetchone()
+        if row is None:
+            return False
+        old = _expense_from_row(row, self._split(conn, row[0]))
+        e = self._expense_ids(conn, e)
+        conn.execute(
+            "UPDATE expenses SET payer_id = ?, amount_minor = ?, description = ?, date = ? WHERE seq = ?",
+            (e.get("payer"), e.get("amount_minor", 0), e.get("description"), e.get("date"), row[0]))
+        conn.execute("DELETE FROM expense_splits WHERE expense_seq = ?", (row[0],))
+        self._insert_split(conn, row[0], e.get("split"))
+        self._update_ledger(conn, added=[e], removed=[old])
+        return True
+
+    def _op_delete_expense(self, conn, op):
+        removed = self._expenses_where(conn, "id = ?", (op["id"],))
+        if not removed:
+            return False
+        self._delete_expenses_where(conn, "id = ?", (op["id"],))
+        self._update_ledger(conn, removed=removed)
+        return True
+
+    def _op_rename_participant(self, conn, op):
+        before = parts.name_rank(self._participant_data(conn)["participants"])
+        # the first active match only (see mutations); expenses refer to the id, so this is the only row that changes
+        conn.execute(
+            "UPDATE participants SET name = ? WHERE id = "
+            "(SELECT id FROM participants WHERE active AND name = ? ORDER BY position, id LIMIT 1)",
+            (op["new"], op["old"]))
+        if parts.name_rank(self._participant_data(conn)["participants"]) != before:
+            # remainder units go out in name order
+            self._rebuild_ledger(conn)
+        return self.participants()
+
+    def _op_delete_participant(self, conn, op):
+        data = self._participant_data(conn)
+        ids = [p["id"] for p in data["participants"] if p["name"] == op["name"]]
+        # their ids stay reserved as former participants: older splits may still list them
+        conn.executemany(
+            "UPDATE participants SET active = 0, position = ? WHERE id = ?",
+            ((n, pid) for n, pid in enumerate(ids, len(data["former_participants"]))))
+        # remove expenses by that participant
+        conn.executemany("DELETE FROM expense_splits WHERE expense_seq IN "
+                         "(SELECT seq FROM expenses WHERE payer_id = ?)", ((pid,) for pid in ids))
+        conn.executemany("DELETE FROM expenses WHERE payer_id = ?", ((pid,) for pid in ids))
+        self._rebuild_ledger(conn)
+        return self.participants()
+
+    def _has_expense(self, conn, eid):
+        return conn.execute("SELECT 1 FROM expenses WHERE id = ?", (eid,)).fetchone() is not None
+
+    def _op_restore_expense(self, conn, op):
+        e = op["expense"]
+        if self._has_expense(conn, e.get("id")):
+            return False
+        self._update_ledger(conn, added=[self._insert_expense(conn, e)])
+        return True
+
+    def _op_restore_participant(self, conn, op):
+        name = op["name"]
+        data = self._participant_data(conn)
+        names = parts.active_names(data)
+        joined = name not in names
+        if joined:
+            parts.set_active(data, names + [name])
+            self._put_participants(conn, data)
+        added = []
+        for e in op.get("expenses", []):
+            if not self._has_expense(conn, e.get("id")):
+                added.append(self._insert_expense(conn, e))
+        if joined:
+            self._rebuild_ledger(conn)
+        else:
+            self._update_ledger(conn, added=added)
+        return self.participants()
+
+    def _op_settings(self, conn, op):
+        if op.get("currency") is not None:
+            # amounts.rescale_expenses, in SQL
+            old, new = self._digits(conn), precision(str(op["currency"]))
+            if new < old:
+                rounded = conn.execute("SELECT COUNT(*) FROM expenses WHERE amount_minor % ?",
+                                       (10 ** (old - new),)).fetchone()[0]
+                if rounded:
+                    raise rounding_error(rounded, str(op["currency"]))
+            if old != new:
+                conn.execute("UPDATE expenses SET amount_minor = rescale_minor(amount_minor, ?, ?)", (old, new))
+                self._rebuild_ledger(conn)
+        self._put_settings(conn, op.get("event"), op.get("currency"))
+        return self.settings()
+
+
+def _expense_from_row(row, split):
+    _seq, eid, payer, amount, description, date = row
+    # one row per member; long splits come back in the compact form the other engines store
+    return {"id": eid, "payer": payer, "amount_minor": amount, "description": description, "date": date,
+            "split": compact(split)}
+
+
+def _ledger_changes(d_paid, d_share):
+    # {participant id: [paid, share]} to add to ledger rows, from ``storage.ledger.deltas``
+    changes = {}
+    for pid, units in d_paid.items():
+        changes[NO_PAYER if pid is None else pid] = [units, 0]
+    for pid, units in d_share.items():
+        changes.setdefault(pid, [0, 0])[1] += units
+    return changes
+
+
+def import_json(json_path, db_path):
+    """One-shot migration of an existing data.json into a SQLite database."""
+    from .json_store import JsonStorage
+
+    data = JsonStorage(json_path).load()
+    store = SqliteStorage(db_path)
+    try:
+        store.save(data)
+    finally:
+        store.close()
+    return data
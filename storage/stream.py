@@ -0,0 +1,226 @@
+# Report totals of a JSON snapshot read one expense at a time.
+#
+#   python -m storage.stream archive.json [METHOD]
+#
+# ``events`` walks the top-level object of a data.json file and yields
+# ``(key, value)`` for each member, except that the records of the expense
+# list come one by one as ``("expense", record)``. Values are decoded with
+# ``json.JSONDecoder.raw_decode`` from a text buffer refilled in chunks and
+# trimmed as it is consumed, so memory stays at about one chunk plus the
+# largest single value however many expenses the file holds.
+# ``stream_ledger`` folds the records into report totals as they arrive;
+# the command prints the report of an archived event without loading it.
+import codecs
+import json
+import os
+import re
+import sys
+
+from settlement import METHODS, build_report, fold_expenses, precision
+
+from .amounts import upgrade_expense
+from .participants import name_rank
+
+CHUNK = 1 << 16
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        # drop what has been consumed, then append up to ``size`` more bytes
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        raw = self.f.read(size)
+        self.eof = not raw
+        self.buf += self.utf8.decode(raw, final=self.eof)
+
+    def peek(self):
+        """The next character that isn't whitespace, '' at the end of the file."""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill(self.chunk_size)
+
+    def expect(self, chars):
+        ch = self.peek()
+        if not ch or ch not in chars:
+            raise ValueError("expected one of %r at character %d of the buffer, found %r" % (chars, self.pos, ch))
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # a number running into the end of the buffer may go on in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            # the value runs past the buffer; read more, twice as much each time
+            self.fill(size)
+            size *= 2
+
+
+def events(f, chunk_size=CHUNK):
+    """(key, value) for each member of the JSON object in binary file ``f``; see the module comment."""
+    r = _Reader(f, chunk_size)
+    r.expect("{")
+    if r.peek() == "}":
+        return
+    while True:
+        key = r.value()
+        r.expect(":")
+        if key == "expenses" and r.peek() == "[":
+            r.pos += 1
+            if r.peek() == "]":
+                r.pos += 1
+            else:
+                while True:
+                    yield "expense", r.value()
+                    if r.expect(",]") == "]":
+                        break
+        else:
+            yield key, r.value()
+        if r.expect(",}") == "}":
+            return
+
+
+class _Restart(Exception):
+    pass
+
+
+def _people(head):
+    """(participant records, keys the expenses use for them, remainder rank)."""
+    parts = head.get("participants", [])
+    if all(isinstance(p, dict) for p in parts):
+        return parts, [p["id"] for p in parts], name_rank(parts)
+    # a file from before participant ids: expenses name people, and names sort as they would by id
+    names = list(dict.fromkeys(p for p in parts if isinstance(p, str)))
+    return [{"id": n + 1, "name": name} for n, name in enumerate(names)], names, None
+
+
+def _expenses(stream, first, head, digits):
+    # the expense records, upgraded as storage.base.normalize would; other members go into ``head``
+    pending = [first]
+    while True:
+        for e in pending:
+            if "amount_minor" not in e:
+                if digits is None:
+                    raise _Restart()
+                e = upgrade_expense(e, digits)
+            if type(e.get("amount_minor", 0)) is not int:
+                e = dict(e, amount_minor=0)
+            yield e
+        pending = []
+        for key, value in stream:
+            if key == "expense":
+                pending = [value]
+                break
+            head[key] = value
+        else:
+            return
+
+
+def _fold(path, chunk_size, head, complete):
+    # ``complete``: ``head`` already holds every member but the expenses (a second pass)
+    with open(path, "rb") as f:
+        stream = events(f, chunk_size)
+        first = None
+        for key, value in stream:
+            if key == "expense":
+                first = value
+                break
+            if not complete:
+                head[key] = value
+        records, keys, rank = _people(head)
+        paid = {k: 0 for k in keys}
+        share = {k: 0 for k in keys}
+        total = 0
+        if first is not None:
+            if not complete and "participants" not in head:
+                raise _Restart()
+            digits = precision(head.get("currency", "CAD")) if complete or "currency" in head else None
+            if keys:
+                paid = _AnyPayer(paid)
+                total = fold_expenses(paid, share, keys, _expenses(stream, first, head, digits), rank)
+            else:
+                for e in _expenses(stream, first, head, digits):
+                    total += e["amount_minor"]
+        for key, value in stream:
+            if key != "expense" and not complete:
+                head[key] = value
+    return records, keys, paid, share, total
+
+
+class _AnyPayer(dict):
+    # someone who has left, or a name no longer listed, still paid
+    def __missing__(self, key):
+        return 0
+
+
+def stream_ledger(path, chunk_size=CHUNK):
+    """What /api/report needs from the JSON snapshot at ``path``, in the shape of ``storage.ledger.view``.
+
+    Paid and share cover the current participants only; there is no plan and
+    no sums by day. Expenses are folded in as they are read. A file that lists
+    its expenses before the participants, or holds float amounts before the
+    currency, is read twice: once for everything but the expenses, then for them.
+    """
+    head = {}
+    try:
+        records, keys, paid, share, total = _fold(path, chunk_size, head, False)
+    except _Restart:
+        with open(path, "rb") as f:
+            head = {key: value for key, value in events(f, chunk_size) if key != "expense"}
+        records, keys, paid, share, total = _fold(path, chunk_size, head, True)
+    return {
+        "participants": records,
+        "currency": head.get("currency", "CAD"),
+        "paid": {p["id"]: paid.get(k, 0) for p, k in zip(records, keys)},
+        "share": {p["id"]: share.get(k, 0) for p, k in zip(records, keys)},
+        "total": total,
+    }
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (1, 2) or (len(argv) == 2 and argv[1] not in METHODS):
+        print("usage: python -m storage.stream DATA_JSON [%s]" % "|".join(METHODS), file=sys.stderr)
+        return 2
+    if not os.path.exists(argv[0]):
+        print("no such file: %s" % argv[0], file=sys.stderr)
+        return 1
+    view = stream_ledger(argv[0])
+    records = view["participants"]
+    if not records:
+        print("no participants in %s" % argv[0], file=sys.stderr)
+        return 1
+    report = build_report([p["name"] for p in records],
+                          {p["name"]: view["paid"][p["id"]] for p in records},
+                          {p["name"]: view["share"][p["id"]] for p in records},
+                          view["total"], precision(view["currency"]),
+                          method=argv[1] if len(argv) == 2 else "greedy")
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
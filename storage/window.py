@@ -0,0 +1,48 @@
+# Report totals for a range of dates.
+#
+# ``DateIndex`` keeps, for each day that has expenses, running sums of what
+# every participant paid and owes over all days up to and including it. The
+# totals between two dates are then the difference of two of those rows,
+# found by binary search: O(participants + log days) a query, however many
+# expenses the range covers.
+#
+# It is built from the ledger's sums by day (``days`` in ``storage.ledger``),
+# which the mutation records keep current, so building it is one pass over
+# the days and never over the expenses; /api/report keeps it until the
+# dataset changes. Expenses without an ISO date (YYYY-MM-DD) fall in no
+# range. Shares come out as they do in the ledger, so a range covering every
+# date gives the ledger's totals for the current participants.
+from bisect import bisect_left, bisect_right
+
+
+class DateIndex:
+    def __init__(self, view):
+        """The index of ``view``, what ``Storage.ledger`` returns."""
+        self.ids = [p["id"] for p in view["participants"]]
+        column = {pid: n for n, pid in enumerate(self.ids)}
+        width = len(self.ids)
+        self.days = [day for day, _, _ in view["days"]]
+        running = [0] * (2 * width + 1)
+        # prefix[k]: the sums over the first k days: paid by participant, share by participant, then the total
+        self.prefix = [running]
+        for _, total, rows in view["days"]:
+            running = list(running)
+            running[-1] += total
+            for pid, paid, share in rows:
+                n = column.get(pid)
+                if n is not None:
+                    running[n] += paid
+                    running[width + n] += share
+            self.prefix.append(running)
+
+    def totals(self, start=None, end=None):
+        """(paid by id, share by id, total) over expenses dated ``start`` to ``end`` inclusive, as ``date`` objects.
+
+        A bound left out is open.
+        """
+        lo = 0 if start is None else bisect_left(self.days, start.toordinal())
+        hi = len(self.days) if end is None else bisect_right(self.days, end.toordinal())
+        hi = max(lo, hi)
+        width = len(self.ids)
+        diff = [b - a for a, b in zip(self.prefix[lo], self.prefix[hi])]
+        return (dict(zip(self.ids, diff[:width])), dict(zip(self.ids, diff[width:2 * width])), diff[-1])
@@ -4,6 +4,7 @@ import pathlib
 import tempfile
 import json
 import unittest
+from unittest import mock
 
 # Ensure project root is on sys.path so `import app` succeeds when pytest runs from tests/
 ROOT = pathlib.Path(__file__).resolve().parents[1]
@@ -16,6 +17,7 @@ tmp.close()
 os.environ['GROUP_EXPENSE_DATA_FILE'] = DATA_PATH
 
 import app as app_module
+from storage import ledger
 
 
 class ApiTest(unittest.TestCase):
@@ -51,6 +53,16 @@ class ApiTest(unittest.TestCase):
         j = rv.get_json()
         self.assertTrue(j.get('ok'))
 
+    def test_restore_participant_without_expenses(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B', 'C']})
+        ids = [self.app.post('/api/expense', json={'payer': payer, 'amount': 1, 'date': '2025-01-01'})
+               .get_json()['expense']['id'] for payer in 'ABB']
+        self.assertEqual(self.app.delete('/api/participant/A').status_code, 200)
+        rv = self.app.post('/api/restore', json={'type': 'participant', 'item': {'name': 'A', 'expenses': []}})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.app.delete(f'/api/expense/{ids[1]}').status_code, 200)
+        self.assertEqual([e['id'] for e in self.app.get('/api/data').get_json()['expenses']], [ids[2]])
+
     def test_delete_restore_participant(self):
         rv = self.app.post('/api/participants', json={'names': ['P1', 'P2']})
         self.assertEqual(rv.status_code, 200)
@@ -100,6 +112,195 @@ class ApiTest(unittest.TestCase):
         amounts = sorted([p['amount'] for p in payments])
         self.assertEqual(amounts, [20.0, 50.0])
 
+    def test_zero_and_three_decimal_currencies(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B', 'C']})
+        self.app.post('/api/settings', json={'currency': 'JPY'})
+        rv = self.app.post('/api/expense', json={'payer': 'A', 'amount': 1000.4})
+        self.assertEqual(rv.get_json()['expense']['amount'], 1000.0)
+        j = self.app.get('/api/report').get_json()
+        # whole yen: 1000 split three ways is 334 + 333 + 333
+        self.assertEqual(sorted(s['share'] for s in j['summary'].values()), [333.0, 333.0, 334.0])
+        self.assertEqual(self.app.get('/api/data').get_json()['expenses'][0]['amount'], 1000.0)
+
+        self.app.post('/api/settings', json={'currency': 'KWD'})
+        eid = self.app.get('/api/data').get_json()['expenses'][0]['id']
+        rv = self.app.put(f'/api/expense/{eid}', json={'amount': 1.0005})
+        self.assertEqual(rv.get_json()['expense']['amount'], 1.001)
+        j = self.app.get('/api/report').get_json()
+        self.assertEqual(sorted(s['share'] for s in j['summary'].values()), [0.333, 0.334, 0.334])
+        # 1.001 has no yen equivalent: the switch is refused and nothing is rounded
+        rv = self.app.post('/api/settings', json={'currency': 'JPY'})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.app.get('/api/settings').get_json()['currency'], 'KWD')
+        self.assertEqual(self.app.get('/api/data').get_json()['expenses'][0]['amount'], 1.001)
+
+    def test_rename_keeps_splits(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B', 'C']})
+        self.app.post('/api/expense', json={'payer': 'A', 'amount': 30, 'split': ['A', 'B']})
+        rv = self.app.post('/api/participants/rename', json={'old': 'B', 'new': 'Bee'})
+        self.assertEqual(rv.get_json()['participants'], ['A', 'Bee', 'C'])
+        self.assertEqual(self.app.get('/api/data').get_json()['expenses'][0]['split'], ['A', 'Bee'])
+        summary = self.app.get('/api/report').get_json()['summary']
+        self.assertEqual(summary['Bee']['share'], 15.0)
+        self.assertEqual(summary['C']['share'], 0.0)
+        rv = self.app.post('/api/participants/rename', json={'old': 'A', 'new': 'C'})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_split_shorthands(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B', 'C']})
+        self.app.post('/api/expense', json={'payer': 'A', 'amount': 3, 'split': 'all'})
+        self.app.post('/api/expense', json={'payer': 'A', 'amount': 3, 'split': {'except': ['C']}})
+        splits = [e['split'] for e in self.app.get('/api/data').get_json()['expenses']]
+        self.assertEqual(splits, [['A', 'B', 'C'], ['A', 'B']])
+
+    def test_optimal_settlement(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B', 'C', 'D', 'E', 'F']})
+        # balances: B +3, C +6, D +6, E -6, F -9
+        self.app.post('/api/expense', json={'payer': 'B', 'amount': 3, 'split': ['E']})
+        self.app.post('/api/expense', json={'payer': 'C', 'amount': 6, 'split': ['F']})
+        self.app.post('/api/expense', json={'payer': 'D', 'amount': 6, 'split': ['E', 'F']})
+        greedy = self.app.get('/api/report').get_json()
+        self.assertEqual(greedy['settlement']['method'], 'greedy')
+        self.assertEqual(len(greedy['payments']), 4)
+        j = self.app.get('/api/report?method=optimal').get_json()
+        self.assertEqual(j['settlement']['method'], 'optimal')
+        self.assertGreaterEqual(j['settlement']['ms'], 0)
+        self.assertEqual(sorted((p['from'], p['to'], p['amount']) for p in j['payments']),
+                         [('E', 'C', 6.0), ('F', 'B', 3.0), ('F', 'D', 6.0)])
+        # out of time: the greedy payments
+        j = self.app.get('/api/report?method=optimal&budget_ms=0').get_json()
+        self.assertEqual(j['settlement']['method'], 'greedy')
+        self.assertEqual(j['payments'], greedy['payments'])
+        # the largest debt and credit are matched first: F's 9 goes to C and D
+        j = self.app.get('/api/report?method=heap').get_json()
+        self.assertEqual(j['settlement']['method'], 'heap')
+        self.assertEqual([(p['from'], p['to'], p['amount']) for p in j['payments']],
+                         [('F', 'C', 6.0), ('E', 'D', 6.0), ('F', 'B', 3.0)])
+        # local search until the deadline finds the three payments as well
+        j = self.app.get('/api/report?method=anytime&deadline_ms=100').get_json()
+        self.assertEqual(j['settlement']['method'], 'anytime')
+        self.assertGreater(j['settlement']['iterations'], 0)
+        self.assertEqual(len(j['payments']), 3)
+        self.assertEqual(self.app.get('/api/report?method=anytime&deadline_ms=-1').status_code, 400)
+        self.assertEqual(self.app.get('/api/report?method=anytime&deadline_ms=600000').status_code, 400)
+        self.assertEqual(self.app.get('/api/report?method=best').status_code, 400)
+        self.assertEqual(self.app.get('/api/report?budget_ms=x').status_code, 400)
+
+    def test_incremental_settlement(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B', 'C', 'D']})
+        self.app.post('/api/expense', json={'payer': 'A', 'amount': 40})
+        first = self.app.get('/api/report?method=incremental').get_json()
+        self.assertEqual(first['settlement']['method'], 'incremental')
+        self.assertEqual(first['payments'], self.app.get('/api/report').get_json()['payments'])
+        # C owes D as well: the payments to A stay as issued, where greedy starts over
+        self.app.post('/api/expense', json={'payer': 'D', 'amount': 8, 'split': ['C', 'D']})
+        j = self.app.get('/api/report?method=incremental').get_json()
+        self.assertEqual(j['payments'], first['payments'] + [{'from': 'C', 'to': 'D', 'amount': 4.0}])
+        self.assertNotEqual(self.app.get('/api/report').get_json()['payments'][:3], first['payments'])
+        self.app.post('/api/expense', json={'payer': 'D', 'amount': 2, 'split': ['C']})
+        j = self.app.get('/api/report?method=incremental').get_json()
+        self.assertEqual(j['payments'], first['payments'] + [{'from': 'C', 'to': 'D', 'amount': 6.0}])
+
+    def test_flow_settlement(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B', 'C', 'D']})
+        self.app.post('/api/expense', json={'payer': 'C', 'amount': 8, 'split': ['A', 'B']})
+        self.app.post('/api/expense', json={'payer': 'D', 'amount': 4, 'split': ['A']})
+        # A owes 8, B 4; C is owed 8, D 4
+        j = self.app.get('/api/report?method=flow').get_json()
+        self.assertEqual(j['settlement']['method'], 'flow')
+        self.assertEqual([(p['from'], p['to'], p['amount']) for p in j['payments']],
+                         [('A', 'C', 8.0), ('B', 'D', 4.0)])
+        # A and C can't pay each other, and C takes one payment: D collects for C
+        j = self.app.get('/api/report?method=flow&blocked=A:C&max_incoming=C:1').get_json()
+        self.assertEqual([(p['from'], p['to'], p['amount']) for p in j['payments']],
+                         [('A', 'D', 8.0), ('D', 'C', 8.0), ('B', 'D', 4.0)])
+        rv = self.app.get('/api/report?method=flow&blocked=A:C&blocked=A:D&blocked=A:B')
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.app.get('/api/report?method=flow&blocked=A:Zed').status_code, 400)
+        self.assertEqual(self.app.get('/api/report?method=flow&max_incoming=D').status_code, 400)
+
+    def test_netting_across_events(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        events = tmpdir.name
+        # A fronts the first event, B the second: once netted, only the difference changes hands
+        for name, payer, amount in (('1-cabin.json', 'A', 30), ('2-dinner.json', 'B', 20)):
+            with open(os.path.join(events, name), 'w') as f:
+                json.dump({'participants': ['A', 'B'], 'currency': 'CAD',
+                           'expenses': [{'id': name, 'payer': payer, 'amount': amount, 'split': ['A', 'B']}]}, f)
+        with mock.patch.object(app_module, 'EVENTS_DIR', events):
+            j = self.app.get('/api/netting').get_json()
+            self.assertEqual(j['payments'], [{'from': 'B', 'to': 'A', 'amount': 5.0}])
+            self.assertEqual(j['total'], 50.0)
+            self.assertEqual(j['events'], [{'file': '1-cabin.json', 'total': 30.0},
+                                           {'file': '2-dinner.json', 'total': 20.0}])
+            before = self.app.get('/api/stats').get_json()['event_balances']
+            j = self.app.get('/api/netting?events=2-dinner.json&method=heap').get_json()
+            self.assertEqual(j['payments'], [{'from': 'A', 'to': 'B', 'amount': 10.0}])
+            after = self.app.get('/api/stats').get_json()['event_balances']
+            self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']), (1, 0))
+            self.assertEqual(self.app.get('/api/netting?events=../data.json').status_code, 404)
+            self.assertEqual(self.app.get('/api/netting?events=3-none.json').status_code, 404)
+            # constraints must name people in the events, as for /api/report
+            rv = self.app.get('/api/netting?method=flow&blocked=A:Zed')
+            self.assertEqual((rv.status_code, rv.get_json()['error']), (400, 'not in participants: Zed'))
+        with mock.patch.object(app_module, 'EVENTS_DIR', os.path.join(events, 'missing')):
+            self.assertEqual(self.app.get('/api/netting').status_code, 400)
+
+    def test_date_window(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B']})
+        self.app.post('/api/expense', json={'payer': 'A', 'amount': 10, 'date': '2025-03-01'})
+        self.app.post('/api/expense', json={'payer': 'B', 'amount': 4, 'date': '2025-03-15'})
+        self.app.post('/api/expense', json={'payer': 'B', 'amount': 30, 'date': '2025-04-02'})
+        j = self.app.get('/api/report?from=2025-03-01&to=2025-03-31').get_json()
+        self.assertEqual(j['total'], 14.0)
+        self.assertEqual(j['window'], {'from': '2025-03-01', 'to': '2025-03-31'})
+        self.assertEqual(j['payments'], [{'from': 'B', 'to': 'A', 'amount': 3.0}])
+        j = self.app.get('/api/report?from=2025-03-10').get_json()
+        self.assertEqual((j['total'], j['window']['to']), (34.0, None))
+        # the index follows the dataset, from the sums by day the mutations keep
+        eid = self.app.post('/api/expense', json={'payer': 'A', 'amount': 2, 'date': '2025-03-20'}).get_json()['expense']['id']
+        with mock.patch('storage.ledger.date_ordinal', wraps=ledger.date_ordinal) as dated:
+            # the reports date no expense; the edit dates the two versions of the one it changes
+            self.assertEqual(self.app.get('/api/report?to=2025-03-31').get_json()['total'], 16.0)
+            self.assertEqual(dated.call_count, 0)
+            self.app.put(f'/api/expense/{eid}', json={'payer': 'A', 'amount': 2, 'date': '2025-04-20'})
+            self.assertEqual(self.app.get('/api/report?from=2025-04-01').get_json()['total'], 32.0)
+            self.assertEqual(dated.call_count, 2)
+        self.app.delete(f'/api/expense/{eid}')
+        self.assertEqual(self.app.get('/api/report?from=2025-04-01').get_json()['total'], 30.0)
+        self.assertNotIn('window', self.app.get('/api/report').get_json())
+        self.assertEqual(self.app.get('/api/report?from=March').status_code, 400)
+        self.assertEqual(self.app.get('/api/report?from=2025-04-01&to=2025-03-01').status_code, 400)
+
+    def test_report_cache(self):
+        self.app.post('/api/participants', json={'names': ['A', 'B']})
+        self.app.post('/api/expense', json={'payer': 'A', 'amount': 10})
+        before = self.app.get('/api/stats').get_json()['report_cache']
+        first = self.app.get('/api/report')
+        second = self.app.get('/api/report')
+        self.assertEqual(second.get_data(), first.get_data())
+        self.app.get('/api/report?method=heap')
+        after = self.app.get('/api/stats').get_json()['report_cache']
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 2)
+        # a save changes the dataset version
+        self.app.post('/api/expense', json={'payer': 'B', 'amount': 30})
+        j = self.app.get('/api/report').get_json()
+        self.assertEqual(j['total'], 40.0)
+        self.assertEqual(self.app.get('/api/stats').get_json()['report_cache']['misses'] - after['misses'], 1)
+
+    def test_warm_reads_hit_cache(self):
+        rv = self.app.post('/api/participants', json={'names': ['A', 'B']})
+        self.assertEqual(rv.status_code, 200)
+        before = self.app.get('/api/stats').get_json()['storage']
+        self.app.get('/api/data')
+        self.app.get('/api/settings')
+        self.app.get('/api/report')
+        after = self.app.get('/api/stats').get_json()['storage']
+        self.assertEqual(after['hits'] - before['hits'], 3)
+        self.assertEqual(after['misses'], before['misses'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,228 @@
+import sys
+import pathlib
+import random
+import unittest
+from collections import defaultdict
+from datetime import date
+from time import perf_counter
+from unittest import mock
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from settlement import (SplitOrders, expense_totals, greedy_payments, kernel, optimal_payments,
+                        parallel_add_expenses, settle, split_shares)
+from settlement.anytime import anytime_payments
+from settlement.flow import CapsNotMet, flow_payments
+from settlement.incremental import adjust_payments, residuals
+from settlement.splits import compact, members
+from storage import ledger, mutations
+from storage.base import normalize
+from storage.participants import name_rank
+from storage.window import DateIndex
+
+from test_storage import expense
+
+
+class SplitOrdersTest(unittest.TestCase):
+    def test_repeated_splits_are_resolved_once(self):
+        rank = {1: 2, 2: 0, 3: 1}
+        orders = SplitOrders([1, 2, 3], rank)
+        ordered = orders.order([3, 1, 9])
+        self.assertEqual(ordered, (3, 1))
+        self.assertIs(orders.order([3, 1, 9]), ordered)
+        self.assertEqual(orders.order([]), (2, 3, 1))
+        self.assertEqual(orders.order(compact([1, 2, 3])), (2, 3, 1))
+        shares = orders.shares(101, [3, 1, 9])
+        self.assertEqual(list(shares), split_shares(101, [3, 1]))
+        self.assertIs(orders.shares(101, [3, 1, 9]), shares)
+        # the ledger shares one per participant list
+        records = [{"id": 1, "name": "C"}, {"id": 2, "name": "A"}, {"id": 3, "name": "B"}]
+        self.assertIs(ledger.split_orders(records), ledger.split_orders([dict(p) for p in records]))
+        self.assertEqual(ledger.split_orders(records).order([1, 2]), (2, 1))
+
+    def test_grouped_shares_match_per_expense_split(self):
+        participants = list(range(1, 8))
+        rank = {p: (p * 5) % 7 for p in participants}
+        splits = [[1, 2, 3, 4, 5, 6, 7], [2, 5], [7, 1, 3], [], [9], compact(list(range(1, 8)))]
+        expenses = [{"payer": 1 + n % 7, "amount_minor": (n * 7919) % 1000 - 100, "split": splits[n % len(splits)]}
+                    for n in range(500)]
+        expected = {p: 0 for p in participants}
+        for e in expenses:
+            split = [s for s in members(e["split"]) if s in rank] or participants
+            split = sorted(split, key=rank.__getitem__)
+            base, rem = divmod(e["amount_minor"], len(split))
+            for idx, member in enumerate(split):
+                expected[member] += base + (1 if idx < rem else 0)
+        self.assertEqual(expense_totals(participants, expenses, rank)[1], expected)
+
+
+class KernelTest(unittest.TestCase):
+    def dataset(self, amount):
+        data = {"participants": [], "expenses": []}
+        mutations.apply(data, {"op": "set_participants", "names": ["P%02d" % i for i in range(12)]})
+        names = [p["name"] for p in data["participants"]]
+        for n in range(300):
+            split = [names, names[n % 5:], [names[n % 12]], ["Gone"]][n % 4]
+            mutations.apply(data, {"op": "add_expense", "expense": expense(
+                "e%d" % n, names[n % 7], 0, split)})
+            data["expenses"][-1]["amount_minor"] = amount(n)
+        # a plain list, for the tests to edit
+        data["expenses"] = list(data["expenses"])
+        return data
+
+    def totals(self, data):
+        ids = [p["id"] for p in data["participants"]]
+        rank = name_rank(data["participants"])
+        return expense_totals(ids, data["expenses"], rank)
+
+    def test_batched_and_plain_sums_agree(self):
+        # negative amounts, and amounts whose sums would overflow 64 bits
+        for amount in (lambda n: (n * 7919) % 100000 - 5000, lambda n: (1 << 62) - n):
+            data = self.dataset(amount)
+            # one expense at a time
+            _, expected, _ = ledger.deltas(data["participants"], data["expenses"])
+            totals = self.totals(data)
+            self.assertEqual(totals[1], expected)
+            with mock.patch.object(kernel, "numpy", None):
+                self.assertEqual(self.totals(data), totals)
+
+    def test_sharded_scan_matches_serial(self):
+        data = self.dataset(lambda n: (n * 7919) % 100000 - 5000)
+        # someone who left still paid
+        data["expenses"][5] = dict(data["expenses"][5], payer=99)
+        ids = [p["id"] for p in data["participants"]]
+        rank = name_rank(data["participants"])
+        results = []
+        for workers in (1, 3):
+            paid = defaultdict(int, ((pid, 0) for pid in ids))
+            share = {pid: 0 for pid in ids}
+            total = parallel_add_expenses(paid, share, ids, data["expenses"], rank, workers, min_expenses=0)
+            results.append((list(paid.items()), share, total))
+        self.assertEqual(results[1], results[0])
+
+
+class IncrementalPlanTest(unittest.TestCase):
+    def test_adjusts_only_the_transfers_a_change_touches(self):
+        balances = {"A": 3000, "B": -1000, "C": -1000, "D": -1000, "E": 500, "F": -500}
+        plan = [("B", "A", 1000), ("C", "A", 1000), ("D", "A", 1000), ("F", "E", 500)]
+        self.assertEqual(adjust_payments(plan, balances, {"A": 3000}), (plan, True))
+        # F paid 200 that everyone but A shares: A's transfers stay, the rest is settled with F
+        moved = dict(balances, B=-1040, C=-1040, D=-1040, E=460, F=-340)
+        payments, kept = adjust_payments(plan, moved, {"A": 3000, "F": 200})
+        self.assertEqual((payments, kept), (plan[:3] + [("F", "E", 460), ("B", "F", 40), ("C", "F", 40),
+                                                         ("D", "F", 40)], True))
+        self.assertEqual(residuals(payments, moved), dict.fromkeys(moved, 0))
+        # with no room beyond the five payments a fresh plan needs, it is replaced
+        payments, kept = adjust_payments(plan, moved, {"A": 3000, "F": 200}, margin=1)
+        self.assertEqual((len(payments), kept), (5, False))
+        # someone left, and what they were part of is settled again
+        gone = {p: bal for p, bal in moved.items() if p != "E"}
+        gone["A"] += 460
+        payments, kept = adjust_payments(plan, gone, {"A": 3000})
+        self.assertEqual(residuals(payments, gone), dict.fromkeys(gone, 0))
+
+    def test_replaces_a_plan_past_the_margin(self):
+        balances = {"A": 100, "B": -100}
+        plan = [("A", "C", 5), ("B", "C", 5), ("C", "A", 10), ("B", "A", 90)]
+        payments, kept = adjust_payments(plan, dict(balances, C=0), {}, margin=0)
+        self.assertEqual((payments, kept), ([("B", "A", 100)], False))
+        # report time uses the margin the plan is maintained with
+        long_plan = [("B", "C", 50), ("C", "A", 50), ("B", "A", 50)]
+        with_c = dict(balances, C=0)
+        self.assertEqual(settle(with_c, {}, "incremental", plan=long_plan, margin=0)[1]["method"], "greedy")
+        payments, settlement = settle(with_c, {}, "incremental", plan=long_plan, margin=2)
+        self.assertEqual((payments, settlement["method"]), (long_plan, "incremental"))
+        # a turned-around transfer nets against the one already there
+        payments, kept = adjust_payments([("A", "B", 30)], balances, {"A": 100})
+        self.assertEqual((payments, kept), ([("B", "A", 100)], True))
+
+
+class FlowPaymentsTest(unittest.TestCase):
+    BALANCES = {"A": -500, "B": -300, "C": 400, "D": 400}
+
+    def test_constraints(self):
+        self.assertEqual(flow_payments(self.BALANCES), [("A", "C", 400), ("A", "D", 100), ("B", "D", 300)])
+        # A can pay neither creditor: B passes A's payment on
+        self.assertEqual(flow_payments(self.BALANCES, blocked={("A", "C"), ("A", "D")}),
+                         [("A", "B", 500), ("B", "C", 400), ("B", "D", 400)])
+        # A's 100 to D goes through B, who pays D already
+        self.assertEqual(flow_payments(self.BALANCES, max_incoming={"C": 1, "D": 1}),
+                         [("A", "C", 400), ("B", "D", 400), ("A", "B", 100)])
+        self.assertIsNone(flow_payments(self.BALANCES, blocked={("A", "B"), ("A", "C"), ("A", "D")}))
+        self.assertIsNone(flow_payments(self.BALANCES, max_incoming={"C": 0}))
+        # nobody can pass A's or B's payment on to C
+        with self.assertRaises(CapsNotMet):
+            flow_payments({"A": -300, "B": -300, "C": 600}, {("A", "B"), ("B", "A")}, {"C": 1})
+
+    def test_a_few_hundred_people(self):
+        rng = random.Random(7)
+        balances = {"p%d" % i: -rng.randint(1, 10000) for i in range(299)}
+        balances["p299"] = -sum(balances.values())
+        blocked = {(a, b) for a in balances for b in balances if rng.random() < 0.05}
+        payments = flow_payments(balances, blocked, {"p299": 5})
+        self.assertEqual(set(residuals(payments, balances).values()), {0})
+        self.assertFalse(blocked & {(f, t) for f, t, _ in payments})
+        self.assertLessEqual(sum(1 for _, t, _ in payments if t == "p299"), 5)
+
+    def test_tight_caps_for_a_few_hundred_people(self):
+        rng = random.Random(11)
+        values = [rng.randint(-10000, 10000) for _ in range(299)]
+        balances = {"p%d" % i: v for i, v in enumerate(values)}
+        balances["p299"] = -sum(values)
+        top = sorted(balances, key=balances.get)[-20:]
+        blocked = {(a, b) for a in balances for b in balances if rng.random() < 0.05}
+        for blocked, caps in ((blocked, dict.fromkeys(balances, 2)), (set(), dict.fromkeys(top, 1))):
+            start = perf_counter()
+            payments = flow_payments(balances, blocked, caps)
+            self.assertLess(perf_counter() - start, 1)
+            self.assertEqual(set(residuals(payments, balances).values()), {0})
+            self.assertFalse(blocked & {(f, t) for f, t, _ in payments})
+            received = defaultdict(int)
+            for _, t, _ in payments:
+                received[t] += 1
+            self.assertTrue(all(received[p] <= cap for p, cap in caps.items()))
+
+
+class AnytimePaymentsTest(unittest.TestCase):
+    def test_improves_on_greedy_until_the_deadline(self):
+        rng = random.Random(3)
+        values = [rng.choice([-500, -300, -200, -100, 100, 200, 300, 400]) for _ in range(15)]
+        balances = {"p%d" % i: v for i, v in enumerate(values + [-sum(values)])}
+        greedy = greedy_payments(balances, {})
+        self.assertEqual(anytime_payments(balances, {}, perf_counter() - 1), (greedy, 0))
+        payments, iterations = anytime_payments(balances, {}, perf_counter() + 0.5)
+        self.assertGreater(iterations, 0)
+        self.assertEqual(set(residuals(payments, balances).values()), {0})
+        self.assertEqual(len(payments), len(optimal_payments(balances, {})))
+        self.assertLess(len(payments), len(greedy))
+        # nothing to improve: the search doesn't start
+        self.assertEqual(anytime_payments({"A": -5, "B": 5}, {}, perf_counter() + 10), ([("A", "B", 5)], 0))
+
+
+class DateIndexTest(unittest.TestCase):
+    def test_windows_match_a_scan(self):
+        rng = random.Random(5)
+        data = normalize({"participants": ["A", "B", "C", "D"], "expenses": []})
+        for i in range(300):
+            day = "" if i % 50 == 0 else "2025-%02d-%02d" % (rng.randint(1, 12), rng.randint(1, 28))
+            e = dict(expense("x%d" % i, rng.choice("ABCD"), rng.randint(1, 9999) / 100,
+                             rng.sample("ABCD", rng.randint(0, 4))), date=day)
+            mutations.apply(data, {"op": "add_expense", "expense": e})
+        mutations.apply(data, {"op": "delete_participant", "name": "D"})
+        records = data["participants"]
+        ids = [p["id"] for p in records]
+        # the sums by day were kept by the mutations: they match a rebuild
+        self.assertEqual(data["ledger"]["days"], ledger.build(data)["days"])
+        index = DateIndex(ledger.view(data))
+        for start, end in ((None, None), ("2025-03-01", "2025-03-31"), ("2025-06-15", None), (None, "2025-01-01"),
+                           ("2025-04-03", "2025-04-03"), ("2026-01-01", None)):
+            dated = [e for e in data["expenses"] if e["date"] and (start is None or e["date"] >= start)
+                     and (end is None or e["date"] <= end)]
+            paid, share, total = expense_totals(ids, dated, name_rank(records))
+            bounds = [b and date.fromisoformat(b) for b in (start, end)]
+            self.assertEqual(index.totals(*bounds), (paid, share, total))
+        # every date: the ledger, less the undated expenses
+        paid, share, total = index.totals()
+        undated = sum(e["amount_minor"] for e in data["expenses"] if not e["date"])
+        self.assertEqual(total + undated, data["ledger"]["total"])
@@ -0,0 +1,685 @@
+import os
+import sys
+import pathlib
+import tempfile
+import io
+import json
+import multiprocessing
+import threading
+import unittest
+from unittest import mock
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from settlement import build_report, expense_totals
+from settlement.incremental import residuals
+from settlement.splits import compact, members
+from storage import (GroupCommit, JournalStorage, JsonStorage, SectionedStorage, SqliteStorage,
+                     binary, import_json)
+from storage import ledger, mutations
+from storage.base import normalize
+from storage.chunks import CHUNK, ExpenseList, to_json
+from storage.index import ExpenseIndex
+from storage.migrate import convert
+from storage.participants import name_rank
+from storage.netting import EventBalances, main as netting_main, net_report
+from storage.stream import events, stream_ledger
+
+
+def expense(eid, payer, amount, split):
+    return {"id": eid, "payer": payer, "amount_minor": round(amount * 100), "description": "d" + eid,
+            "date": "2025-01-01", "split": split}
+
+
+# a little of everything the endpoints can emit, in order
+OPS = [
+    {"op": "set_participants", "names": ["A", "B", "C"]},
+    {"op": "add_expense", "expense": expense("e1", "A", 30.0, ["A", "B", "C"])},
+    {"op": "add_expense", "expense": expense("e2", "B", 10.5, ["A", "B"])},
+    {"op": "add_expense", "expense": expense("e3", "C", 7.25, ["C"])},
+    {"op": "edit_expense", "expense": expense("e2", "B", 12.0, ["B", "C"])},
+    {"op": "delete_expense", "id": "e1"},
+    {"op": "rename_participant", "old": "B", "new": "Bee"},
+    {"op": "delete_participant", "name": "C"},
+    {"op": "restore_participant", "name": "C", "expenses": [expense("e3", "C", 7.25, ["C"])]},
+    {"op": "restore_expense", "expense": expense("e1", "A", 30.0, ["A", "Bee", "C"])},
+    {"op": "settings", "event": "Trip", "currency": "USD"},
+]
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def replay(self, store):
+        return [store.commit(op) for op in OPS]
+
+
+class JsonStorageTest(StorageTestCase):
+    def test_cache_hits_until_file_changes(self):
+        js = JsonStorage(self.path("data.json"))
+        js.commit(OPS[0])
+        first = js.load()
+        self.assertIs(js.load(), first)
+        self.assertEqual(js.stats()["misses"], 0)
+        # another process rewrites the file
+        with open(self.path("data.json"), "w") as f:
+            json.dump({"participants": ["Z"], "expenses": []}, f)
+        self.assertEqual(js.participants(), ["Z"])
+        self.assertEqual(js.stats()["misses"], 1)
+        self.assertEqual([p["name"] for p in first["participants"]], ["A", "B", "C"])
+
+    def test_commit_leaves_loaded_dataset_intact(self):
+        js = JsonStorage(self.path("data.json"))
+        self.replay(js)
+        before = js.load()
+        snapshot = json.loads(json.dumps(before, default=to_json))
+        js.commit({"op": "rename_participant", "old": "A", "new": "Ay"})
+        js.commit({"op": "delete_expense", "id": "e2"})
+        self.assertEqual(before, snapshot)
+        self.assertEqual(js.stats()["revision"], len(OPS) + 2)
+
+
+class SqliteStorageTest(StorageTestCase):
+    def test_matches_json_storage(self):
+        js = JsonStorage(self.path("data.json"))
+        db = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        self.assertEqual(self.replay(db), self.replay(js))
+        self.assertEqual(db.load(), js.load())
+        self.assertEqual(db.settings(), {"event": "Trip", "currency": "USD"})
+        self.assertEqual(db.get_expense("e2"), js.get_expense("e2"))
+        self.assertIsNone(db.get_expense("missing"))
+
+    def test_wal_mode(self):
+        db = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        mode = db._connect().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_version_is_shared_by_every_connection(self):
+        db = SqliteStorage(self.path("data.db"))
+        other = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        self.addCleanup(other.close)
+        db.commit(OPS[0])
+        before = db.version()
+        other.commit(OPS[1])
+        seen = []
+        # a thread that first reads after the write gets a connection of its own
+        reader = threading.Thread(target=lambda: seen.append(db.version()))
+        reader.start()
+        reader.join()
+        self.assertNotEqual(seen[0], before)
+        self.assertEqual(seen, [db.version()])
+
+    def test_import_json(self):
+        js = JsonStorage(self.path("data.json"))
+        self.replay(js)
+        import_json(self.path("data.json"), self.path("data.db"))
+        db = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        self.assertEqual(db.load(), js.load())
+
+    def test_refuses_a_currency_change_that_rounds(self):
+        # a data.json from before minor units and participant ids
+        with open(self.path("data.json"), "w") as f:
+            json.dump({"participants": ["A"], "currency": "KWD", "expenses": [
+                {"id": "e1", "payer": "A", "amount": 10.005, "split": ["A"]},
+                {"id": "e2", "payer": "A", "amount": 0.1, "split": ["A"]}]}, f)
+        import_json(self.path("data.json"), self.path("data.db"))
+        db = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        self.assertEqual([e["amount_minor"] for e in db.load()["expenses"]], [10005, 100])
+        # 10.005 doesn't fit in cents: the change is refused rather than rounded
+        with self.assertRaises(ValueError):
+            db.commit({"op": "settings", "currency": "USD"})
+        self.assertEqual(db.settings()["currency"], "KWD")
+        db.commit({"op": "edit_expense", "expense": dict(db.get_expense("e1"), amount_minor=10000)})
+        db.commit({"op": "settings", "currency": "USD"})
+        self.assertEqual([e["amount_minor"] for e in db.load()["expenses"]], [1000, 10])
+
+
+class JournalStorageTest(StorageTestCase):
+    def test_matches_json_storage(self):
+        js = JsonStorage(self.path("data.json"))
+        jn = JournalStorage(self.path("journal.json"))
+        self.assertEqual(self.replay(jn), self.replay(js))
+        self.assertEqual(jn.load(), js.load())
+        # one compact record per mutation, snapshot untouched
+        self.assertFalse(os.path.exists(self.path("journal.json")))
+        with open(self.path("journal.json.journal")) as f:
+            self.assertEqual(len(f.readlines()), len(OPS))
+        # a fresh process rebuilds the same dataset from the journal
+        self.assertEqual(JournalStorage(self.path("journal.json")).load(), js.load())
+
+    def test_torn_final_record(self):
+        jn = JournalStorage(self.path("data.json"))
+        self.replay(jn)
+        expected = JournalStorage(self.path("data.json")).load()
+        with open(self.path("data.json.journal"), "ab") as f:
+            f.write(b'[99,{"op":"delete_expense","id":"e')
+        recovered = JournalStorage(self.path("data.json"))
+        self.assertEqual(recovered.load(), expected)
+        # the torn bytes are truncated so new records append cleanly
+        recovered.commit({"op": "delete_expense", "id": "e1"})
+        self.assertIsNone(JournalStorage(self.path("data.json")).get_expense("e1"))
+
+    def test_background_compaction(self):
+        jn = JournalStorage(self.path("data.json"), compact_bytes=200)
+        self.replay(jn)
+        jn.wait_for_compaction()
+        with open(self.path("data.json")) as f:
+            self.assertGreater(json.load(f)["journal_seq"], 0)
+        jn.compact()
+        self.assertEqual(os.path.getsize(self.path("data.json.journal")), 0)
+        js = JsonStorage(self.path("plain.json"))
+        self.replay(js)
+        self.assertEqual(JournalStorage(self.path("data.json")).load(), js.load())
+        self.assertEqual(jn.load(), js.load())
+
+    def test_concurrent_compactions_keep_every_record(self):
+        a = JournalStorage(self.path("data.json"), compact_bytes=1 << 30)
+        b = JournalStorage(self.path("data.json"), compact_bytes=1 << 30)
+        a.commit(OPS[0])
+        for i in range(5):
+            a.commit({"op": "add_expense", "expense": expense("a%d" % i, "A", 1, ["A"])})
+        encode = a.encode
+
+        def meanwhile(data):
+            # b commits, compacts and commits again while a is between reading and swapping
+            b.commit({"op": "add_expense", "expense": expense("b1", "B", 1, ["B"])})
+            b.compact()
+            b.commit({"op": "add_expense", "expense": expense("b2", "B", 1, ["B"])})
+            return encode(data)
+
+        with mock.patch.object(a, "encode", meanwhile):
+            a.compact()
+        ids = [e["id"] for e in JournalStorage(self.path("data.json")).load()["expenses"]]
+        self.assertEqual(ids, ["a0", "a1", "a2", "a3", "a4", "b1", "b2"])
+        self.assertEqual([n for n in os.listdir(self.tmpdir.name) if ".tmp-" in n], [])
+
+    def test_sees_other_writers(self):
+        a = JournalStorage(self.path("data.json"))
+        b = JournalStorage(self.path("data.json"))
+        a.commit(OPS[0])
+        self.assertEqual(b.participants(), ["A", "B", "C"])
+        b.commit(OPS[1])
+        self.assertIsNotNone(a.get_expense("e1"))
+
+
+def _add_many(engine, path, worker, count):
+    store = engine(path)
+    for i in range(count):
+        store.commit({"op": "add_expense", "expense": expense("w%d-%d" % (worker, i), "A", 1, ["A"])})
+
+
+class CrossProcessLockingTest(StorageTestCase):
+    def assert_no_lost_updates(self, engine, path):
+        engine(path).commit(OPS[0])
+        ctx = multiprocessing.get_context("fork")
+        procs = [ctx.Process(target=_add_many, args=(engine, path, w, 25)) for w in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        self.assertEqual(len(engine(path).load()["expenses"]), 100)
+
+    def test_json_workers_do_not_lose_updates(self):
+        self.assert_no_lost_updates(JsonStorage, self.path("data.json"))
+
+    def test_journal_workers_do_not_lose_updates(self):
+        self.assert_no_lost_updates(JournalStorage, self.path("data.json"))
+
+    def test_save_replaces_file_atomically(self):
+        js = JsonStorage(self.path("data.json"))
+        js.commit(OPS[0])
+        inode = os.stat(self.path("data.json")).st_ino
+        js.commit(OPS[1])
+        self.assertNotEqual(os.stat(self.path("data.json")).st_ino, inode)
+        self.assertEqual([n for n in os.listdir(self.tmpdir.name) if ".tmp-" in n], [])
+
+
+class BinarySnapshotTest(StorageTestCase):
+    def test_round_trip(self):
+        js = JsonStorage(self.path("data.json"))
+        self.replay(js)
+        data = js.load()
+        data = dict(data, expenses=data["expenses"] + [
+            {"id": "12731e99-ebde-40be-97cb-1388afc92889", "payer": "A", "amount_minor": 978,
+             "description": "Dollarama", "date": "2025-11-15", "split": ["A", "Bee"]},
+            {"id": 7, "payer": None, "amount_minor": "12", "description": None, "date": "",
+             "split": None, "note": "from an old client"},
+        ], journal_seq=4)
+        data["ledger"] = ledger.build(data)
+        self.assertEqual(binary.decode(binary.encode(data)), data)
+
+    def test_binary_engines_match_json(self):
+        js = JsonStorage(self.path("data.json"))
+        jb = JsonStorage(self.path("data.bin"), snapshot_format="binary")
+        jn = JournalStorage(self.path("journal.bin"), snapshot_format="binary", compact_bytes=100)
+        self.assertEqual(self.replay(jb), self.replay(js))
+        self.replay(jn)
+        jn.wait_for_compaction()
+        jb.cache.invalidate()
+        self.assertEqual(jb.load(), js.load())
+        self.assertEqual(JournalStorage(self.path("journal.bin"), snapshot_format="binary").load(), js.load())
+        with open(self.path("data.bin"), "rb") as f:
+            self.assertEqual(f.read(4), binary.MAGIC)
+
+    def test_convert_both_directions(self):
+        js = JsonStorage(self.path("data.json"))
+        self.replay(js)
+        convert(self.path("data.json"), self.path("data.bin"))
+        convert(self.path("data.bin"), self.path("back.json"))
+        with open(self.path("data.json")) as a, open(self.path("back.json")) as b:
+            self.assertEqual(json.load(a), json.load(b))
+        self.assertLess(os.path.getsize(self.path("data.bin")), os.path.getsize(self.path("data.json")))
+
+
+class SectionedStorageTest(StorageTestCase):
+    def test_matches_json_storage(self):
+        js = JsonStorage(self.path("data.json"))
+        ss = SectionedStorage(self.path("data.sections"))
+        self.assertEqual(self.replay(ss), self.replay(js))
+        self.assertEqual(ss.load(), js.load())
+        self.assertEqual(SectionedStorage(self.path("data.sections")).load(), js.load())
+        self.assertEqual(ss.settings(), js.settings())
+
+    def test_reads_and_writes_only_touched_sections(self):
+        ss = SectionedStorage(self.path("data.sections"))
+        ss.commit({"op": "set_participants", "names": ["A", "B"]})
+        ss.commit({"op": "add_expense", "expense": expense("e1", "A", 5.0, ["A", "B"])})
+        before = sorted(os.listdir(self.path("data.sections")))
+        ss.commit({"op": "settings", "event": "Trip", "currency": "EUR"})
+        after = sorted(os.listdir(self.path("data.sections")))
+        # only the settings section (and the manifest) were replaced
+        self.assertEqual([f for f in after if f not in before], ["settings-3.json"])
+        with open(self.path("data.sections/manifest.json")) as f:
+            self.assertEqual(json.load(f)["sections"]["expenses"], "expenses-2.json")
+        # a fresh reader asking for settings never opens the expense section
+        os.remove(self.path("data.sections/expenses-2.json"))
+        fresh = SectionedStorage(self.path("data.sections"))
+        self.assertEqual(fresh.settings(), {"event": "Trip", "currency": "EUR"})
+        self.assertEqual(fresh.participants(), ["A", "B"])
+
+
+class MinorUnitsTest(StorageTestCase):
+    LEGACY = {"participants": ["A", "B"], "currency": "JPY", "expenses": [
+        {"id": "e1", "payer": "A", "amount": 1000.4, "split": ["A", "B"]},
+        {"id": "e2", "payer": "B", "amount": 2.5, "split": ["B"]},
+    ]}
+
+    def test_float_data_migrates_on_load(self):
+        with open(self.path("data.json"), "w") as f:
+            json.dump(self.LEGACY, f)
+        convert(self.path("data.json"), self.path("data.sections"))
+        for store in (JsonStorage(self.path("data.json")), SectionedStorage(self.path("data.sections"))):
+            expenses = store.load()["expenses"]
+            self.assertEqual([e["amount_minor"] for e in expenses], [1000, 3])
+            self.assertNotIn("amount", expenses[0])
+
+    def test_currency_change_rescales(self):
+        js = JsonStorage(self.path("data.json"))
+        js.commit(OPS[0])
+        js.commit({"op": "add_expense", "expense": expense("e1", "A", 12.5, ["A"])})
+        js.commit({"op": "settings", "currency": "KWD"})
+        self.assertEqual(js.get_expense("e1")["amount_minor"], 12500)
+        # 12.5 can't be whole yen: refused, nothing rounded
+        with self.assertRaisesRegex(ValueError, "JPY has 0 decimal places: 1 expense"):
+            js.commit({"op": "settings", "currency": "JPY"})
+        self.assertEqual((js.settings()["currency"], js.get_expense("e1")["amount_minor"]), ("KWD", 12500))
+        js.commit({"op": "edit_expense", "expense": dict(expense("e1", "A", 0, ["A"]), amount_minor=12000)})
+        js.commit({"op": "settings", "currency": "JPY"})
+        js.commit({"op": "settings", "currency": "jpy"})
+        self.assertEqual(js.get_expense("e1")["amount_minor"], 12)
+        js.commit({"op": "settings", "currency": "CAD"})
+        self.assertEqual(js.get_expense("e1")["amount_minor"], 1200)
+
+
+class ParticipantIdsTest(StorageTestCase):
+    def stores(self):
+        db = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        return [JsonStorage(self.path("data.json")), JournalStorage(self.path("journal.json")), db,
+                JsonStorage(self.path("data.bin"), snapshot_format="binary"),
+                SectionedStorage(self.path("data.sections"))]
+
+    def test_rename_touches_only_the_participant(self):
+        for store in self.stores():
+            store.commit(OPS[0])
+            store.commit({"op": "add_expense", "expense": expense("e1", "B", 9.0, ["B", "C"])})
+            before = store.get_expense("e1")
+            self.assertEqual((before["payer"], before["split"]), (2, [2, 3]))
+            self.assertEqual(store.commit({"op": "rename_participant", "old": "B", "new": "Bee"}), ["A", "Bee", "C"])
+            self.assertEqual(store.get_expense("e1"), before)
+            self.assertEqual(store.participant_names(), {1: "A", 2: "Bee", 3: "C"})
+
+    def test_readded_name_gets_its_old_id(self):
+        for store in self.stores():
+            store.commit(OPS[0])
+            store.commit({"op": "add_expense", "expense": expense("e1", "A", 9.0, ["A", "C"])})
+            store.commit({"op": "delete_participant", "name": "C"})
+            store.commit({"op": "set_participants", "names": ["A", "B", "D"]})
+            # C's id stays reserved for the split that still lists it
+            self.assertEqual(store.participant_names(), {1: "A", 2: "B", 3: "C", 4: "D"})
+            store.commit({"op": "set_participants", "names": ["A", "B", "C", "D"]})
+            data = store.load()
+            self.assertEqual(data["participants"][2], {"id": 3, "name": "C"})
+            self.assertEqual(data["expenses"][0]["split"], [1, 3])
+            # a name no one had before joins a split as a former participant
+            store.commit({"op": "add_expense", "expense": expense("e2", "A", 1.0, ["A", "Zed"])})
+            self.assertEqual(store.get_expense("e2")["split"], [1, 5])
+            self.assertEqual(store.participants(), ["A", "B", "C", "D"])
+
+    def test_name_based_data_upgrades_on_load(self):
+        legacy = {"participants": ["A", "B", "A"], "currency": "CAD", "expenses": [
+            {"id": "e1", "payer": "B", "amount_minor": 300, "split": ["A", "B", "Gone"]}]}
+        with open(self.path("data.json"), "w") as f:
+            json.dump(legacy, f)
+        convert(self.path("data.json"), self.path("data.sections"))
+        for store in (JsonStorage(self.path("data.json")), SectionedStorage(self.path("data.sections"))):
+            data = store.load()
+            self.assertEqual(data["participants"], [{"id": 1, "name": "A"}, {"id": 2, "name": "B"}])
+            self.assertEqual(data["former_participants"], [{"id": 3, "name": "Gone"}])
+            self.assertEqual((data["expenses"][0]["payer"], data["expenses"][0]["split"]), (2, [1, 2, 3]))
+
+
+class SplitEncodingTest(StorageTestCase):
+    NAMES = ["P%02d" % i for i in range(40)]
+
+    def test_long_splits_are_stored_as_bitsets(self):
+        self.assertEqual(compact([1, 2, 3]), [1, 2, 3])
+        self.assertEqual(compact(list(range(1, 41))), {"bits": "1fffffffffe"})
+        self.assertEqual(members({"bits": "1fffffffffe"}), list(range(1, 41)))
+        # order and repeats only survive as a list
+        self.assertEqual(compact(list(range(40, 0, -1))), list(range(40, 0, -1)))
+        db = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        stores = [JsonStorage(self.path("data.json")), db, JsonStorage(self.path("data.bin"), snapshot_format="binary"),
+                  SectionedStorage(self.path("data.sections"))]
+        for store in stores:
+            store.commit({"op": "set_participants", "names": self.NAMES})
+            store.commit({"op": "add_expense", "expense": expense("all", "P00", 10.0, self.NAMES)})
+            store.commit({"op": "add_expense", "expense": expense("most", "P01", 10.0, self.NAMES[:-1])})
+            store.commit({"op": "add_expense", "expense": expense("few", "P02", 10.0, ["P03", "P04"])})
+            self.assertEqual([e["split"] for e in store.load()["expenses"]],
+                             [{"bits": "1fffffffffe"}, {"bits": "fffffffffe"}, [4, 5]])
+            self.assertEqual(store.load(), stores[0].load())
+        with open(self.path("data.json")) as f:
+            self.assertNotIn('"P39"', f.read().split('"expenses"')[1])
+
+
+class LedgerTest(StorageTestCase):
+    # beyond OPS: reordering renames, departures and a rescale all reshape the ledger
+    MORE = [
+        {"op": "add_expense", "expense": expense("m1", "A", 10.0, ["A", "Bee", "C"])},
+        {"op": "rename_participant", "old": "A", "new": "Zed"},
+        {"op": "add_expense", "expense": dict(expense("m2", "C", 0.05, []), date="")},
+        {"op": "edit_expense", "expense": dict(expense("m1", "Bee", 7.0, ["Zed", "C"]), date="2025-02-01")},
+        {"op": "delete_participant", "name": "Bee"},
+        {"op": "restore_participant", "name": "Bee", "expenses": [expense("e2", "Bee", 12.0, ["Bee", "C"])]},
+        {"op": "settings", "currency": "KWD"},
+        {"op": "delete_expense", "id": "m2"},
+    ]
+
+    def assert_ledger_current(self, store):
+        data = store.load()
+        records = data["participants"]
+        ids = [p["id"] for p in records]
+        paid, share, total = expense_totals(ids, data["expenses"], name_rank(records))
+        view = store.ledger()
+        self.assertEqual(view["participants"], records)
+        self.assertEqual({pid: view["paid"].get(pid, 0) for pid in ids}, paid)
+        self.assertEqual({pid: view["share"].get(pid, 0) for pid in ids}, share)
+        self.assertEqual(view["total"], total)
+        # the plan is adjusted as the expenses change, so it need not be the fresh one; it must settle up
+        fresh = ledger.build(data)
+        self.assertEqual(dict(data["ledger"], plan=None), dict(fresh, plan=None))
+        self.assertEqual(view["plan"], data["ledger"]["plan"])
+        self.assertEqual(view["days"], data["ledger"]["days"])
+        left = residuals(data["ledger"]["plan"], {pid: paid[pid] - share[pid] for pid in ids})
+        self.assertFalse(any(v > 0 for v in left.values()) and any(v < 0 for v in left.values()))
+        self.assertLessEqual(len(data["ledger"]["plan"]), len(fresh["plan"]) + ledger.PLAN_MARGIN)
+
+    def test_every_mutation_keeps_the_ledger_current(self):
+        db = SqliteStorage(self.path("data.db"))
+        self.addCleanup(db.close)
+        for store in (JsonStorage(self.path("data.json")), JournalStorage(self.path("journal.json")), db,
+                      SectionedStorage(self.path("data.sections"))):
+            for op in OPS + self.MORE:
+                store.commit(op)
+                self.assert_ledger_current(store)
+
+    def test_missing_or_miscounted_ledger_is_rebuilt(self):
+        js = JsonStorage(self.path("data.json"))
+        self.replay(js)
+        with open(self.path("data.json")) as f:
+            data = json.load(f)
+        data["expenses"].append(expense("hand", 1, 5.0, [1]))
+        with open(self.path("data.json"), "w") as f:
+            json.dump(data, f)
+        self.assert_ledger_current(js)
+
+class StreamTest(StorageTestCase):
+    def current(self, view):
+        ids = [p["id"] for p in view["participants"]]
+        view = {k: v for k, v in view.items() if k not in ("plan", "days")}
+        return dict(view, paid={pid: view["paid"].get(pid, 0) for pid in ids},
+                    share={pid: view["share"].get(pid, 0) for pid in ids})
+
+    def test_events_across_chunk_boundaries(self):
+        doc = {"participants": ["A"], "expenses": [{"n": 12345, "s": "x\u00e9y"}, {"n": -1.5e3}, {}], "z": 10}
+        raw = json.dumps(doc, indent=2).encode()
+        for chunk_size in (1, 2, 3, 64):
+            got = list(events(io.BytesIO(raw), chunk_size))
+            self.assertEqual(got, [("participants", ["A"])] + [("expense", e) for e in doc["expenses"]]
+                             + [("z", 10)])
+        self.assertEqual(list(events(io.BytesIO(b'{"expenses": []}'))), [])
+        with self.assertRaises(ValueError):
+            list(events(io.BytesIO(b'{"expenses": [1, 2')))
+
+    def test_matches_loaded_ledger(self):
+        js = JsonStorage(self.path("data.json"))
+        self.replay(js)
+        self.assertEqual(stream_ledger(self.path("data.json"), chunk_size=5), self.current(js.ledger()))
+        # float amounts ahead of the currency, and the participants last: read twice
+        legacy = {"expenses": [{"id": "e1", "payer": "A", "amount": 10.01, "split": ["A", "B", "C"]},
+                               {"id": "e2", "payer": "Gone", "amount": 3, "split": []}],
+                  "currency": "JPY", "participants": ["B", "A", "C"]}
+        with open(self.path("legacy.json"), "w") as f:
+            json.dump(legacy, f)
+        view = stream_ledger(self.path("legacy.json"), chunk_size=7)
+        self.assertEqual(view, self.current(JsonStorage(self.path("legacy.json")).ledger()))
+        self.assertEqual(view["total"], 13)
+
+
+class NettingTest(StorageTestCase):
+    def event(self, name, ops):
+        store = JsonStorage(self.path(name))
+        for op in ops:
+            store.commit(op)
+        return self.path(name)
+
+    def test_nets_events_and_reads_each_once(self):
+        first = self.event("first.json", OPS)
+        second = self.event("second.json", [
+            {"op": "settings", "currency": "USD"},
+            {"op": "set_participants", "names": ["C", "A", "Dee"]},
+            {"op": "add_expense", "expense": expense("x1", "C", 60.0, [])},
+        ])
+        balances = EventBalances(self.path("cache.json"))
+        report = net_report([first, second], balances)
+        separate = [build_report(*args) for args in (self.totals(first), self.totals(second))]
+        for name in ("A", "C", "Dee"):
+            self.assertAlmostEqual(report["summary"][name]["balance"],
+                                   sum(r["summary"].get(name, {"balance": 0})["balance"] for r in separate))
+        self.assertEqual([e["file"] for e in report["events"]], ["first.json", "second.json"])
+        self.assertEqual(balances.stats(), {"hits": 0, "misses": 2, "hit_ratio": 0.0, "entries": 2})
+        balances.save()
+        # a new run reads the saved totals; only the event that changed is read again
+        JsonStorage(first).commit({"op": "add_expense", "expense": expense("e9", "A", 1.0, [])})
+        again = EventBalances(self.path("cache.json"))
+        self.assertEqual(net_report([first, second], again)["total"], report["total"] + 1.0)
+        self.assertEqual(again.stats(), {"hits": 1, "misses": 1, "hit_ratio": 0.5, "entries": 2})
+        third = self.event("third.json", [{"op": "settings", "currency": "JPY"},
+                                          {"op": "set_participants", "names": ["A"]}])
+        with self.assertRaises(ValueError):
+            net_report([first, third], again)
+        with mock.patch("sys.stdout", io.StringIO()) as out:
+            self.assertEqual(netting_main(["--method=heap", first, second]), 0)
+        self.assertEqual(json.loads(out.getvalue())["settlement"]["method"], "heap")
+
+    def totals(self, path):
+        view = stream_ledger(path)
+        names = [p["name"] for p in view["participants"]]
+        return (names, dict(zip(names, view["paid"].values())), dict(zip(names, view["share"].values())),
+                view["total"])
+
+
+class ExpenseIndexTest(StorageTestCase):
+    def test_restoring_a_participant_without_expenses(self):
+        data = normalize({"participants": ["A", "B", "C"], "expenses": []})
+        index = ExpenseIndex()
+        for eid, payer in (("a", "A"), ("b1", "B"), ("b2", "B")):
+            mutations.apply(data, {"op": "add_expense", "expense": expense(eid, payer, 1.0, ["A"])}, index)
+        # the departure replaces the list; the restore appends nothing to it
+        mutations.apply(data, {"op": "delete_participant", "name": "A"}, index)
+        mutations.apply(data, {"op": "restore_participant", "name": "A", "expenses": []}, index)
+        self.assertTrue(mutations.apply(data, {"op": "delete_expense", "id": "b1"}, index))
+        self.assertEqual([e["id"] for e in data["expenses"]], ["b2"])
+
+    def test_a_change_from_another_list_rebuilds(self):
+        index = ExpenseIndex()
+        index.sync([{"id": "x"}, {"id": "y"}])
+        new = [{"id": "y"}, {"id": "z"}]
+        index.appended([{"id": "y"}], new, ["z"])
+        self.assertEqual((index.find(new, "z"), index.find(new, "x"), index.rebuilds), (1, None, 2))
+
+    def test_positions_follow_mutations(self):
+        data = normalize({"participants": ["A", "B"], "expenses": []})
+        index = ExpenseIndex()
+        for i in range(300):
+            mutations.apply(data, {"op": "add_expense", "expense": expense("x%d" % i, "A", 1.0, ["A"])}, index)
+        # enough deletes to trigger a compaction along the way
+        for i in range(0, 300, 3):
+            self.assertTrue(mutations.apply(data, {"op": "delete_expense", "id": "x%d" % i}, index))
+        self.assertFalse(mutations.apply(data, {"op": "delete_expense", "id": "x0"}, index))
+        mutations.apply(data, {"op": "edit_expense", "expense": expense("x7", "B", 2.0, ["B"])}, index)
+        self.assertFalse(mutations.apply(data, {"op": "restore_expense", "expense": expense("x8", "A", 1.0, ["A"])}, index))
+        self.assertTrue(mutations.apply(data, {"op": "restore_expense", "expense": expense("x0", "A", 1.0, ["A"])}, index))
+        for pos, e in enumerate(data["expenses"]):
+            self.assertEqual(index.find(data["expenses"], e["id"]), pos)
+        self.assertEqual(data["expenses"][index.find(data["expenses"], "x7")]["payer"], 2)
+        self.assertIsNone(index.find(data["expenses"], "x3"))
+
+    def test_warm_commits_do_not_rescan(self):
+        js = JsonStorage(self.path("data.json"))
+        js.commit(OPS[0])
+        for i in range(20):
+            js.commit({"op": "add_expense", "expense": expense("x%d" % i, "A", 1.0, ["A"])})
+        rebuilds = js.index.rebuilds
+        js.commit({"op": "edit_expense", "expense": expense("x5", "B", 3.0, ["B"])})
+        js.commit({"op": "delete_expense", "id": "x6"})
+        js.commit({"op": "restore_participant", "name": "A", "expenses": [expense("x6", "A", 1.0, ["A"])]})
+        self.assertEqual(js.get_expense("x5")["amount_minor"], 300)
+        self.assertEqual(js.index.rebuilds, rebuilds)
+
+    def test_duplicate_ids_fall_back_to_scans(self):
+        data = normalize({"participants": ["A"], "expenses": [expense("d", "A", 1.0, ["A"]),
+                                                              expense("d", "A", 2.0, ["A"])]})
+        mutations.apply(data, {"op": "edit_expense", "expense": expense("d", "A", 5.0, ["A"])}, ExpenseIndex())
+        self.assertEqual([e["amount_minor"] for e in data["expenses"]], [500, 200])
+        mutations.apply(data, {"op": "delete_expense", "id": "d"}, ExpenseIndex())
+        self.assertEqual(data["expenses"], [])
+
+
+class ExpenseListTest(unittest.TestCase):
+    def test_versions_share_what_they_did_not_change(self):
+        plain = [{"id": n} for n in range(3 * CHUNK + 5)]
+        versions = [ExpenseList([plain])]
+        expected = [plain]
+        for n, change in enumerate([lambda v: v.appended([{"id": "a"}]), lambda v: v.replaced(CHUNK + 3, {"id": "r"}),
+                                    lambda v: v.deleted(-2), lambda v: v.deleted(0), lambda v: v.appended([])]):
+            versions.append(change(versions[-1]))
+        expected.append(plain + [{"id": "a"}])
+        expected.append(expected[-1][:CHUNK + 3] + [{"id": "r"}] + expected[-1][CHUNK + 4:])
+        expected.append(expected[-1][:-2] + expected[-1][-1:])
+        expected.append(expected[-1][1:])
+        expected.append(expected[-1])
+        for version, items in zip(versions, expected):
+            self.assertEqual(version, items)
+            self.assertEqual(list(version), items)
+            self.assertEqual([version[i] for i in range(-len(items), len(items))], items + items)
+        # the wrapped list is never edited, and later versions copy one chunk each
+        self.assertEqual(len(plain), 3 * CHUNK + 5)
+        self.assertIs(versions[1]._chunks[0], plain)
+        self.assertIs(versions[3]._chunks[0], versions[2]._chunks[0])
+        self.assertEqual(json.loads(json.dumps({"expenses": versions[-1]}, default=to_json))["expenses"], expected[-1])
+
+    def test_mutations_leave_the_list_they_started_from(self):
+        data = normalize({"participants": ["A"], "expenses": [expense("x%d" % i, "A", 1.0, ["A"]) for i in range(5)]})
+        index = ExpenseIndex()
+        before = data["expenses"]
+        mutations.apply(data, {"op": "delete_expense", "id": "x1"}, index)
+        deleted = data["expenses"]
+        mutations.apply(data, {"op": "edit_expense", "expense": expense("x2", "A", 9.0, ["A"])}, index)
+        mutations.apply(data, {"op": "add_expense", "expense": expense("y", "A", 1.0, ["A"])}, index)
+        self.assertIsInstance(data["expenses"], ExpenseList)
+        self.assertEqual([e["id"] for e in before], ["x0", "x1", "x2", "x3", "x4"])
+        self.assertEqual([e["amount_minor"] for e in deleted], [100] * 4)
+        self.assertEqual([e["id"] for e in data["expenses"]], ["x0", "x2", "x3", "x4", "y"])
+        self.assertEqual(data["expenses"][1]["amount_minor"], 900)
+
+
+class GroupCommitTest(StorageTestCase):
+    def commit_concurrently(self, store, ops):
+        barrier = threading.Barrier(len(ops))
+        results = [None] * len(ops)
+
+        def worker(idx):
+            barrier.wait()
+            try:
+                results[idx] = store.commit(ops[idx])
+            except Exception as exc:
+                results[idx] = exc
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(ops))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        return results
+
+    def test_coalesces_concurrent_writes(self):
+        for inner in (JsonStorage(self.path("data.json")), JournalStorage(self.path("journal.json")),
+                      SqliteStorage(self.path("data.db"))):
+            store = GroupCommit(inner, 0.05)
+            self.addCleanup(store.close)
+            store.commit(OPS[0])
+            ops = [{"op": "add_expense", "expense": expense("x%d" % i, "A", i, ["A", "B"])} for i in range(16)]
+            self.assertEqual(self.commit_concurrently(store, ops), [True] * 16)
+            self.assertEqual(len(store.load()["expenses"]), 16)
+            stats = store.stats()["group_commit"]
+            self.assertEqual(stats["batched_ops"], 17)
+            self.assertLess(stats["batches"], 17)
+
+    def test_failed_record_does_not_sink_batch(self):
+        store = GroupCommit(JsonStorage(self.path("data.json")), 0.05)
+        ops = [OPS[0], {"op": "bogus"}, {"op": "settings", "event": "Trip"}]
+        results = self.commit_concurrently(store, ops)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(store.settings()["event"], "Trip")
+        self.assertEqual(store.participants(), ["A", "B", "C"])
+
+
+if __name__ == '__main__':
+    unittest.main()